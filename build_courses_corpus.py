@@ -0,0 +1,349 @@
+"""
+Офлайн-сборщик корпуса уроков для COURSES_V2_DIR.
+
+Генерирует уроки для языков x уровней x навыков (SKILL_ORDER) тем же промптом
+и той же валидацией, что и /generate_lesson, и пишет их в раскладку,
+которую читает CourseCatalog:
+
+    <out>/<lang>/<level>/<skill>/lessons/<lessonId>.json
+
+Пример:
+    python build_courses_corpus.py --langs en,de,es --levels A1,A2,B1 \\
+        --per-skill 8 --concurrency 4 --rps 2
+
+Повторный запуск продолжает с места остановки: уроки, чьи файлы уже
+лежат в <out>, пропускаются, остальные (в том числе упавшие) генерируются
+снова. Чекпоинт <out>/.corpus_build_state.json хранит итоги по урокам —
+пути готовых и причины ошибок — для разбора; решение о пропуске
+принимается только по файлам.
+
+Кэши бэкенда (TTS, ответы LLM) сборщику не нужны: на время работы они
+указывают во временный каталог, так что ни --dry-run, ни обычный запуск
+не трогают каталоги и базы работающего сервера.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+logger = logging.getLogger("courses_corpus")
+
+# Темы по умолчанию; свои можно передать через --themes (JSON-список строк
+# или объект {"A1": [...], "B1": [...]})
+DEFAULT_THEMES = [
+    "Greetings and introductions",
+    "Family and friends",
+    "Food and ordering at a cafe",
+    "Shopping and prices",
+    "Getting around the city",
+    "Travel and hotels",
+    "Work and office life",
+    "Health and the doctor",
+    "Hobbies and free time",
+    "Home and housing",
+    "Weather and seasons",
+    "Plans and invitations",
+    "Technology and apps",
+    "Studying and exams",
+    "Culture, films and music",
+    "News and society",
+]
+
+SKILL_FOCUS = {
+    "vocabulary": "new words and collocations for the theme",
+    "grammar": "grammar patterns typical for this level",
+    "listening": "short dialogues and comprehension of spoken phrases",
+    "speaking": "ready-to-use phrases and dialogue responses",
+    "writing": "short messages, e-mails and texts",
+    "error_correction": "spotting and fixing typical learner mistakes",
+}
+
+STATE_FILE = ".corpus_build_state.json"
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", text.casefold()).strip("-")[:60] or "lesson"
+
+
+def _norm_question(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+
+def _load_themes(path: Optional[str]) -> Dict[str, List[str]]:
+    if not path:
+        return {"*": DEFAULT_THEMES}
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    if isinstance(data, list):
+        return {"*": [str(t) for t in data]}
+    return {str(k).upper() if k != "*" else "*": [str(t) for t in v] for k, v in data.items()}
+
+
+class RateLimiter:
+    """Не чаще rps стартов запросов в секунду (равномерно, без всплесков)."""
+
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class CorpusBuilder:
+    def __init__(self, backend, args):
+        self.backend = backend
+        self.args = args
+        self.out = Path(args.out)
+        self.state_path = self.out / STATE_FILE
+        self.state: Dict[str, Any] = {"done": {}, "failed": {}}
+        if self.state_path.exists():
+            try:
+                self.state = json.loads(self.state_path.read_text(encoding="utf-8"))
+            except Exception as e:
+                logger.warning("[CORPUS] broken checkpoint %s, starting fresh: %s", self.state_path, e)
+        self.state.setdefault("done", {})
+        self.state.setdefault("failed", {})
+        self.limiter = RateLimiter(args.rps)
+        self.sem = asyncio.Semaphore(args.concurrency)
+        # вопросы, уже встречавшиеся в корпусе: (lang, level, skill) -> set
+        self.seen_questions: Dict[tuple, Set[str]] = {}
+        self.counts = {"done": 0, "skipped": 0, "failed": 0, "dup_exercises": 0}
+        self.total = 0
+        self.started = time.monotonic()
+        self._dirty = 0
+
+    # ---------- план работ ----------
+
+    def plan_jobs(self) -> List[Dict[str, Any]]:
+        themes = _load_themes(self.args.themes)
+        skills = [s.strip() for s in self.args.skills.split(",") if s.strip()] if self.args.skills else list(
+            self.backend.SKILL_ORDER
+        )
+        jobs: List[Dict[str, Any]] = []
+        seen_ids = set()
+        for lang_raw in self.args.langs.split(","):
+            lang = self.backend.normalize_lang_code(lang_raw.strip())
+            if not lang:
+                continue
+            for level in (l.strip().upper() for l in self.args.levels.split(",") if l.strip()):
+                level_themes = themes.get(level, themes.get("*", DEFAULT_THEMES))[: self.args.per_skill]
+                for skill in skills:
+                    skill = self.backend._normalize_lesson_skill(skill)
+                    for theme in level_themes:
+                        lesson_id = f"{lang}-{level.lower()}-{skill}-{_slug(theme)}"
+                        if lesson_id in seen_ids:
+                            continue
+                        seen_ids.add(lesson_id)
+                        jobs.append(
+                            {
+                                "lesson_id": lesson_id,
+                                "lang": lang,
+                                "level": level,
+                                "skill": skill,
+                                "theme": theme,
+                                "path": self.out / lang / level / skill / "lessons" / f"{lesson_id}.json",
+                            }
+                        )
+        return jobs
+
+    def _index_existing(self, job: Dict[str, Any]) -> None:
+        """Вопросы из уже готовых уроков — чтобы новые не повторяли их."""
+        try:
+            data = json.loads(job["path"].read_text(encoding="utf-8"))
+        except Exception:
+            return
+        bucket = self.seen_questions.setdefault((job["lang"], job["level"], job["skill"]), set())
+        for ex in data.get("exercises") or []:
+            if isinstance(ex, dict) and ex.get("question"):
+                bucket.add(_norm_question(str(ex["question"])))
+
+    # ---------- генерация ----------
+
+    async def _generate(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        backend = self.backend
+        req = backend.LessonRequest(
+            language=job["lang"],
+            level_hint=job["level"],
+            lesson_title=job["theme"],
+            vocab_topics=[job["theme"]],
+            grammar_topics=[SKILL_FOCUS.get(job["skill"], job["skill"])],
+            skill=job["skill"],
+        )
+        lesson = await backend._generate_lesson_llm(req)
+
+        bucket = self.seen_questions.setdefault((job["lang"], job["level"], job["skill"]), set())
+        exercises = []
+        questions: Set[str] = set()
+        for ex in lesson.exercises:
+            q = _norm_question(ex.question or "")
+            if q and (q in bucket or q in questions):
+                self.counts["dup_exercises"] += 1
+                continue
+            if q:
+                questions.add(q)
+            exercises.append(ex.dict(exclude_none=True))
+        if len(exercises) < self.args.min_exercises:
+            raise ValueError(f"only {len(exercises)} unique exercises")
+        bucket.update(questions)
+
+        return {
+            "lessonId": job["lesson_id"],
+            "title": lesson.lesson_title or job["theme"],
+            "skill": job["skill"],
+            "level": job["level"],
+            "language": job["lang"],
+            "theme": job["theme"],
+            "description": lesson.description,
+            "exercises": exercises,
+            "generator": {"model": backend.LLM_MODEL, "created_at": int(time.time())},
+        }
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        lesson_id = job["lesson_id"]
+        async with self.sem:
+            last_error = ""
+            for attempt in range(1, self.args.retries + 2):
+                await self.limiter.wait()
+                try:
+                    data = await self._generate(job)
+                    break
+                except Exception as e:
+                    last_error = str(e)
+                    logger.warning("[CORPUS] %s attempt %d failed: %s", lesson_id, attempt, e)
+            else:
+                self.state["failed"][lesson_id] = last_error
+                self.counts["failed"] += 1
+                self._checkpoint()
+                return
+
+        path: Path = job["path"]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+
+        self.state["done"][lesson_id] = str(path.relative_to(self.out))
+        self.state["failed"].pop(lesson_id, None)
+        self.counts["done"] += 1
+        self._checkpoint()
+
+    def _checkpoint(self, force: bool = False) -> None:
+        self._dirty += 1
+        if not force and self._dirty < self.args.checkpoint_every:
+            return
+        self._dirty = 0
+        self.out.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.state, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, self.state_path)
+
+    async def _report_progress(self) -> None:
+        while True:
+            await asyncio.sleep(self.args.progress_every)
+            self._log_progress()
+
+    def _log_progress(self) -> None:
+        finished = self.counts["done"] + self.counts["failed"]
+        todo = self.total - self.counts["skipped"]
+        elapsed = time.monotonic() - self.started
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        eta = (todo - finished) / rate if rate > 0 else float("inf")
+        logger.info(
+            "[CORPUS] %d/%d done, %d failed, %d skipped, %d dup exercises dropped | %.2f lessons/s, ETA %s",
+            self.counts["done"],
+            todo,
+            self.counts["failed"],
+            self.counts["skipped"],
+            self.counts["dup_exercises"],
+            rate,
+            f"{eta / 60:.1f} min" if eta != float("inf") else "?",
+        )
+
+    async def run(self) -> int:
+        jobs = self.plan_jobs()
+        self.total = len(jobs)
+        pending = []
+        for job in jobs:
+            if job["path"].exists():
+                self.counts["skipped"] += 1
+                self._index_existing(job)
+            else:
+                pending.append(job)
+        retrying = sum(1 for job in pending if job["lesson_id"] in self.state["failed"])
+        logger.info(
+            "[CORPUS] %d lessons planned, %d already built, %d to generate (%d failed last time) -> %s",
+            self.total,
+            self.counts["skipped"],
+            len(pending),
+            retrying,
+            self.out,
+        )
+        if self.args.dry_run:
+            for job in pending:
+                print(job["path"])
+            return 0
+
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            await asyncio.gather(*(self._run_job(job) for job in pending))
+        finally:
+            reporter.cancel()
+            self._checkpoint(force=True)
+            await self.backend.LLM_HTTP.aclose()
+        self._log_progress()
+        return 1 if self.counts["failed"] else 0
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Bulk-generate the courses_v2 lesson corpus.")
+    ap.add_argument("--langs", required=True, help="comma-separated languages, e.g. en,de,es")
+    ap.add_argument("--levels", default="A1,A2,B1,B2", help="comma-separated CEFR levels")
+    ap.add_argument("--skills", default="", help="comma-separated skills (default: SKILL_ORDER)")
+    ap.add_argument("--per-skill", type=int, default=8, help="lessons per language/level/skill")
+    ap.add_argument("--themes", default="", help="JSON file with themes (list or {level: list})")
+    ap.add_argument("--out", default=os.getenv("COURSES_V2_DIR", "/workspace/langapp/courses_v2"))
+    ap.add_argument("--concurrency", type=int, default=2, help="parallel LLM requests")
+    ap.add_argument("--rps", type=float, default=1.0, help="max request starts per second (0 = unlimited)")
+    ap.add_argument("--retries", type=int, default=2)
+    ap.add_argument("--min-exercises", type=int, default=6, help="min unique exercises per lesson")
+    ap.add_argument("--checkpoint-every", type=int, default=5, help="flush checkpoint every N results")
+    ap.add_argument("--progress-every", type=float, default=15.0, help="progress log interval, seconds")
+    ap.add_argument("--dry-run", action="store_true", help="only list lessons that would be generated")
+    return ap.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    # LLM-семафор бэкенда создаётся при импорте — выставляем лимит до него
+    os.environ["LLM_MAX_CONCURRENCY"] = str(max(1, args.concurrency))
+    # импорт бэкенда открывает TTS-кэш и SQLite-кэш ответов и создаёт их каталоги;
+    # сборщику они не нужны — уводим их во временный каталог
+    with tempfile.TemporaryDirectory(prefix="corpus_build_", ignore_cleanup_errors=True) as scratch:
+        os.environ["AUDIO_CACHE_DIR"] = os.path.join(scratch, "audio_cache")
+        os.environ["AUDIO_CACHE_INDEX_PATH"] = os.path.join(scratch, "audio_cache", ".index.sqlite3")
+        os.environ["CACHE_DB_PATH"] = os.path.join(scratch, "response_cache.sqlite3")
+        import language_tutor_backend as backend
+
+        return asyncio.run(CorpusBuilder(backend, args).run())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,38 @@
 import asyncio
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Query
+from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Query, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional, Literal
 import os
 import json
+import re
 import httpx
 from typing import Dict, Any
 import subprocess  # для whisper STT и piper CLI
 import logging
 import tempfile  # для временного файла в /stt
 import hashlib
+import unicodedata
+import gzip
 from pathlib import Path
 import time
+import io
+import copy
+import uuid
+import wave
+import queue
+import select
+import shutil
+import threading
+import sqlite3
+import heapq
+import operator
+from array import array
+from collections import deque, OrderedDict
+from typing import Deque, AsyncIterator
+from contextlib import asynccontextmanager
+from concurrent.futures import Future
 
 logger = logging.getLogger("language_tutor_backend")
 
@@ -94,77 +113,332 @@ def normalize_lang_code(language: str) -> str:
     return lang
 
 
-def synthesize_tts_piper(text: str, model_path: str) -> bytes:
-    """
-    Piper -> WAV (temp) -> MP3 (ffmpeg).
-    Возвращает MP3 bytes.
-    """
-    import tempfile
-    import subprocess
-    import os
-
-    PIPER_BIN = "/workspace/langapp/piper_bin/piper/piper"
-
-    if not os.path.exists(PIPER_BIN):
-        raise RuntimeError(f"piper binary not found: {PIPER_BIN}")
-    if not os.path.exists(model_path):
-        raise RuntimeError(f"piper model not found: {model_path}")
+# Бинарник piper и параметры пула долгоживущих процессов
+PIPER_BIN = os.getenv("PIPER_BIN", "/workspace/langapp/piper_bin/piper/piper")
+PIPER_WORKERS_PER_MODEL = max(1, int(os.getenv("PIPER_WORKERS_PER_MODEL", "2")))
+PIPER_SYNTH_TIMEOUT = float(os.getenv("PIPER_SYNTH_TIMEOUT", "30"))
+# Языки, модели которых загружаем сразу при старте (через запятую: "en,de")
+PIPER_PRELOAD_LANGS = [
+    code.strip() for code in os.getenv("PIPER_PRELOAD_LANGS", "").split(",") if code.strip()
+]
+# WAV от piper пишем в tmpfs, чтобы не ходить на диск
+PIPER_SCRATCH_DIR = os.getenv(
+    "PIPER_SCRATCH_DIR",
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+)
 
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
-        wav_path = f.name
 
-    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as f:
-        mp3_path = f.name
+class _PiperWorker:
+    """
+    Один долгоживущий процесс piper с уже загруженной ONNX-моделью.
+    Текст получает построчно через stdin (--json-input), в ответ печатает путь к WAV.
+    """
 
-    try:
-        # 1️⃣ Piper -> WAV
-        proc = subprocess.run(
-            [PIPER_BIN, "--model", model_path, "--output_file", wav_path],
-            input=text.encode("utf-8"),
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.out_dir = tempfile.mkdtemp(prefix="piper_", dir=PIPER_SCRATCH_DIR)
+        self._stderr_tail: Deque[str] = deque(maxlen=50)
+        self.proc = subprocess.Popen(
+            [PIPER_BIN, "--model", model_path, "--json-input", "--output_dir", self.out_dir],
+            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             env=os.environ.copy(),
         )
+        # piper много пишет в stderr — вычитываем в фоне, чтобы пайп не переполнился
+        threading.Thread(target=self._drain_stderr, daemon=True).start()
 
-        if proc.returncode != 0:
-            raise RuntimeError(proc.stderr.decode("utf-8", "ignore")[:1000])
+    def _drain_stderr(self) -> None:
+        for raw in iter(self.proc.stderr.readline, b""):
+            self._stderr_tail.append(raw.decode("utf-8", "ignore").rstrip())
+
+    def is_alive(self) -> bool:
+        return self.proc.poll() is None
 
-        if not os.path.exists(wav_path) or os.path.getsize(wav_path) < 200:
+    def synthesize(self, text: str, timeout: float) -> bytes:
+        """Возвращает WAV bytes для одной фразы."""
+        out_path = os.path.join(self.out_dir, f"{uuid.uuid4().hex}.wav")
+        line = json.dumps({"text": text, "output_file": out_path}, ensure_ascii=False)
+        self.proc.stdin.write(line.encode("utf-8") + b"\n")
+        self.proc.stdin.flush()
+
+        ready, _, _ = select.select([self.proc.stdout], [], [], timeout)
+        if not ready:
+            raise RuntimeError(f"piper timed out after {timeout:.0f}s")
+
+        printed = self.proc.stdout.readline().decode("utf-8", "ignore").strip()
+        if not printed:
+            raise RuntimeError("piper exited: " + " | ".join(list(self._stderr_tail)[-5:]))
+
+        wav_path = printed if os.path.isabs(printed) else out_path
+        try:
+            with open(wav_path, "rb") as f:
+                wav = f.read()
+        finally:
+            try:
+                os.remove(wav_path)
+            except Exception:
+                pass
+
+        if len(wav) < 200:
             raise RuntimeError("piper produced empty wav")
+        return wav
+
+    def close(self) -> None:
+        try:
+            if self.proc.stdin:
+                self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+        shutil.rmtree(self.out_dir, ignore_errors=True)
 
-        # 2️⃣ WAV -> MP3 (ffmpeg из workspace)
-        proc2 = subprocess.run(
-            [
-                FFMPEG_BIN,
-                "-y",
-                "-i", wav_path,
-                "-codec:a", "libmp3lame",
-                "-b:a", "64k",
-                mp3_path,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
 
-        if proc2.returncode != 0:
-            raise RuntimeError(proc2.stderr.decode("utf-8", "ignore")[:1000])
+class PiperEngine:
+    """
+    Пул тёплых piper-процессов: на каждую модель до PIPER_WORKERS_PER_MODEL воркеров.
+    Модель грузится один раз при старте воркера, дальше фразы идут через пайп.
+    """
 
-        if not os.path.exists(mp3_path) or os.path.getsize(mp3_path) < 200:
-            raise RuntimeError("ffmpeg produced empty mp3")
+    def __init__(self, workers_per_model: int):
+        self.workers_per_model = workers_per_model
+        self._lock = threading.Lock()
+        self._idle: Dict[str, "queue.Queue[_PiperWorker]"] = {}
+        self._spawned: Dict[str, int] = {}
 
-        with open(mp3_path, "rb") as f:
-            return f.read()
+    def _checkout(self, model_path: str) -> _PiperWorker:
+        with self._lock:
+            idle = self._idle.setdefault(model_path, queue.Queue())
+            spawn = idle.empty() and self._spawned.get(model_path, 0) < self.workers_per_model
+            if spawn:
+                self._spawned[model_path] = self._spawned.get(model_path, 0) + 1
 
-    finally:
-        for p in (wav_path, mp3_path):
+        if spawn:
             try:
-                os.remove(p)
+                logger.info("[TTS] starting piper worker model=%s", model_path)
+                return _PiperWorker(model_path)
             except Exception:
-                pass
+                with self._lock:
+                    self._spawned[model_path] -= 1
+                raise
+
+        try:
+            return idle.get(timeout=PIPER_SYNTH_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError(f"no free piper worker for {model_path}")
+
+    def _discard(self, worker: _PiperWorker) -> None:
+        worker.close()
+        with self._lock:
+            self._spawned[worker.model_path] -= 1
+
+    def synthesize(self, text: str, model_path: str) -> bytes:
+        worker = self._checkout(model_path)
+        if not worker.is_alive():
+            self._discard(worker)
+            worker = self._checkout(model_path)
+
+        try:
+            wav = worker.synthesize(text, timeout=PIPER_SYNTH_TIMEOUT)
+        except Exception:
+            # процесс в неизвестном состоянии — выбрасываем, следующий запрос поднимет новый
+            self._discard(worker)
+            raise
+
+        self._idle[model_path].put(worker)
+        return wav
+
+    def warmup(self, languages: List[str]) -> None:
+        for language in languages:
+            model_path = _piper_model_path_for_language(language)
+            if not model_path or not os.path.exists(model_path):
+                logger.warning("[TTS] skip piper warmup, model not found: %s", model_path)
+                continue
+            try:
+                worker = self._checkout(model_path)
+                self._idle[model_path].put(worker)
+            except Exception:
+                logger.exception("[TTS] piper warmup failed model=%s", model_path)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                path: {"workers": self._spawned.get(path, 0), "idle": idle.qsize()}
+                for path, idle in self._idle.items()
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            pools = list(self._idle.values())
+            self._idle.clear()
+            self._spawned.clear()
+        for idle in pools:
+            while not idle.empty():
+                idle.get_nowait().close()
+
+
+PIPER_ENGINE = PiperEngine(PIPER_WORKERS_PER_MODEL)
+
+
+# ---------- Кодирование PCM -> MP3/Opus в памяти ----------
+
+try:
+    # PyAV кодирует прямо в процессе; без него — ffmpeg через пайпы
+    import av
+except Exception:
+    av = None
+
+TTS_AUDIO_FORMAT = os.getenv("TTS_AUDIO_FORMAT", "mp3").strip().lower()
+
+AUDIO_FORMATS: Dict[str, Dict[str, Any]] = {
+    "mp3": {"ext": "mp3", "container": "mp3", "codec": "libmp3lame", "bit_rate": 64000, "rate": None},
+    "opus": {"ext": "opus", "container": "ogg", "codec": "libopus", "bit_rate": 32000, "rate": 48000},
+}
+
+TTS_STAGE_STATS: Dict[str, float] = {
+    "phrases": 0,
+    "synth_ms_total": 0.0,
+    "encode_ms_total": 0.0,
+    "bytes_total": 0,
+}
+_TTS_STATS_LOCK = threading.Lock()
+
+
+def _normalize_audio_format(audio_format: Optional[str]) -> str:
+    fmt = (audio_format or "").strip().lower()
+    if fmt in AUDIO_FORMATS:
+        return fmt
+    return TTS_AUDIO_FORMAT if TTS_AUDIO_FORMAT in AUDIO_FORMATS else "mp3"
+
+
+def _wav_to_pcm(wav_bytes: bytes) -> tuple[bytes, int, int]:
+    """WAV bytes -> (s16le PCM, sample_rate, channels) без записи на диск."""
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wav_file:
+        if wav_file.getsampwidth() != 2:
+            raise RuntimeError(f"unsupported wav sample width: {wav_file.getsampwidth()}")
+        pcm = wav_file.readframes(wav_file.getnframes())
+        return pcm, wav_file.getframerate(), wav_file.getnchannels()
+
+
+def _pcm_to_wav(pcm: bytes, sample_rate: int, channels: int = 1) -> bytes:
+    """s16le PCM -> WAV bytes в памяти."""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return buf.getvalue()
+
+
+def _encode_pcm_av(pcm: bytes, sample_rate: int, channels: int, audio_format: str) -> bytes:
+    spec = AUDIO_FORMATS[audio_format]
+    layout = "mono" if channels == 1 else "stereo"
+    out = io.BytesIO()
+    container = av.open(out, mode="w", format=spec["container"])
+    stream = container.add_stream(spec["codec"], rate=spec["rate"] or sample_rate)
+    stream.bit_rate = spec["bit_rate"]
+    stream.layout = layout
+
+    frame = av.AudioFrame(format="s16", layout=layout, samples=len(pcm) // (2 * channels))
+    frame.planes[0].update(pcm)
+    frame.sample_rate = sample_rate
+
+    for packet in stream.encode(frame):
+        container.mux(packet)
+    for packet in stream.encode(None):
+        container.mux(packet)
+    container.close()
+    return out.getvalue()
+
+
+def _encode_pcm_ffmpeg(pcm: bytes, sample_rate: int, channels: int, audio_format: str) -> bytes:
+    spec = AUDIO_FORMATS[audio_format]
+    cmd = [
+        FFMPEG_BIN,
+        "-hide_banner", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels),
+        "-i", "pipe:0",
+        "-codec:a", spec["codec"],
+        "-b:a", f"{spec['bit_rate'] // 1000}k",
+    ]
+    if spec["rate"]:
+        cmd += ["-ar", str(spec["rate"])]
+    cmd += ["-f", spec["container"], "pipe:1"]
+
+    proc = subprocess.run(cmd, input=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode("utf-8", "ignore")[:1000])
+    return proc.stdout
+
 
+def encode_pcm(pcm: bytes, sample_rate: int, channels: int = 1, audio_format: str = "mp3") -> bytes:
+    """
+    Сырой PCM (s16le) -> MP3 / Opus bytes целиком в памяти.
+    """
+    audio_format = _normalize_audio_format(audio_format)
+    if av is not None:
+        audio = _encode_pcm_av(pcm, sample_rate, channels, audio_format)
+    else:
+        audio = _encode_pcm_ffmpeg(pcm, sample_rate, channels, audio_format)
+
+    if len(audio) < 200:
+        raise RuntimeError(f"encoder produced empty {audio_format}")
+    return audio
+
+
+def _tts_stage_stats_snapshot() -> Dict[str, Any]:
+    with _TTS_STATS_LOCK:
+        stats = dict(TTS_STAGE_STATS)
+    phrases = stats["phrases"] or 1
+    stats["synth_ms_avg"] = round(stats["synth_ms_total"] / phrases, 1)
+    stats["encode_ms_avg"] = round(stats["encode_ms_total"] / phrases, 1)
+    stats["encoder"] = "pyav" if av is not None else "ffmpeg-pipe"
+    return stats
+
+
+def synthesize_tts_piper(text: str, model_path: str, audio_format: str = "mp3") -> bytes:
+    """
+    Piper (тёплый воркер) -> PCM -> MP3/Opus, всё в памяти.
+    Возвращает закодированные bytes.
+    """
+    if not os.path.exists(PIPER_BIN):
+        raise RuntimeError(f"piper binary not found: {PIPER_BIN}")
+    if not os.path.exists(model_path):
+        raise RuntimeError(f"piper model not found: {model_path}")
+
+    t0 = time.perf_counter()
+    wav_bytes = PIPER_ENGINE.synthesize(text, model_path)
+    pcm, sample_rate, channels = _wav_to_pcm(wav_bytes)
+    t1 = time.perf_counter()
+    audio = encode_pcm(pcm, sample_rate, channels, audio_format)
+    t2 = time.perf_counter()
+
+    synth_ms = (t1 - t0) * 1000
+    encode_ms = (t2 - t1) * 1000
+    with _TTS_STATS_LOCK:
+        TTS_STAGE_STATS["phrases"] += 1
+        TTS_STAGE_STATS["synth_ms_total"] += synth_ms
+        TTS_STAGE_STATS["encode_ms_total"] += encode_ms
+        TTS_STAGE_STATS["bytes_total"] += len(audio)
 
+    logger.info(
+        "[TTS] stages synth=%.0fms encode=%.0fms format=%s bytes=%d",
+        synth_ms,
+        encode_ms,
+        audio_format,
+        len(audio),
+    )
+    return audio
 
-def synthesize_with_piper(text: str, language: str, voice: Optional[str] = None) -> bytes:
+
+
+def synthesize_with_piper(
+    text: str,
+    language: str,
+    voice: Optional[str] = None,
+    audio_format: Optional[str] = None,
+) -> bytes:
     """
     Озвучка текста через Piper бинарник.
     """
@@ -184,7 +458,7 @@ def synthesize_with_piper(text: str, language: str, voice: Optional[str] = None)
         model_path = _piper_model_path_for_language(language)
 
     t0 = time.time()
-    audio = synthesize_tts_piper(text, model_path)
+    audio = synthesize_tts_piper(text, model_path, _normalize_audio_format(audio_format))
     logger.info(
         "[TTS] Piper synth took %.2fs bytes=%d model=%s",
         time.time() - t0,
@@ -194,15 +468,373 @@ def synthesize_with_piper(text: str, language: str, voice: Optional[str] = None)
     return audio
 
 
+# ---------- Кэш озвучки: индекс, вытеснение, RAM-слой ----------
+
+
+class _SingleFlight:
+    """
+    Схлопывает параллельные вызовы с одинаковым ключом: работу делает первый
+    поток, остальные ждут его результат (или его исключение).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+        self.coalesced = 0
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+class TTSAudioCache:
+    """
+    Контент-адресный кэш аудио в AUDIO_CACHE_DIR.
+
+    Индекс (размер, язык, последний доступ, число попаданий) живёт в памяти
+    и сохраняется в SQLite, так что попадание — это поиск в dict, без stat().
+    При превышении max_bytes вытесняем по LRU или LFU; самые горячие клипы
+    держим целиком в RAM (ram_bytes).
+    """
+
+    FLUSH_EVERY = 100  # сколько "касаний" копим перед записью в SQLite
+
+    def __init__(
+        self,
+        directory: Path,
+        index_path: Path,
+        max_bytes: int,
+        ram_bytes: int,
+        policy: str = "lru",
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ram_bytes = ram_bytes
+        self.policy = policy if policy in ("lru", "lfu") else "lru"
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._ram: "OrderedDict[str, bytes]" = OrderedDict()
+        self._ram_size = 0
+        self._total_size = 0
+        self._dirty: set = set()
+        # для LFU: куча (hits, last_access, filename) с ленивым удалением устаревших записей
+        self._lfu_heap: List[tuple] = []
+        self.counters = {"hits": 0, "misses": 0, "ram_hits": 0, "evictions": 0, "evicted_bytes": 0}
+
+        self._db = sqlite3.connect(str(index_path), check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tts_cache (
+                filename TEXT PRIMARY KEY,
+                language TEXT,
+                size INTEGER,
+                created_at REAL,
+                last_access REAL,
+                hits INTEGER
+            )
+            """
+        )
+        self._load()
+
+    def _load(self) -> None:
+        rows = self._db.execute(
+            "SELECT filename, language, size, created_at, last_access, hits "
+            "FROM tts_cache ORDER BY last_access"
+        ).fetchall()
+        indexed = {
+            row[0]: {
+                "language": row[1] or "",
+                "size": row[2],
+                "created_at": row[3],
+                "last_access": row[4],
+                "hits": row[5],
+            }
+            for row in rows
+        }
+
+        on_disk: Dict[str, os.stat_result] = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.startswith(".") and entry.name.endswith(".tmp"):
+                # недописанный файл после падения процесса
+                os.remove(entry.path)
+                continue
+            if not entry.name.startswith("."):
+                on_disk[entry.name] = entry.stat()
+
+        # файлы, пропавшие с диска, забываем; осиротевшие (без записи в индексе) — усыновляем
+        stale = [name for name in indexed if name not in on_disk]
+        for name, st in on_disk.items():
+            if name not in indexed:
+                indexed[name] = {
+                    "language": "",
+                    "size": st.st_size,
+                    "created_at": st.st_mtime,
+                    "last_access": st.st_mtime,
+                    "hits": 0,
+                }
+                self._dirty.add(name)
+
+        for name in stale:
+            indexed.pop(name, None)
+        for name, meta in sorted(indexed.items(), key=lambda kv: kv[1]["last_access"]):
+            self._entries[name] = meta
+            self._total_size += meta["size"]
+        self._rebuild_lfu_heap_locked()
+
+        with self._db:
+            self._db.executemany("DELETE FROM tts_cache WHERE filename = ?", [(n,) for n in stale])
+        self._evict_locked()
+        self._flush_locked()
+        logger.info(
+            "[TTS_CACHE] loaded entries=%d bytes=%d budget=%d policy=%s",
+            len(self._entries),
+            self._total_size,
+            self.max_bytes,
+            self.policy,
+        )
+
+    def _touch_locked(self, filename: str) -> Dict[str, Any]:
+        meta = self._entries[filename]
+        meta["last_access"] = time.time()
+        meta["hits"] += 1
+        self._entries.move_to_end(filename)
+        self._lfu_push_locked(filename, meta)
+        self._dirty.add(filename)
+        if len(self._dirty) >= self.FLUSH_EVERY:
+            self._flush_locked()
+        return meta
+
+    def _lfu_push_locked(self, filename: str, meta: Dict[str, Any]) -> None:
+        if self.policy != "lfu":
+            return
+        heapq.heappush(self._lfu_heap, (meta["hits"], meta["last_access"], filename))
+        # каждое касание добавляет запись; устаревшие периодически выбрасываем
+        if len(self._lfu_heap) > 2 * len(self._entries) + 1024:
+            self._rebuild_lfu_heap_locked()
+
+    def _rebuild_lfu_heap_locked(self) -> None:
+        if self.policy != "lfu":
+            return
+        self._lfu_heap = [(m["hits"], m["last_access"], name) for name, m in self._entries.items()]
+        heapq.heapify(self._lfu_heap)
+
+    def _flush_locked(self) -> None:
+        if not self._dirty:
+            return
+        rows = [
+            (
+                name,
+                self._entries[name]["language"],
+                self._entries[name]["size"],
+                self._entries[name]["created_at"],
+                self._entries[name]["last_access"],
+                self._entries[name]["hits"],
+            )
+            for name in self._dirty
+            if name in self._entries
+        ]
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tts_cache "
+                "(filename, language, size, created_at, last_access, hits) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        self._dirty.clear()
+
+    def _ram_put_locked(self, filename: str, data: bytes) -> None:
+        if len(data) > self.ram_bytes:
+            return
+        old = self._ram.pop(filename, None)
+        if old is not None:
+            self._ram_size -= len(old)
+        self._ram[filename] = data
+        self._ram_size += len(data)
+        while self._ram_size > self.ram_bytes and self._ram:
+            _, dropped = self._ram.popitem(last=False)
+            self._ram_size -= len(dropped)
+
+    def _pick_victim_locked(self) -> str:
+        if self.policy == "lfu":
+            while self._lfu_heap:
+                hits, last_access, name = heapq.heappop(self._lfu_heap)
+                meta = self._entries.get(name)
+                # запись актуальна, только если клип с тех пор не трогали и не вытесняли
+                if meta is not None and meta["hits"] == hits and meta["last_access"] == last_access:
+                    return name
+        return next(iter(self._entries))
+
+    def _evict_locked(self) -> None:
+        if self._total_size <= self.max_bytes:
+            return
+        # вытесняем с запасом до 90% бюджета, чтобы не чистить на каждой записи
+        target = int(self.max_bytes * 0.9)
+        evicted = []
+        while self._total_size > target and self._entries:
+            name = self._pick_victim_locked()
+            meta = self._entries.pop(name)
+            self._total_size -= meta["size"]
+            data = self._ram.pop(name, None)
+            if data is not None:
+                self._ram_size -= len(data)
+            self._dirty.discard(name)
+            evicted.append(name)
+            self.counters["evictions"] += 1
+            self.counters["evicted_bytes"] += meta["size"]
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
+            except Exception:
+                logger.exception("[TTS_CACHE] failed to delete %s", name)
+
+        with self._db:
+            self._db.executemany("DELETE FROM tts_cache WHERE filename = ?", [(n,) for n in evicted])
+        logger.info("[TTS_CACHE] evicted %d files, size now %d", len(evicted), self._total_size)
+
+    def lookup(self, filename: str) -> Optional[Path]:
+        """Путь к файлу, если он в кэше (без обращения к диску)."""
+        with self._lock:
+            if filename not in self._entries:
+                self.counters["misses"] += 1
+                return None
+            self._touch_locked(filename)
+            self.counters["hits"] += 1
+        return self.directory / filename
+
+    def peek(self, filename: str) -> Optional[Path]:
+        """Как lookup, но без учёта в счётчиках и LRU."""
+        with self._lock:
+            if filename in self._entries:
+                return self.directory / filename
+        return None
+
+    def put(self, filename: str, data: bytes, language: str) -> Path:
+        filepath = self.directory / filename
+        # пишем во временный файл и атомарно переименовываем —
+        # /audio никогда не увидит недописанный клип
+        tmp_path = self.directory / f".{filename}.{uuid.uuid4().hex}.tmp"
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        now = time.time()
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old is not None:
+                self._total_size -= old["size"]
+            self._entries[filename] = {
+                "language": language,
+                "size": len(data),
+                "created_at": now,
+                "last_access": now,
+                "hits": 0,
+            }
+            self._total_size += len(data)
+            self._lfu_push_locked(filename, self._entries[filename])
+            self._dirty.add(filename)
+            self._ram_put_locked(filename, data)
+            self._evict_locked()
+            self._flush_locked()
+        return filepath
+
+    def read_from_ram(self, filename: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._ram.get(filename)
+            if data is None:
+                return None
+            self._ram.move_to_end(filename)
+            self._touch_locked(filename)
+            self.counters["ram_hits"] += 1
+            return data
+
+    def read(self, filename: str) -> Optional[bytes]:
+        """Байты клипа для раздачи: RAM-слой, затем диск (с подъёмом в RAM)."""
+        data = self.read_from_ram(filename)
+        if data is not None:
+            return data
+
+        with self._lock:
+            if filename not in self._entries:
+                return None
+
+        try:
+            data = (self.directory / filename).read_bytes()
+        except FileNotFoundError:
+            # файл удалили снаружи — чистим индекс
+            with self._lock:
+                meta = self._entries.pop(filename, None)
+                if meta is not None:
+                    self._total_size -= meta["size"]
+                with self._db:
+                    self._db.execute("DELETE FROM tts_cache WHERE filename = ?", (filename,))
+            return None
+
+        with self._lock:
+            if filename in self._entries:
+                self._touch_locked(filename)
+                self._ram_put_locked(filename, data)
+        return data
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": round(self.counters["hits"] / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._total_size,
+                "max_bytes": self.max_bytes,
+                "ram_entries": len(self._ram),
+                "ram_bytes": self._ram_size,
+                "policy": self.policy,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_locked()
+            self._db.close()
+
+
 def _build_tts_cache_filename(
     text: str,
     language: Optional[str],
     voice: Optional[str],
     sample_rate: Optional[int],
+    audio_format: Optional[str] = None,
 ) -> str:
     cache_key_raw = f"{voice or ''}|{sample_rate or ''}|{language or ''}|{text}"
     cache_key = hashlib.sha1(cache_key_raw.encode("utf-8")).hexdigest()
-    return f"{cache_key}.mp3"
+    ext = AUDIO_FORMATS[_normalize_audio_format(audio_format)]["ext"]
+    return f"{cache_key}.{ext}"
 
 
 def _ensure_cached_tts_file(
@@ -210,15 +842,35 @@ def _ensure_cached_tts_file(
     language: Optional[str],
     voice: Optional[str],
     sample_rate: Optional[int],
+    audio_format: Optional[str] = None,
 ) -> Path:
     """
-    Returns path to cached wav file for given TTS params, generating it if needed.
+    Returns path to cached audio file (mp3/opus) for given TTS params, generating it if needed.
     """
-    filename = _build_tts_cache_filename(text, language, voice, sample_rate)
-    filepath = AUDIO_CACHE_DIR / filename
+    filename = _build_tts_cache_filename(text, language, voice, sample_rate, audio_format)
 
-    if filepath.exists():
-        return filepath
+    cached = TTS_CACHE.lookup(filename)
+    if cached is not None:
+        return cached
+
+    # одновременные промахи по одному ключу ждут один синтез
+    return _TTS_SINGLE_FLIGHT.do(
+        filename,
+        lambda: _synthesize_into_cache(filename, text, language, voice, audio_format),
+    )
+
+
+def _synthesize_into_cache(
+    filename: str,
+    text: str,
+    language: Optional[str],
+    voice: Optional[str],
+    audio_format: Optional[str],
+) -> Path:
+    # пока мы ждали, предыдущий "лидер" мог уже положить файл
+    cached = TTS_CACHE.peek(filename)
+    if cached is not None:
+        return cached
 
     model_path = _piper_model_path_for_language(language or "en")
     logger.info(
@@ -226,9 +878,16 @@ def _ensure_cached_tts_file(
         model_path,
         len(text),
     )
-    audio_bytes = synthesize_with_piper(text, language or "en", voice=voice)
-    filepath.write_bytes(audio_bytes)
-    return filepath
+    audio_bytes = synthesize_with_piper(
+        text,
+        language or "en",
+        voice=voice,
+        audio_format=audio_format,
+    )
+    return TTS_CACHE.put(filename, audio_bytes, normalize_lang_code(language or "en"))
+
+
+_TTS_SINGLE_FLIGHT = _SingleFlight()
 
 
 def _build_audio_url(filename: str) -> str:
@@ -242,6 +901,47 @@ def _build_audio_url(filename: str) -> str:
 WHISPER_BIN = "/workspace/langapp/whisper.cpp/build/bin/whisper-cli"
 WHISPER_MODEL = "/workspace/langapp/whisper.cpp/models/ggml-base.bin"
 
+# Постоянный режим: держим модель в памяти в whisper-server процессах
+WHISPER_SERVER_BIN = os.getenv(
+    "WHISPER_SERVER_BIN", "/workspace/langapp/whisper.cpp/build/bin/whisper-server"
+)
+WHISPER_SERVER_WORKERS = max(0, int(os.getenv("WHISPER_SERVER_WORKERS", "1")))
+WHISPER_SERVER_HOST = os.getenv("WHISPER_SERVER_HOST", "127.0.0.1")
+WHISPER_SERVER_BASE_PORT = int(os.getenv("WHISPER_SERVER_BASE_PORT", "8178"))
+WHISPER_SERVER_THREADS = int(os.getenv("WHISPER_SERVER_THREADS", "4"))
+# Уже запущенные внешние серверы (через запятую) — тогда свои процессы не поднимаем
+WHISPER_SERVER_URLS = [
+    u.strip().rstrip("/") for u in os.getenv("WHISPER_SERVER_URLS", "").split(",") if u.strip()
+]
+# --convert: whisper-server сам гоняет ffmpeg через временные файлы. Обычно мы присылаем
+# готовый 16 кГц WAV, но если декодирование не удалось (_normalize_stt_audio -> None),
+# уходит исходный m4a/webm — без --convert сервер его не прочитает
+WHISPER_SERVER_CONVERT = os.getenv("WHISPER_SERVER_CONVERT", "1") == "1"
+WHISPER_QUEUE_MAX = int(os.getenv("WHISPER_QUEUE_MAX", "32"))
+WHISPER_TIMEOUT = float(os.getenv("WHISPER_TIMEOUT", "60"))
+WHISPER_STARTUP_TIMEOUT = float(os.getenv("WHISPER_STARTUP_TIMEOUT", "120"))
+
+# Потоковое распознавание (/ws/stt): клиент шлёт сырой PCM s16le mono
+STT_STREAM_SAMPLE_RATE = int(os.getenv("STT_STREAM_SAMPLE_RATE", "16000"))
+STT_STREAM_STEP_S = float(os.getenv("STT_STREAM_STEP_S", "1.0"))      # как часто считаем partial
+STT_STREAM_WINDOW_S = float(os.getenv("STT_STREAM_WINDOW_S", "12"))   # скользящее окно декодирования
+STT_STREAM_MAX_S = float(os.getenv("STT_STREAM_MAX_S", "120"))        # максимум аудио за сессию
+
+# Нормализация загрузок перед распознаванием: 16 кГц mono PCM + обрезка тишины по краям
+STT_SAMPLE_RATE = 16000
+STT_VAD_ENABLED = os.getenv("STT_VAD_ENABLED", "1") == "1"
+STT_VAD_RMS_MIN = int(os.getenv("STT_VAD_RMS_MIN", "200"))   # порог "речи" в единицах s16
+STT_VAD_PAD_MS = int(os.getenv("STT_VAD_PAD_MS", "200"))     # запас вокруг речи
+# адаптивный порог не выше этой доли от уровня речи (90-й перцентиль кадров),
+# иначе тихую речь на шумной записи срежет как тишину
+STT_VAD_MAX_SPEECH_RATIO = float(os.getenv("STT_VAD_MAX_SPEECH_RATIO", "0.3"))
+
+try:
+    # ускоряет VAD на длинных записях; без него — чистый Python
+    import numpy as np
+except Exception:
+    np = None
+
 try:
     # Используем OpenAI только для STT, если он установлен и настроен
     from openai import OpenAI
@@ -252,11 +952,19 @@ except Exception:
 # These settings let us move the service without changing code.
 AUDIO_CACHE_DIR = Path(os.getenv("AUDIO_CACHE_DIR", "/workspace/langapp/audio_cache"))
 AUDIO_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+AUDIO_CACHE_INDEX_PATH = Path(
+    os.getenv("AUDIO_CACHE_INDEX_PATH", str(AUDIO_CACHE_DIR / ".index.sqlite3"))
+)
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+AUDIO_CACHE_RAM_BYTES = int(os.getenv("AUDIO_CACHE_RAM_BYTES", str(64 * 1024 ** 2)))
+AUDIO_CACHE_POLICY = os.getenv("AUDIO_CACHE_POLICY", "lru").strip().lower()  # lru / lfu
 AUDIO_BASE_URL = os.getenv("AUDIO_BASE_URL", "https://api.languagetutorapp.org").rstrip("/")
 
 FFMPEG_BIN = os.getenv("FFMPEG_BIN", "/workspace/langapp/tools/ffmpeg/ffmpeg")
 
 COURSES_V2_DIR = Path(os.getenv("COURSES_V2_DIR", "/workspace/langapp/courses_v2"))
+# Как часто перепроверять mtime уроков в каталоге (0 — только при старте)
+COURSES_CATALOG_POLL_S = float(os.getenv("COURSES_CATALOG_POLL_S", "30"))
 
 SKILL_META = {
     "listening": {"title": "Listening", "description": "Train comprehension through audio-first tasks."},
@@ -294,8 +1002,81 @@ LLM_MODEL = os.getenv("LLM_MODEL", "llama3.1:8b")
 LLM_CHAT_COMPLETIONS_URL = LLM_BASE_URL + "/api/chat"
 
 LLM_API_KEY = os.getenv("LLM_API_KEY")
+
+# Персистентные кэши ответов LLM (уроки, проверки, переводы...)
+CACHE_DB_PATH = Path(os.getenv("CACHE_DB_PATH", "/workspace/langapp/response_cache.sqlite3"))
+CACHE_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+LESSON_CACHE_TTL_S = float(os.getenv("LESSON_CACHE_TTL_S", str(30 * 24 * 3600)))
+LESSON_CACHE_MAX_ENTRIES = int(os.getenv("LESSON_CACHE_MAX_ENTRIES", "20000"))
+COURSE_PLAN_CACHE_TTL_S = float(os.getenv("COURSE_PLAN_CACHE_TTL_S", str(14 * 24 * 3600)))
+COURSE_PLAN_CACHE_MAX_ENTRIES = int(os.getenv("COURSE_PLAN_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_TTL_S = float(os.getenv("ANSWER_CACHE_TTL_S", str(90 * 24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "200000"))
+# Двуязычный словарь для /translate-word: .json {"en": {"word": "перевод" | {...}}} или .tsv
+# (lang<TAB>word<TAB>translation[<TAB>example<TAB>example_translation])
+TRANSLATION_LEXICON_PATH = os.getenv("TRANSLATION_LEXICON_PATH", "")
+
+# Фоновая пре-генерация уроков по плану курса
+PREGEN_LESSONS_PER_LEVEL = int(os.getenv("PREGEN_LESSONS_PER_LEVEL", "3"))
+PREGEN_ON_COURSE_PLAN = os.getenv("PREGEN_ON_COURSE_PLAN", "1") == "1"
+PREGEN_JOBS_KEEP = int(os.getenv("PREGEN_JOBS_KEEP", "500"))
+
+# Пул заранее сгенерированных ситуаций для /generate_situation
+SITUATION_POOL_SIZE = int(os.getenv("SITUATION_POOL_SIZE", "3"))          # K на корзину, 0 — выключено
+SITUATION_POOL_MAX_BUCKETS = int(os.getenv("SITUATION_POOL_MAX_BUCKETS", "500"))
 LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
 
+# Серверные сессии чата (история + готовый системный промпт)
+CHAT_SESSION_TTL_S = float(os.getenv("CHAT_SESSION_TTL_S", str(6 * 3600)))
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "20000"))              # для in-memory бэкенда
+CHAT_SESSION_MAX_MESSAGES = int(os.getenv("CHAT_SESSION_MAX_MESSAGES", "60"))
+CHAT_SESSION_REDIS_URL = os.getenv("CHAT_SESSION_REDIS_URL", "")            # redis://... — общий стор
+# Сколько последних сообщений уходит в LLM
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "5"))
+# Скользящее резюме длинных сессий: раз в N ходов старые сообщения сворачиваются
+# в короткую «память», которая подставляется вместо них (0 — выключено)
+CHAT_SUMMARY_EVERY_TURNS = int(os.getenv("CHAT_SUMMARY_EVERY_TURNS", "6"))
+CHAT_SUMMARY_MAX_CHARS = int(os.getenv("CHAT_SUMMARY_MAX_CHARS", "1200"))
+
+# Резидентность модели и KV-кэш ollama:
+# keep_alive "-1" — держать модель в памяти всегда (по умолчанию ollama выгружает через 5 мин)
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "-1")
+# num_ctx должен быть одинаковым у всех запросов: другое значение = перезагрузка модели и сброс кэша
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "8192"))
+# При старте загрузить модель и прогнать большие системные промпты, чтобы их префикс был в кэше
+LLM_WARMUP = os.getenv("LLM_WARMUP", "1") == "1"
+
+# Сколько генераций одновременно реально тянет ollama (OLLAMA_NUM_PARALLEL);
+# остальные запросы ждут в очереди, не занимая потоки
+LLM_MAX_CONCURRENCY = max(1, int(os.getenv("LLM_MAX_CONCURRENCY", "2")))
+LLM_MAX_CONNECTIONS = max(LLM_MAX_CONCURRENCY, int(os.getenv("LLM_MAX_CONNECTIONS", "16")))
+# Общий бюджет фоновых генераций (пре-генерация уроков, пул ситуаций, резюме чата):
+# хотя бы один слот LLM всегда остаётся живым запросам; при LLM_MAX_CONCURRENCY=1
+# бюджет 0 — фоновые генерации выключены
+LLM_BACKGROUND_CONCURRENCY = max(
+    0,
+    min(
+        int(os.getenv("LLM_BACKGROUND_CONCURRENCY", os.getenv("PREGEN_CONCURRENCY", str(LLM_MAX_CONCURRENCY - 1)))),
+        LLM_MAX_CONCURRENCY - 1,
+    ),
+)
+
+# Таймауты по эндпоинтам (ожидание в очереди + генерация), LLM_TIMEOUT_<ИМЯ>
+LLM_TIMEOUTS: Dict[str, float] = {
+    name: float(os.getenv(f"LLM_TIMEOUT_{name.upper()}", str(default)))
+    for name, default in {
+        "chat": LLM_TIMEOUT,
+        "situation": LLM_TIMEOUT,
+        "translate": LLM_TIMEOUT,
+        "course_plan": max(LLM_TIMEOUT, 120),
+        "lesson": max(LLM_TIMEOUT, 120),
+        "check_answer": LLM_TIMEOUT,
+        "check_answers_batch": max(LLM_TIMEOUT, 120),
+        "chat_summary": LLM_TIMEOUT,
+        "translate_batch": max(LLM_TIMEOUT, 120),
+    }.items()
+}
+
 
 
 # Env guide:
@@ -528,6 +1309,47 @@ Before producing output, internally verify:
 ✓ No forbidden text outside JSON
 """
 
+ANSWER_CHECK_SYSTEM_PROMPT = """
+You are a strict but friendly language teacher grading ONE exercise answer in a language-learning app.
+
+INPUT (JSON in the user message):
+- exercise_type, question, user_answer
+- correct_answer / accepted_answers: reference answers (may be empty for open tasks)
+- sample_answer, evaluation_criteria: for open_answer tasks
+- language: the language being learned
+
+RULES:
+- Judge meaning and grammar, not exact wording: a different but correct translation or phrasing IS correct.
+- Ignore capitalization and punctuation unless they change the meaning.
+- For open_answer, grade against evaluation_criteria; sample_answer is only an example.
+- score: 0–100. is_correct = true when the answer is acceptable for the learner's level (score >= 70).
+- feedback: 1–2 short sentences in Russian. If the answer is wrong, show the corrected version and the key mistake.
+
+Output STRICT JSON only:
+{"is_correct": true, "score": 0, "feedback": "..."}
+"""
+
+ANSWER_CHECK_BATCH_SYSTEM_PROMPT = """
+You are a strict but friendly language teacher grading SEVERAL exercise answers from one lesson in a language-learning app.
+
+INPUT (JSON in the user message): {"language": ..., "items": [...]}
+- language: the language being learned
+- every item has an "id" and: exercise_type, question, user_answer,
+  correct_answer / accepted_answers (reference answers, may be empty for open tasks),
+  sample_answer, evaluation_criteria (for open_answer tasks)
+
+RULES:
+- Grade EVERY item independently; do not skip any id and do not let one item influence another.
+- Judge meaning and grammar, not exact wording: a different but correct translation or phrasing IS correct.
+- Ignore capitalization and punctuation unless they change the meaning.
+- For open_answer, grade against evaluation_criteria; sample_answer is only an example.
+- score: 0–100. is_correct = true when the answer is acceptable for the learner's level (score >= 70).
+- feedback: 1–2 short sentences in Russian. If the answer is wrong, show the corrected version and the key mistake.
+
+Output STRICT JSON only:
+{"results": [{"id": "...", "is_correct": true, "score": 0, "feedback": "..."}]}
+"""
+
 
 app = FastAPI()
 
@@ -540,8 +1362,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Раздаём сгенерированные аудиофайлы
-app.mount("/audio", StaticFiles(directory=AUDIO_CACHE_DIR), name="audio")
+# Сгенерированные аудиофайлы раздаём через TTS_CACHE (см. /audio/{filename}),
+# чтобы учитывать обращения и отдавать горячие клипы из RAM
+TTS_CACHE = TTSAudioCache(
+    AUDIO_CACHE_DIR,
+    AUDIO_CACHE_INDEX_PATH,
+    max_bytes=AUDIO_CACHE_MAX_BYTES,
+    ram_bytes=AUDIO_CACHE_RAM_BYTES,
+    policy=AUDIO_CACHE_POLICY,
+)
 
 # ---------- Модели запросов/ответов ----------
 
@@ -577,6 +1406,11 @@ class ChatRequest(BaseModel):
     messages: List[ChatMessage]
     character: Optional[str] = None
     situation: Optional[SituationContext] = None
+    with_audio: Optional[bool] = False      # озвучить ответ (в /chat/stream — по предложениям)
+    audio_format: Optional[Literal["mp3", "opus"]] = None
+    # Серверная сессия: "new" — начать; с известным id в messages шлём только новые сообщения,
+    # язык/персонаж/ситуация берутся из сессии (сменить — начать новую)
+    session_id: Optional[str] = None
 
 class LegacyChatRequest(BaseModel):
     # Старый формат, который посылает Flutter
@@ -591,6 +1425,7 @@ class ChatResponse(BaseModel):
     corrections_text: str
     partner_name: str
     audio_url: Optional[str] = None
+    session_id: Optional[str] = None
 
 
 class TTSRequest(BaseModel):
@@ -612,6 +1447,7 @@ class TranslateRequest(BaseModel):
     word: str
     language: Optional[str] = "English"
     with_audio: Optional[bool] = False
+    audio_format: Optional[Literal["mp3", "opus"]] = None  # по умолчанию TTS_AUDIO_FORMAT
 
 
 class TranslateResponse(BaseModel):
@@ -646,6 +1482,10 @@ class Lesson(BaseModel):
         default="",
         description="Краткая строка о том, какой опыт/XP даст урок.",
     )
+    matches_goals: bool = Field(
+        default=False,
+        description="Урок пересекается с целями ученика (подсветка в плане, порядок не меняется).",
+    )
 
 
 class CourseLevel(BaseModel):
@@ -674,6 +1514,8 @@ class LessonRequest(BaseModel):
     grammar_topics: Optional[List[str]] = None
     vocab_topics: Optional[List[str]] = None
     interests: Optional[List[str]] = None
+    skill: Optional[str] = None       # фокус урока из SKILL_ORDER (для корпуса courses_v2)
+    regenerate: bool = False          # True — не брать из кэша, сгенерировать заново
 
 
 class LessonExercise(BaseModel):
@@ -711,6 +1553,7 @@ class LessonExercise(BaseModel):
 
     # Для translate_sentence / fill_in_blank
     correct_answer: Optional[str] = None   # правильный ответ / правильный перевод
+    accepted_answers: Optional[List[str]] = None  # другие допустимые варианты
 
     # Для fill_in_blank
     sentence_with_gap: Optional[str] = None  # строка с пропуском, например: "I ____ to school yesterday."
@@ -742,93 +1585,533 @@ def _llm_headers() -> Dict[str, str]:
     return headers
 
 
-LLM_HTTP = httpx.Client(
+LLM_HTTP = httpx.AsyncClient(
     timeout=LLM_TIMEOUT,
     trust_env=False,  # игнорируем proxy из окружения, чтобы не тормозить localhost
     headers=_llm_headers(),
+    limits=httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONCURRENCY,
+    ),
 )
 
-@app.on_event("shutdown")
-async def _shutdown():
-    try:
-        LLM_HTTP.close()
-    except Exception:
-        pass
+# Ограничитель параллельных генераций + метрики очереди
+LLM_SEMAPHORE = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+# Фоновые задачи берут его до LLM-слота, поэтому вместе занимают не больше LLM_BACKGROUND_CONCURRENCY
+LLM_BACKGROUND_SEMAPHORE = asyncio.Semaphore(max(1, LLM_BACKGROUND_CONCURRENCY))
+LLM_STATS: Dict[str, float] = {
+    "requests": 0,
+    "errors": 0,
+    "timeouts": 0,
+    "waiting": 0,
+    "max_waiting": 0,
+    "in_flight": 0,
+    "wait_ms_total": 0.0,
+    "llm_ms_total": 0.0,
+}
 
 
-def _parse_json_content(content: str) -> Dict:
-    """Пытаемся извлечь JSON даже если модель обернула его в текст/markdown."""
-    if not content:
-        return {}
-    content = content.strip()
-    try:
-        return json.loads(content)
-    except Exception:
-        pass
+# Разбивка времени ollama по эндпоинтам: prefill (prompt_eval) отдельно от decode (eval)
+LLM_TIMING: Dict[str, Dict[str, float]] = {}
+
 
+def _llm_keep_alive() -> Any:
+    # ollama принимает и длительность ("30m"), и число секунд (-1 — навсегда)
     try:
-        start = content.find("{")
-        end = content.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            return json.loads(content[start : end + 1])
-    except Exception:
-        pass
+        return int(LLM_KEEP_ALIVE)
+    except ValueError:
+        return LLM_KEEP_ALIVE
 
-    return {}
+
+def _llm_payload(messages: List[Dict[str, str]], temperature: float, stream: bool) -> Dict[str, Any]:
+    options: Dict[str, Any] = {"temperature": temperature}
+    if LLM_NUM_CTX > 0:
+        options["num_ctx"] = LLM_NUM_CTX
+    return {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "stream": stream,
+        "keep_alive": _llm_keep_alive(),
+        "options": options,
+    }
 
 
-def _parse_textual_reply(content: str) -> Dict[str, str]:
+def _record_llm_timing(endpoint: str, data: Dict[str, Any]) -> None:
+    """Счётчики из финального ответа ollama (длительности в наносекундах)."""
+    if "prompt_eval_count" not in data and "eval_count" not in data:
+        return
+    t = LLM_TIMING.setdefault(
+        endpoint,
+        {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "prefill_ms": 0.0,
+            "output_tokens": 0,
+            "decode_ms": 0.0,
+            "load_ms": 0.0,
+            "cold_loads": 0,
+        },
+    )
+    t["calls"] += 1
+    t["prompt_tokens"] += int(data.get("prompt_eval_count") or 0)
+    t["prefill_ms"] += (data.get("prompt_eval_duration") or 0) / 1e6
+    t["output_tokens"] += int(data.get("eval_count") or 0)
+    t["decode_ms"] += (data.get("eval_duration") or 0) / 1e6
+    load_ms = (data.get("load_duration") or 0) / 1e6
+    t["load_ms"] += load_ms
+    if load_ms > 1000:
+        t["cold_loads"] += 1
+
+
+def _llm_timing_snapshot() -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for endpoint, t in LLM_TIMING.items():
+        calls = t["calls"] or 1
+        out[endpoint] = {
+            **{k: round(v, 1) if isinstance(v, float) else v for k, v in t.items()},
+            # prompt_tokens — только НЕ закэшированная часть промпта: ollama не считает
+            # токены, взятые из KV-кэша, так что падение этого числа = попадание в кэш
+            "prompt_tokens_avg": round(t["prompt_tokens"] / calls, 1),
+            "prefill_ms_avg": round(t["prefill_ms"] / calls, 1),
+            "decode_ms_avg": round(t["decode_ms"] / calls, 1),
+            "decode_tok_s": round(t["output_tokens"] / (t["decode_ms"] / 1000), 1) if t["decode_ms"] else 0.0,
+        }
+    return out
+
+
+def _llm_stats_snapshot() -> Dict[str, Any]:
+    stats = dict(LLM_STATS)
+    done = stats["requests"] or 1
+    stats["wait_ms_avg"] = round(stats["wait_ms_total"] / done, 1)
+    stats["llm_ms_avg"] = round(stats["llm_ms_total"] / done, 1)
+    stats["max_concurrency"] = LLM_MAX_CONCURRENCY
+    stats["background_concurrency"] = LLM_BACKGROUND_CONCURRENCY
+    stats["timeouts_by_endpoint"] = LLM_TIMEOUTS
+    stats["keep_alive"] = LLM_KEEP_ALIVE
+    stats["num_ctx"] = LLM_NUM_CTX
+    stats["timing"] = _llm_timing_snapshot()
+    return stats
+
+
+# ---------- Кэши ответов LLM (SQLite) ----------
+
+
+class SqliteResponseCache:
     """
-    Если модель вернула текст вида "reply: ... corrections_text: ...",
-    пытаемся выдрать поля из строки. Возвращает {"reply": ..., "corrections_text": ...}.
+    Персистентный кэш JSON-ответов: key -> value, с TTL и лимитом записей
+    (вытесняем давно не использованные). Одна таблица на вид ответов,
+    все таблицы живут в CACHE_DB_PATH и переживают рестарт.
+
+    Методы синхронные (SQLite); из async-кода зовём aget/aput/acontains —
+    они уходят в поток и не блокируют event loop.
     """
-    reply = ""
-    corrections = ""
-    if not content:
-        return {"reply": reply, "corrections_text": corrections}
 
-    lower = content.lower()
-    reply_idx = lower.find("reply:")
-    corr_idx = lower.find("corrections_text:")
+    FLUSH_EVERY = 100  # как в TTSAudioCache: попадания копим и пишем в SQLite пачкой
+
+    def __init__(self, table: str, ttl_s: float, max_entries: int):
+        self.table = table
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "writes": 0}
+        self._touched: Dict[str, tuple[float, int]] = {}  # key -> (last_access, новых попаданий)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(CACHE_DB_PATH), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    created_at REAL,
+                    last_access REAL,
+                    hits INTEGER
+                )
+                """
+            )
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)")
+        self._count = self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            if self.ttl_s > 0 and now - row[1] > self.ttl_s:
+                with self._db:
+                    self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self._count -= 1
+                self.counters["expired"] += 1
+                self.counters["misses"] += 1
+                return None
+            _, pending = self._touched.get(key, (now, 0))
+            self._touched[key] = (now, pending + 1)
+            if len(self._touched) >= self.FLUSH_EVERY:
+                self._flush_touches_locked()
+            self.counters["hits"] += 1
+        return json.loads(row[0])
+
+    def _flush_touches_locked(self) -> None:
+        if not self._touched:
+            return
+        with self._db:
+            self._db.executemany(
+                f"UPDATE {self.table} SET last_access = ?, hits = hits + ? WHERE key = ?",
+                [(ts, n, key) for key, (ts, n) in self._touched.items()],
+            )
+        self._touched.clear()
+
+    def put(self, key: str, value: Any) -> None:
+        now = time.time()
+        raw = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            with self._db:
+                cur = self._db.execute(
+                    f"UPDATE {self.table} SET value = ?, created_at = ?, last_access = ? WHERE key = ?",
+                    (raw, now, now, key),
+                )
+                if cur.rowcount == 0:
+                    self._db.execute(
+                        f"INSERT INTO {self.table} (key, value, created_at, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+                        (key, raw, now, now),
+                    )
+                    self._count += 1
+            self.counters["writes"] += 1
+            if self._count > self.max_entries:
+                # вытесняем по last_access — сначала досохраняем накопленные попадания
+                self._flush_touches_locked()
+                # чистим с запасом до 90% лимита
+                excess = self._count - int(self.max_entries * 0.9)
+                with self._db:
+                    self._db.execute(
+                        f"DELETE FROM {self.table} WHERE key IN "
+                        f"(SELECT key FROM {self.table} ORDER BY last_access LIMIT ?)",
+                        (excess,),
+                    )
+                self._count -= excess
+                self.counters["evictions"] += excess
+
+    def contains(self, key: str) -> bool:
+        """Есть ли свежая запись (без учёта в hit/miss и без обновления last_access)."""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None and (self.ttl_s <= 0 or time.time() - row[0] <= self.ttl_s)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aget_or_miss(self, key: str) -> Optional[Any]:
+        """Как aget, но сломанный/заблокированный кэш — просто промах, а не 500."""
+        try:
+            return await self.aget(key)
+        except Exception as e:
+            logger.warning("[CACHE] %s read failed, treating as miss: %s", self.table, e)
+            return None
+
+    async def aput(self, key: str, value: Any) -> None:
+        await asyncio.to_thread(self.put, key, value)
+
+    async def acontains(self, key: str) -> bool:
+        return await asyncio.to_thread(self.contains, key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": round(self.counters["hits"] / lookups, 3) if lookups else 0.0,
+                "entries": self._count,
+                "max_entries": self.max_entries,
+            }
 
-    def _trim(val: str) -> str:
-        return val.strip(" \n\r\t.:")
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touches_locked()
+            self._db.close()
 
-    if reply_idx != -1 and corr_idx != -1:
-        if reply_idx < corr_idx:
-            reply = _trim(content[reply_idx + len("reply:") : corr_idx])
-            corrections = _trim(content[corr_idx + len("corrections_text:") :])
+
+class _AsyncSingleFlight:
+    """
+    asyncio-версия _SingleFlight: одинаковые ключи ждут одну корутину.
+    Работа идёт в отдельной задаче, так что отвалившийся первый клиент
+    не отменяет её для остальных.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, factory):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _t, k=key: self._tasks.pop(k, None))
         else:
-            corrections = _trim(content[corr_idx + len("corrections_text:") : reply_idx])
-            reply = _trim(content[reply_idx + len("reply:") :])
-    elif reply_idx != -1:
-        reply = _trim(content[reply_idx + len("reply:") :])
-    elif corr_idx != -1:
-        corrections = _trim(content[corr_idx + len("corrections_text:") :])
-    else:
-        reply = content.strip()
+            self.coalesced += 1
+        return await asyncio.shield(task)
 
-    return {
-        "reply": reply,
-        "corrections_text": corrections,
-    }
+    def in_flight(self) -> int:
+        return len(self._tasks)
 
 
-def _build_chat_request_from_payload(payload: dict) -> ChatRequest:
-    if "messages" in payload:
-        return ChatRequest(**payload)
+def _normalize_topics(topics: Optional[List[str]]) -> List[str]:
+    return sorted({" ".join(str(t).split()).casefold() for t in topics or [] if str(t).strip()})
 
-    if "message" in payload:
-        student_text = payload.get("message", "")
-        if not student_text:
-            raise HTTPException(status_code=422, detail="Empty 'message'")
 
-        return ChatRequest(
-            messages=[ChatMessage(role="user", content=student_text)],
-            language=payload.get("language", "English"),
-            level=payload.get("level", "B1"),
-            character=payload.get("character", "Michael"),
+def _lesson_cache_key(req: LessonRequest) -> str:
+    """
+    Канонический ключ урока: язык через normalize_lang_code, уровень, название
+    и отсортированные темы без учёта регистра/пробелов. interests в ключ не входят —
+    иначе ученики с общим планом курса никогда не попадали бы в кэш.
+    """
+    canonical = {
+        "language": normalize_lang_code(req.language),
+        "level": (req.level_hint or "").strip().upper(),
+        "title": " ".join(req.lesson_title.split()).casefold(),
+        "grammar": _normalize_topics(req.grammar_topics),
+        "vocab": _normalize_topics(req.vocab_topics),
+    }
+    if req.skill:
+        canonical["skill"] = _normalize_lesson_skill(req.skill)
+    raw = json.dumps(canonical, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+_CEFR_RE = re.compile(r"\b([ABC][12])\b")
+_LEVEL_WORDS = (
+    ("upper-intermediate", "B2"),
+    ("upper intermediate", "B2"),
+    ("pre-intermediate", "A2"),
+    ("pre intermediate", "A2"),
+    ("intermediate", "B1"),
+    ("elementary", "A2"),
+    ("beginner", "A1"),
+    ("advanced", "C1"),
+)
+_AGE_BANDS = ((12, "child"), (17, "teen"), (25, "18-25"), (40, "26-40"), (60, "41-60"))
+
+
+def _cefr_bucket(level_hint: Optional[str]) -> str:
+    """'a2', 'A2+', 'beginner' -> CEFR-код; всё непонятное -> ''."""
+    text = (level_hint or "").strip()
+    m = _CEFR_RE.search(text.upper())
+    if m:
+        return m.group(1)
+    low = text.lower()
+    for word, code in _LEVEL_WORDS:
+        if word in low:
+            return code
+    return ""
+
+
+def _age_band(age: Optional[int]) -> str:
+    if age is None or age <= 0:
+        return ""
+    for upper, band in _AGE_BANDS:
+        if age <= upper:
+            return band
+    return "60+"
+
+
+def _course_plan_cache_key(prefs: CoursePreferences) -> str:
+    """
+    Ключ плана курса по «корзине» предпочтений: язык, CEFR-уровень, набор интересов
+    и возрастная группа. goals/gender в ключ не входят — это свободный текст,
+    который почти никогда не совпадает дословно.
+    """
+    canonical = {
+        "language": normalize_lang_code(prefs.language),
+        "level": _cefr_bucket(prefs.level_hint),
+        "interests": _normalize_topics(prefs.interests),
+        "age_band": _age_band(prefs.age),
+    }
+    raw = json.dumps(canonical, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+LESSON_CACHE = SqliteResponseCache(
+    "generated_lessons",
+    ttl_s=LESSON_CACHE_TTL_S,
+    max_entries=LESSON_CACHE_MAX_ENTRIES,
+)
+_LESSON_SINGLE_FLIGHT = _AsyncSingleFlight()
+
+COURSE_PLAN_CACHE = SqliteResponseCache(
+    "course_plans",
+    ttl_s=COURSE_PLAN_CACHE_TTL_S,
+    max_entries=COURSE_PLAN_CACHE_MAX_ENTRIES,
+)
+_COURSE_PLAN_SINGLE_FLIGHT = _AsyncSingleFlight()
+
+
+# Фоновые задачи, которые живут всё время работы сервиса (гасим на shutdown)
+_BACKGROUND_TASKS: List[asyncio.Task] = []
+
+
+async def _warmup_llm() -> None:
+    """
+    Загружает модель с нашим keep_alive/num_ctx и прогоняет большие системные
+    промпты (num_predict=1), чтобы первые живые запросы не платили за загрузку и prefill.
+    """
+    try:
+        resp = await LLM_HTTP.post(
+            LLM_CHAT_COMPLETIONS_URL,
+            json=_llm_payload([], 0.0, stream=False),   # пустые messages — только загрузка модели
+            timeout=max(LLM_TIMEOUT, 300),
+        )
+        resp.raise_for_status()
+        logger.info("[LLM] model %s loaded, keep_alive=%s", LLM_MODEL, LLM_KEEP_ALIVE)
+    except Exception as e:
+        logger.warning("[LLM] warmup load failed: %s", e)
+        return
+
+    for name, prompt in (
+        ("chat", CHAT_RULES_PROMPT),
+        ("lesson", LESSON_SYSTEM_PROMPT),
+        ("course_plan", COURSE_PLAN_SYSTEM_PROMPT),
+        ("check_answer", ANSWER_CHECK_SYSTEM_PROMPT),
+    ):
+        payload = _llm_payload([{"role": "system", "content": prompt}], 0.0, stream=False)
+        payload["options"]["num_predict"] = 1
+        try:
+            async with _llm_slot():
+                resp = await LLM_HTTP.post(LLM_CHAT_COMPLETIONS_URL, json=payload, timeout=max(LLM_TIMEOUT, 120))
+            resp.raise_for_status()
+            _record_llm_timing(f"warmup_{name}", resp.json())
+        except Exception as e:
+            logger.warning("[LLM] warmup of %s prompt failed: %s", name, e)
+
+
+@app.on_event("startup")
+async def _startup():
+    if PIPER_PRELOAD_LANGS and os.path.exists(PIPER_BIN):
+        await asyncio.to_thread(PIPER_ENGINE.warmup, PIPER_PRELOAD_LANGS)
+    await WHISPER_POOL.start()
+    await asyncio.to_thread(COURSE_CATALOG.refresh)
+    await asyncio.to_thread(TRANSLATION_STORE.load)
+    if COURSES_CATALOG_POLL_S > 0:
+        _BACKGROUND_TASKS.append(asyncio.create_task(_poll_course_catalog()))
+    if LLM_WARMUP:
+        _BACKGROUND_TASKS.append(asyncio.create_task(_warmup_llm()))
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    for task in [*_BACKGROUND_TASKS, *_PREGEN_TASKS.values(), *_CHAT_SUMMARY_TASKS.values()]:
+        task.cancel()
+    _BACKGROUND_TASKS.clear()
+    SITUATION_POOL.close()
+    try:
+        await LLM_HTTP.aclose()
+    except Exception:
+        pass
+    try:
+        PIPER_ENGINE.close()
+    except Exception:
+        pass
+    try:
+        TTS_CACHE.close()
+    except Exception:
+        pass
+    try:
+        await WHISPER_POOL.close()
+    except Exception:
+        pass
+    try:
+        await CHAT_SESSIONS.close()
+    except Exception:
+        pass
+    for cache in (LESSON_CACHE, COURSE_PLAN_CACHE, ANSWER_CACHE, TRANSLATION_STORE):
+        try:
+            cache.close()
+        except Exception:
+            pass
+
+
+def _parse_json_content(content: str) -> Dict:
+    """Пытаемся извлечь JSON даже если модель обернула его в текст/markdown."""
+    if not content:
+        return {}
+    content = content.strip()
+    try:
+        return json.loads(content)
+    except Exception:
+        pass
+
+    try:
+        start = content.find("{")
+        end = content.rfind("}")
+        if start != -1 and end != -1 and end > start:
+            return json.loads(content[start : end + 1])
+    except Exception:
+        pass
+
+    return {}
+
+
+def _parse_textual_reply(content: str) -> Dict[str, str]:
+    """
+    Если модель вернула текст вида "reply: ... corrections_text: ...",
+    пытаемся выдрать поля из строки. Возвращает {"reply": ..., "corrections_text": ...}.
+    """
+    reply = ""
+    corrections = ""
+    if not content:
+        return {"reply": reply, "corrections_text": corrections}
+
+    lower = content.lower()
+    reply_idx = lower.find("reply:")
+    corr_idx = lower.find("corrections_text:")
+
+    def _trim(val: str) -> str:
+        return val.strip(" \n\r\t.:")
+
+    if reply_idx != -1 and corr_idx != -1:
+        if reply_idx < corr_idx:
+            reply = _trim(content[reply_idx + len("reply:") : corr_idx])
+            corrections = _trim(content[corr_idx + len("corrections_text:") :])
+        else:
+            corrections = _trim(content[corr_idx + len("corrections_text:") : reply_idx])
+            reply = _trim(content[reply_idx + len("reply:") :])
+    elif reply_idx != -1:
+        reply = _trim(content[reply_idx + len("reply:") :])
+    elif corr_idx != -1:
+        corrections = _trim(content[corr_idx + len("corrections_text:") :])
+    else:
+        reply = content.strip()
+
+    return {
+        "reply": reply,
+        "corrections_text": corrections,
+    }
+
+
+def _build_chat_request_from_payload(payload: dict) -> ChatRequest:
+    if "messages" in payload:
+        return ChatRequest(**payload)
+
+    if "message" in payload:
+        student_text = payload.get("message", "")
+        if not student_text:
+            raise HTTPException(status_code=422, detail="Empty 'message'")
+
+        return ChatRequest(
+            messages=[ChatMessage(role="user", content=student_text)],
+            language=payload.get("language", "English"),
+            level=payload.get("level", "B1"),
+            character=payload.get("character", "Michael"),
             topic=payload.get("topic", "general"),
+            session_id=payload.get("session_id"),
+            with_audio=bool(payload.get("with_audio", False)),
+            audio_format=payload.get("audio_format"),
         )
 
     if "student_message" in payload:
@@ -851,62 +2134,417 @@ def _build_chat_request_from_payload(payload: dict) -> ChatRequest:
     )
 
 
-def _prepare_chat_messages(
-    req: ChatRequest,
-) -> tuple[str, List[Dict[str, str]], bool, bool]:
-    partner_name = (req.character or "").strip() or get_partner_name(
-        req.language,
-        req.partner_gender or "female",
+# ---------- Серверные сессии чата ----------
+
+try:
+    import redis.asyncio as redis_async
+    from redis.exceptions import WatchError as RedisWatchError
+except Exception:
+    redis_async = None
+    RedisWatchError = None
+
+
+class _MemorySessionBackend:
+    """Сессии в памяти процесса: LRU + скользящий TTL."""
+
+    name = "memory"
+
+    def __init__(self, ttl_s: float, max_sessions: int):
+        self.ttl_s = ttl_s
+        self.max_sessions = max_sessions
+        self._data: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        item = self._data.get(session_id)
+        if item is None:
+            return None
+        if item[0] < time.time():
+            self._data.pop(session_id, None)
+            return None
+        self._data.move_to_end(session_id)
+        return copy.deepcopy(item[1])
+
+    async def save(self, session_id: str, session: Dict[str, Any]) -> None:
+        now = time.time()
+        self._data[session_id] = (now + self.ttl_s, copy.deepcopy(session))
+        self._data.move_to_end(session_id)
+        # в начале — самые давно тронутые: снимаем истёкшие и лишние
+        while self._data:
+            oldest_id, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at >= now and len(self._data) <= self.max_sessions:
+                break
+            self._data.pop(oldest_id)
+
+    async def update(self, session_id: str, fn) -> Optional[Dict[str, Any]]:
+        """
+        Атомарно: fn(текущая сессия или None) -> новая сессия (None — не сохранять).
+        get/save ничего не ждут, так что между ними event loop не переключается.
+        """
+        session = fn(await self.get(session_id))
+        if session is not None:
+            await self.save(session_id, session)
+        return session
+
+    async def delete(self, session_id: str) -> None:
+        self._data.pop(session_id, None)
+
+    async def count(self) -> int:
+        return len(self._data)
+
+    async def close(self) -> None:
+        self._data.clear()
+
+
+class _RedisSessionBackend:
+    """Сессии в Redis (или совместимом сервере) — общие для нескольких воркеров."""
+
+    name = "redis"
+
+    def __init__(self, url: str, ttl_s: float):
+        self.ttl_s = int(ttl_s)
+        self._redis = redis_async.from_url(url, decode_responses=True)
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        raw = await self._redis.get(f"chat_session:{session_id}")
+        return json.loads(raw) if raw else None
+
+    async def save(self, session_id: str, session: Dict[str, Any]) -> None:
+        await self._redis.set(
+            f"chat_session:{session_id}",
+            json.dumps(session, ensure_ascii=False),
+            ex=self.ttl_s,
+        )
+
+    async def update(self, session_id: str, fn) -> Optional[Dict[str, Any]]:
+        """Как у memory-бэкенда, но через WATCH/MULTI: при гонке fn пересчитывается."""
+        key = f"chat_session:{session_id}"
+        async with self._redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    raw = await pipe.get(key)
+                    session = fn(json.loads(raw) if raw else None)
+                    if session is None:
+                        await pipe.unwatch()
+                        return None
+                    pipe.multi()
+                    pipe.set(key, json.dumps(session, ensure_ascii=False), ex=self.ttl_s)
+                    await pipe.execute()
+                    return session
+                except RedisWatchError:
+                    continue
+
+    async def delete(self, session_id: str) -> None:
+        await self._redis.delete(f"chat_session:{session_id}")
+
+    async def count(self) -> int:
+        return -1  # SCAN по всем ключам ради /stats не делаем
+
+    async def close(self) -> None:
+        await self._redis.close()
+
+
+def _make_session_backend():
+    if CHAT_SESSION_REDIS_URL:
+        if redis_async is not None:
+            return _RedisSessionBackend(CHAT_SESSION_REDIS_URL, CHAT_SESSION_TTL_S)
+        logger.warning("[CHAT] CHAT_SESSION_REDIS_URL set but redis package missing, using memory sessions")
+    return _MemorySessionBackend(CHAT_SESSION_TTL_S, CHAT_SESSION_MAX)
+
+
+CHAT_SESSIONS = _make_session_backend()
+CHAT_SESSION_STATS = {"created": 0, "resumed": 0, "expired": 0}
+
+
+async def _load_chat_session(req: ChatRequest) -> Optional[Dict[str, Any]]:
+    """
+    None — запрос без session_id (старое поведение: история целиком от клиента).
+    Иначе — сессия с уже добавленными новыми сообщениями из req.messages
+    (они же в session["_new"] — для слияния при сохранении).
+    """
+    sid = (req.session_id or "").strip()
+    if not sid:
+        return None
+
+    session = None if sid == "new" else await CHAT_SESSIONS.get(sid)
+    if session is None:
+        if sid != "new":
+            # истекла или неизвестна — чужой id не принимаем, выдаём новый
+            # (иначе клиент может сам назначить id и подсунуть его другому)
+            CHAT_SESSION_STATS["expired"] += 1
+            logger.info("[CHAT] session %s not found, starting a new one", sid)
+        sid = uuid.uuid4().hex
+        CHAT_SESSION_STATS["created"] += 1
+        session = {
+            "id": sid,
+            "messages": [],
+            "turns": 0,
+            "created_at": time.time(),
+            "total": 0,              # сколько сообщений было за всю сессию
+            "summary": "",
+            "summarized_total": 0,   # сколько первых сообщений уже свёрнуто в summary
+        }
+    else:
+        CHAT_SESSION_STATS["resumed"] += 1
+
+    new_messages = [{"role": m.role, "content": m.content} for m in req.messages]
+    _append_session_messages(session, new_messages)
+    session["_new"] = new_messages
+    return session
+
+
+def _append_session_messages(session: Dict[str, Any], new_messages: List[Dict[str, str]]) -> None:
+    session["total"] = session.get("total", len(session["messages"])) + len(new_messages)
+    session["messages"].extend(new_messages)
+    session["messages"] = session["messages"][-CHAT_SESSION_MAX_MESSAGES:]
+
+
+def _unsummarized_messages(session: Dict[str, Any]) -> List[Dict[str, str]]:
+    # messages хранит только хвост истории: смещение = total - len(messages)
+    offset = session.get("total", len(session["messages"])) - len(session["messages"])
+    return session["messages"][max(0, session.get("summarized_total", 0) - offset):]
+
+
+def _chat_summaries_enabled() -> bool:
+    return CHAT_SUMMARY_EVERY_TURNS > 0 and LLM_BACKGROUND_CONCURRENCY > 0
+
+
+def _chat_summary_due(session: Dict[str, Any]) -> bool:
+    # в промпт всегда идёт окно из CHAT_HISTORY_WINDOW сообщений; вышедшие за окно
+    # копятся и раз в N ходов (по 2 сообщения) сворачиваются в резюме одним вызовом
+    if not _chat_summaries_enabled():
+        return False
+    return len(_unsummarized_messages(session)) >= CHAT_HISTORY_WINDOW + 2 * CHAT_SUMMARY_EVERY_TURNS
+
+
+async def _save_chat_turn(session: Dict[str, Any], response: ChatResponse, llm_ok: bool = True) -> None:
+    """
+    Дописывает ход в сохранённую сессию. Сливаем с тем, что лежит в хранилище
+    сейчас, а не перезаписываем свою копию: параллельный ход или фоновое
+    резюме могли обновить сессию, пока мы ждали LLM.
+    """
+    response.session_id = session["id"]
+    if not llm_ok:
+        # таймаут/сбой LLM: заглушку в историю не пишем, реплику ученика тоже —
+        # клиент повторит её, и модель увидит диалог без дыры
+        return
+
+    new_messages = list(session.get("_new", []))
+    if response.reply:
+        new_messages.append({"role": "assistant", "content": response.reply})
+
+    def _merge(latest: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if latest is None:
+            # сессия новая (или истекла, пока ждали) — наша копия уже с репликой ученика
+            base = copy.deepcopy(session)
+            base.pop("_new", None)
+            added = new_messages[len(session.get("_new", [])):]
+        else:
+            base = latest
+            added = new_messages
+        _append_session_messages(base, added)
+        for field in ("partner_name", "system_prompt"):
+            base.setdefault(field, session.get(field))
+        base["turns"] = base.get("turns", 0) + 1
+        base["updated_at"] = time.time()
+        return base
+
+    stored = await CHAT_SESSIONS.update(session["id"], _merge)
+
+    if _chat_summary_due(stored):
+        _schedule_chat_summary(session["id"])
+
+
+# ---------- Резюме длинных диалогов ----------
+
+CHAT_SUMMARY_SYSTEM_PROMPT = """
+You maintain a compact memory of a language-practice chat between a learner and a tutor who plays a character.
+
+INPUT: the previous memory (may be empty) and the next part of the transcript.
+TASK: return an UPDATED memory that replaces both. Keep:
+- the scene: where the conversation happens, roles, what has happened so far, open threads;
+- facts the learner shared about themselves (name, plans, preferences);
+- the learner's recurring mistakes (briefly).
+Drop small talk and anything already resolved. Write in English, third person, at most 120 words.
+Output ONLY the memory text, no preface.
+"""
+
+CHAT_SUMMARY_STATS = {"runs": 0, "errors": 0, "folded_messages": 0, "ms_total": 0.0}
+_CHAT_SUMMARY_TASKS: Dict[str, asyncio.Task] = {}
+
+
+def _schedule_chat_summary(session_id: str) -> None:
+    # один фоновый пересчёт на сессию; ответ пользователю его не ждёт
+    if session_id in _CHAT_SUMMARY_TASKS:
+        return
+    task = asyncio.create_task(_summarize_chat_session(session_id))
+    _CHAT_SUMMARY_TASKS[session_id] = task
+    task.add_done_callback(lambda _t, sid=session_id: _CHAT_SUMMARY_TASKS.pop(sid, None))
+
+
+async def _summarize_chat_session(session_id: str) -> None:
+    session = await CHAT_SESSIONS.get(session_id)
+    if session is None:
+        return
+    pending = _unsummarized_messages(session)
+    fold = pending[: max(0, len(pending) - CHAT_HISTORY_WINDOW)]
+    if not fold:
+        return
+
+    partner = session.get("partner_name") or "Tutor"
+    transcript = "\n".join(
+        f"{'Learner' if m['role'] == 'user' else partner}: {m['content']}" for m in fold
     )
-    system_prompt = build_system_prompt(
-        language=req.language,
-        level=req.level,
-        topic=req.topic,
-        partner_gender=req.partner_gender,
-        partner_name=partner_name,
-        situation=req.situation,
+    user_content = (
+        f"PREVIOUS MEMORY:\n{session.get('summary') or '(empty)'}\n\n"
+        f"TRANSCRIPT:\n{transcript}"
+    )
+
+    t0 = time.time()
+    CHAT_SUMMARY_STATS["runs"] += 1
+    try:
+        async with LLM_BACKGROUND_SEMAPHORE:
+            content = await llm_chat_completion(
+                [
+                    {"role": "system", "content": CHAT_SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": user_content},
+                ],
+                temperature=0.2,
+                endpoint="chat_summary",
+                raise_errors=True,
+            )
+    except Exception as e:
+        logger.warning("[CHAT] summary failed for session %s: %s", session_id, e)
+        content = ""
+    summary = " ".join((content or "").split())[:CHAT_SUMMARY_MAX_CHARS]
+    CHAT_SUMMARY_STATS["ms_total"] += (time.time() - t0) * 1000
+    if not summary:
+        CHAT_SUMMARY_STATS["errors"] += 1
+        return
+
+    summarized_total = session["total"] - len(pending) + len(fold)
+
+    def _merge(latest: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        # пока шла генерация, в сессию могли дописать ходы — пишем в свежую версию;
+        # если кто-то уже свернул дальше, наше резюме устарело
+        if latest is None or latest.get("summarized_total", 0) >= summarized_total:
+            return None
+        latest["summary"] = summary
+        latest["summarized_total"] = summarized_total
+        return latest
+
+    if await CHAT_SESSIONS.update(session_id, _merge) is None:
+        return
+    CHAT_SUMMARY_STATS["folded_messages"] += len(fold)
+    logger.info(
+        "[CHAT] session %s: folded %d messages into summary (%d chars)",
+        session_id,
+        len(fold),
+        len(summary),
     )
 
-    history_messages = [
-        {"role": msg.role, "content": msg.content}
-        for msg in req.messages
-    ]
-    history_messages = history_messages[-5:]
 
-    has_user_message = any(msg.role == "user" for msg in req.messages)
-    last_message_from_user = bool(req.messages and req.messages[-1].role == "user")
+def _prepare_chat_messages(
+    req: ChatRequest,
+    session: Optional[Dict[str, Any]] = None,
+) -> tuple[str, List[Dict[str, str]], bool, bool]:
+    if session is not None and session.get("system_prompt"):
+        # персонаж и промпт фиксируются при создании сессии: тот же текст — тот же KV-префикс
+        partner_name = session["partner_name"]
+        system_prompt = session["system_prompt"]
+    else:
+        partner_name = (req.character or "").strip() or get_partner_name(
+            req.language,
+            req.partner_gender or "female",
+        )
+        system_prompt = build_system_prompt(
+            language=req.language,
+            level=req.level,
+            topic=req.topic,
+            partner_gender=req.partner_gender,
+            partner_name=partner_name,
+            situation=req.situation,
+        )
+        if session is not None:
+            session.update(partner_name=partner_name, system_prompt=system_prompt)
+
+    summary = ""
+    if session is not None:
+        all_messages = session["messages"]
+        # свёрнутые в резюме сообщения не шлём — вместо них идёт summary;
+        # хвост фиксированной длины, чтобы промпт не рос между сворачиваниями
+        history_messages = _unsummarized_messages(session)[-CHAT_HISTORY_WINDOW:]
+        summary = session.get("summary") or ""
+    else:
+        all_messages = [{"role": msg.role, "content": msg.content} for msg in req.messages]
+        history_messages = all_messages[-CHAT_HISTORY_WINDOW:]
+
+    has_user_message = any(msg["role"] == "user" for msg in all_messages)
+    last_message_from_user = bool(all_messages and all_messages[-1]["role"] == "user")
 
     messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        # отдельным сообщением после основного промпта — его префикс не меняется
+        messages.append({"role": "system", "content": f"Memory of the earlier conversation:\n{summary}"})
     messages.extend(history_messages)
 
     logger.info("[CHAT] situation present: %s", "yes" if req.situation else "no")
     return partner_name, messages, has_user_message, last_message_from_user
 
 
-def llm_chat_completion(
+@asynccontextmanager
+async def _llm_slot():
+    """Занимает один из LLM_MAX_CONCURRENCY слотов, считая время в очереди."""
+    t_wait = time.time()
+    LLM_STATS["waiting"] += 1
+    LLM_STATS["max_waiting"] = max(LLM_STATS["max_waiting"], LLM_STATS["waiting"])
+    try:
+        await LLM_SEMAPHORE.acquire()
+    finally:
+        LLM_STATS["waiting"] -= 1
+    LLM_STATS["wait_ms_total"] += (time.time() - t_wait) * 1000
+
+    LLM_STATS["in_flight"] += 1
+    try:
+        yield
+    finally:
+        LLM_STATS["in_flight"] -= 1
+        LLM_SEMAPHORE.release()
+
+
+async def llm_chat_completion(
     messages: List[Dict[str, str]],
     temperature: float = 0.4,
+    endpoint: str = "chat",
+    raise_errors: bool = False,
 ) -> str:
-    payload: Dict[str, Any] = {
-        "model": LLM_MODEL,
-        "messages": messages,
-        # иначе ollama будет стримить кусочками
-        "stream": False,
-        "options": {
-            "temperature": temperature,
-        },
-    }
+    """
+    Ответ модели текстом. При таймауте/ошибке по умолчанию отдаёт вежливую заглушку
+    для чата; raise_errors=True — пробрасывает исключение (пакетные и фоновые вызовы
+    должны отличать сбой от ответа).
+    """
+    # stream=False — иначе ollama будет стримить кусочками
+    payload = _llm_payload(messages, temperature, stream=False)
+    timeout = LLM_TIMEOUTS.get(endpoint, LLM_TIMEOUT)
+
+    async def _call() -> httpx.Response:
+        async with _llm_slot():
+            return await LLM_HTTP.post(
+                LLM_CHAT_COMPLETIONS_URL,      # http://127.0.0.1:11434/api/chat
+                json=payload,
+                timeout=timeout,
+            )
 
     t0 = time.time()
+    LLM_STATS["requests"] += 1
     try:
-        resp = LLM_HTTP.post(
-            LLM_CHAT_COMPLETIONS_URL,      # http://127.0.0.1:11434/api/chat
-            json=payload,
-        )
+        resp = await asyncio.wait_for(_call(), timeout=timeout)
 
         dt_ms = (time.time() - t0) * 1000
+        LLM_STATS["llm_ms_total"] += dt_ms
         resp.raise_for_status()
         data = resp.json()
+        _record_llm_timing(endpoint, data)
 
         # формат ответа ollama:
         # {"message": {"role": "assistant", "content": "..."} , ...}
@@ -919,23 +2557,231 @@ def llm_chat_completion(
             content = str(content)
 
         logger.info(
-            "[LLM] POST %s %s in %.0fms text_len=%d",
+            "[LLM] POST %s %s in %.0fms text_len=%d endpoint=%s",
             LLM_CHAT_COMPLETIONS_URL,
             resp.status_code,
             dt_ms,
             len(content),
+            endpoint,
         )
         return content.strip()
 
+    except asyncio.TimeoutError:
+        LLM_STATS["timeouts"] += 1
+        LLM_STATS["errors"] += 1
+        logger.error("[LLM] timeout after %.0fs endpoint=%s", timeout, endpoint)
+        if raise_errors:
+            raise
+        return "Sorry, something went wrong. Could you write that again?"
+
     except Exception:
+        LLM_STATS["errors"] += 1
         dt_ms = (time.time() - t0) * 1000
         logger.exception("[LLM] error while calling chat completion (%.0fms)", dt_ms)
+        if raise_errors:
+            raise
         return "Sorry, something went wrong. Could you write that again?"
 
 
+async def llm_chat_completion_stream(
+    messages: List[Dict[str, str]],
+    temperature: float = 0.4,
+    endpoint: str = "chat",
+) -> AsyncIterator[str]:
+    """
+    То же, что llm_chat_completion, но отдаёт куски текста по мере генерации
+    (ollama stream=true, NDJSON). Ошибки пробрасываются вызывающему.
+    """
+    payload = _llm_payload(messages, temperature, stream=True)
+    timeout = LLM_TIMEOUTS.get(endpoint, LLM_TIMEOUT)
 
+    t0 = time.time()
+    first_token_ms: Optional[float] = None
+    text_len = 0
+    LLM_STATS["requests"] += 1
+    try:
+        async with _llm_slot():
+            async with LLM_HTTP.stream(
+                "POST",
+                LLM_CHAT_COMPLETIONS_URL,
+                json=payload,
+                timeout=timeout,
+            ) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line.strip():
+                        continue
+                    chunk = json.loads(line)
+                    piece = ((chunk.get("message") or {}).get("content")) or chunk.get("response") or ""
+                    if piece:
+                        if first_token_ms is None:
+                            first_token_ms = (time.time() - t0) * 1000
+                        text_len += len(piece)
+                        yield piece
+                    if chunk.get("done"):
+                        # последний кусок несёт prompt_eval_* / eval_*
+                        _record_llm_timing(endpoint, chunk)
+                        break
+    except Exception:
+        LLM_STATS["errors"] += 1
+        raise
+    finally:
+        dt_ms = (time.time() - t0) * 1000
+        LLM_STATS["llm_ms_total"] += dt_ms
+        logger.info(
+            "[LLM] stream %s ttft=%.0fms total=%.0fms text_len=%d endpoint=%s",
+            LLM_CHAT_COMPLETIONS_URL,
+            first_token_ms if first_token_ms is not None else -1,
+            dt_ms,
+            text_len,
+            endpoint,
+        )
+
+
+class _ChatStreamSplitter:
+    """
+    Инкрементальный разбор ответа вида {"reply":"...","corrections_text":"..."}
+    прямо из потока токенов: feed() возвращает новые куски [(поле, текст)].
+    Если модель ответила не JSON-ом — весь текст считается reply.
+    """
+
+    FIELDS = ("reply", "corrections_text")
+    _ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self):
+        self.mode = "detect"      # detect / json / text / done
+        self.fenced = False       # ответ начался с ``` (markdown-блок)
+        self.state = "key"        # key / in_key / colon / value / in_value / skip_value
+        self.key = ""
+        self.escape: Optional[str] = None   # None, "" (после \\) или накопленные hex-цифры \u
+        self.high_surrogate: Optional[int] = None
+        self.skip_depth = 0
+        self.skip_in_string = False
+
+    def feed(self, piece: str) -> List[tuple[str, str]]:
+        out: List[tuple[str, str]] = []
+
+        def emit(field: str, text: str) -> None:
+            if out and out[-1][0] == field:
+                out[-1] = (field, out[-1][1] + text)
+            else:
+                out.append((field, text))
 
+        for ch in piece:
+            if self.mode == "done":
+                break
 
+            if self.mode == "detect":
+                if ch == "`":
+                    self.fenced = True
+                    continue
+                if ch.isspace():
+                    continue
+                if ch == "{":
+                    self.mode = "json"
+                    continue
+                if self.fenced and ch.isalpha() and self.key.lower() in ("", "j", "js", "jso"):
+                    # ```json — пропускаем метку блока кода
+                    self.key += ch
+                    if self.key.lower() == "json":
+                        self.key = ""
+                    continue
+                self.mode = "text"
+                if self.key:
+                    emit("reply", self.key)
+                    self.key = ""
+
+            if self.mode == "text":
+                emit("reply", ch)
+                continue
+
+            self._feed_json_char(ch, emit)
+
+        return out
+
+    def _feed_json_char(self, ch: str, emit) -> None:
+        if self.state == "key":
+            if ch == '"':
+                self.state, self.key = "in_key", ""
+            elif ch == "}":
+                self.mode = "done"
+        elif self.state == "in_key":
+            if ch == '"' and self.escape is None:
+                self.state = "colon"
+            elif ch == "\\" and self.escape is None:
+                self.escape = ""
+            else:
+                self.escape = None
+                self.key += ch
+        elif self.state == "colon":
+            if ch == ":":
+                self.state = "value"
+        elif self.state == "value":
+            if ch.isspace():
+                return
+            if ch == '"':
+                self.state = "in_value"
+            else:
+                self.state, self.skip_depth, self.skip_in_string = "skip_value", 0, False
+                self._skip_char(ch)
+        elif self.state == "in_value":
+            text = self._string_char(ch)
+            if text is None:
+                self.state = "key"
+            elif text and self.key in self.FIELDS:
+                emit(self.key, text)
+        elif self.state == "skip_value":
+            self._skip_char(ch)
+
+    def _string_char(self, ch: str) -> Optional[str]:
+        """Декодирует один символ JSON-строки; None — строка закончилась."""
+        if self.escape is None:
+            if ch == '"':
+                return None
+            if ch == "\\":
+                self.escape = ""
+                return ""
+            return ch
+
+        if self.escape == "" and ch != "u":
+            self.escape = None
+            return self._ESCAPES.get(ch, ch)
+
+        self.escape += ch
+        if len(self.escape) < 5:          # "u" + 4 hex
+            return ""
+        hex_part, self.escape = self.escape[1:], None
+        try:
+            code = int(hex_part, 16)
+        except ValueError:
+            return ""
+        if 0xD800 <= code < 0xDC00:
+            self.high_surrogate = code
+            return ""
+        if 0xDC00 <= code < 0xE000 and self.high_surrogate is not None:
+            code = 0x10000 + ((self.high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+        self.high_surrogate = None
+        return chr(code)
+
+    def _skip_char(self, ch: str) -> None:
+        if self.skip_in_string:
+            if ch == '"' and self.escape is None:
+                self.skip_in_string = False
+            self.escape = "" if (ch == "\\" and self.escape is None) else None
+            return
+        if ch == '"':
+            self.skip_in_string = True
+        elif ch in "[{":
+            self.skip_depth += 1
+        elif ch in "]}":
+            if self.skip_depth == 0:
+                self.state = "key"
+                if ch == "}":
+                    self.mode = "done"
+            else:
+                self.skip_depth -= 1
+        elif ch == "," and self.skip_depth == 0:
+            self.state = "key"
 
 
 def get_partner_name(language: str, partner_gender: str) -> str:
@@ -963,6 +2809,36 @@ def get_partner_name(language: str, partner_gender: str) -> str:
         return female_names.get(language, "Alex")
 
 
+CHAT_RULES_PROMPT = """
+You are a friendly, professional language tutor chatting with a learner as a native-speaker friend.
+The language, learner level, your name and role, and the topic are given in SESSION at the end.
+
+Goals:
+- Reply only in the session language with short, natural answers (1-3 sentences) that keep the conversation moving.
+- Be concise and relevant; avoid introductions, sign-offs, and filler.
+- Encourage dialogue with occasional brief follow-up questions.
+
+Error correction:
+- Correct only the learner's LAST user message; ignore assistant/system/your own messages.
+- Preserve the user's meaning: do NOT change intent, nouns, key phrases, or add/remove information.
+- Fix only grammar, spelling/typos, word form/choice, and word order. Avoid style rewrites or tone changes.
+- If something is unclear, do minimal fixes and keep the original wording; do not guess new meaning.
+- First give the corrected version, then a short plain-language note on the fix.
+- Ignore minor casing/punctuation unless meaning changes.
+- If there are no real mistakes, leave "corrections_text" empty and do not invent issues.
+- Do not repeat the user's original sentence verbatim.
+- If the last message is NOT from the user, leave "corrections_text" empty.
+
+Style:
+- Sound human, not like a textbook or AI; never say you are an AI or language model.
+- Avoid repetitive explanations and meta-commentary.
+
+Output:
+Return STRICT JSON only:
+{"reply":"...","corrections_text":"..."}
+"""
+
+
 def build_system_prompt(
     language: str,
     level: Optional[str],
@@ -983,46 +2859,30 @@ def build_system_prompt(
 
     situation_contract = ""
     if situation:
-        situation_contract = f"""
-SITUATION CONTRACT:
-- Learner role: {situation.my_role}
-- Your role: {situation.partner_role}
-- Circumstances: {situation.circumstances}
-
-Obligations:
-- Reply strictly as {situation.partner_role}; never say you are an AI.
-- Stay inside the described circumstances and tone; use fitting vocabulary.
-- If the user goes off-topic, gently steer back and suggest an in-context reply.
-- Keep answers concise and natural (1–3 sentences).
-- Corrections: brief, helpful, and stay in the scene.
-"""
-
-    return f"""
-You are a friendly, professional {lang} tutor for a {level} learner. Your name is {partner_name}, a {partner_role} native speaker. Topic: {topic}.
-
-Goals:
-- Reply only in {lang} with short, natural answers (1-3 sentences) that keep the conversation moving.
-- Be concise and relevant; avoid introductions, sign-offs, and filler.
-- Encourage dialogue with occasional brief follow-up questions.
-
-Error correction:
-- Correct only the learner's LAST user message; ignore assistant/system/your own messages.
-- Preserve the user's meaning: do NOT change intent, nouns, key phrases, or add/remove information.
-- Fix only grammar, spelling/typos, word form/choice, and word order. Avoid style rewrites or tone changes.
-- If something is unclear, do minimal fixes and keep the original wording; do not guess new meaning.
-- First give the corrected version, then a short plain-language note on the fix.
-- Ignore minor casing/punctuation unless meaning changes.
-- If there are no real mistakes, leave "corrections_text" empty and do not invent issues.
-- Do not repeat the user's original sentence verbatim.
-- If the last message is NOT from the user, leave "corrections_text" empty.
+        situation_contract = f"""
+SITUATION CONTRACT:
+- Learner role: {situation.my_role}
+- Your role: {situation.partner_role}
+- Circumstances: {situation.circumstances}
 
-Style:
-- Sound human, not like a textbook or AI; never say you are an AI or language model.
-- Avoid repetitive explanations and meta-commentary.
+Obligations:
+- Reply strictly as {situation.partner_role}; never say you are an AI.
+- Stay inside the described circumstances and tone; use fitting vocabulary.
+- If the user goes off-topic, gently steer back and suggest an in-context reply.
+- Keep answers concise and natural (1–3 sentences).
+- Corrections: brief, helpful, and stay in the scene.
+"""
+
+    # Неизменная часть идёт первой и одинакова для всех диалогов — ollama
+    # переиспользует её KV-кэш; всё, что зависит от сессии, — в конце.
+    return CHAT_RULES_PROMPT + f"""
+SESSION:
+- Language: {lang}
+- Learner level: {level}
+- Your name: {partner_name}, a {partner_role} native speaker
+- Topic: {topic}
 {situation_contract}
-Output:
-Return STRICT JSON only:
-{{"reply":"...","corrections_text":"..."}}
+Reply only in {lang}. Return STRICT JSON only.
 """
 
 
@@ -1081,17 +2941,34 @@ def _normalize_situation_from_dict(
     )
 
 
-def call_llm_chat(req: ChatRequest) -> ChatResponse:
+async def call_llm_chat(req: ChatRequest) -> ChatResponse:
     """Вызов новой LLM для чат-диалога с коррекциями."""
+    session = await _load_chat_session(req)
     (
         partner_name,
         messages,
         has_user_message,
         last_message_from_user,
-    ) = _prepare_chat_messages(req)
+    ) = _prepare_chat_messages(req, session)
+
+    try:
+        content = await llm_chat_completion(messages, temperature=0.4, endpoint="chat", raise_errors=True)
+    except Exception:
+        content = ""
+    response = _build_chat_response(content, partner_name, has_user_message, last_message_from_user)
+    if session is not None:
+        # пустой content — сбой или пустой ответ модели; в reply тогда заглушка
+        await _save_chat_turn(session, response, llm_ok=bool(content.strip()))
+    return response
 
-    content = llm_chat_completion(messages, temperature=0.4)
 
+def _build_chat_response(
+    content: str,
+    partner_name: str,
+    has_user_message: bool,
+    last_message_from_user: bool,
+) -> ChatResponse:
+    """Разбирает сырой ответ модели в ChatResponse (reply + corrections_text)."""
     data = _parse_json_content(content)
     reply_text = ""
     corrections_text = ""
@@ -1141,142 +3018,1045 @@ def call_llm_chat(req: ChatRequest) -> ChatResponse:
     if not reply_text:
         reply_text = "Sorry, something went wrong. Could you write that again?"
 
-    return ChatResponse(
-        reply=reply_text,
-        corrections_text=corrections_text,
-        partner_name=partner_name,
-        audio_url=None,
-    )
+    return ChatResponse(
+        reply=reply_text,
+        corrections_text=corrections_text,
+        partner_name=partner_name,
+        audio_url=None,
+    )
+
+
+async def call_generate_situation(req: GenerateSituationRequest) -> SituationContext:
+    """Генерация ситуации диалога через тот же LLM."""
+    try:
+        return await _generate_situation_llm(req)
+    except ValueError:
+        return _normalize_situation_from_dict({}, req)
+
+
+async def _generate_situation_llm(req: GenerateSituationRequest) -> SituationContext:
+    """Один вызов модели; без JSON в ответе — ValueError (в пул дефолты не кладём)."""
+    system_prompt = f"""
+Ты придумываешь неожиданные, забавные, иногда слегка абсурдные ситуации для диалогов.
+Сгенерируй 3 строки (каждая 6-20 слов):
+- my_role
+- partner_role
+- circumstances (место/цель/обстоятельства/настроение)
+
+Входные параметры:
+- language: {req.language}
+- level: {req.level}
+- partner persona/name: {req.character}
+
+Требования:
+- Сделай сценарий необычным и весёлым, но безопасным (без насилия/секса/политики/токсичности).
+- Соответствуй языку и уровню; вплети персонажа в partner_role и обстоятельства.
+- Добавляй рандомные неожиданные элементы (например: странные места, юморные ограничения, любопытные цели).
+- Верни ТОЛЬКО JSON без дополнительного текста:
+{{"my_role":"...","partner_role":"...","circumstances":"..."}}
+"""
+
+    user_payload = {
+        "language": req.language,
+        "level": req.level,
+        "character": req.character,
+        "topic_hint": req.topic_hint,
+    }
+
+    content = await llm_chat_completion(
+        [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": json.dumps(user_payload, ensure_ascii=False),
+            },
+        ],
+        temperature=0.7,
+        endpoint="situation",
+    )
+
+    data = _parse_json_content(content)
+    if not data:
+        raise ValueError("LLM returned no situation JSON")
+    return _normalize_situation_from_dict(data, req)
+
+
+# ---------- Пул ситуаций ----------
+
+
+def _situation_bucket(req: GenerateSituationRequest) -> tuple[str, str, str, str]:
+    def norm(value: Optional[str]) -> str:
+        return " ".join((value or "").split()).casefold()
+
+    return (norm(req.language), norm(req.level).upper(), norm(req.character), norm(req.topic_hint))
+
+
+class SituationPool:
+    """
+    Для каждой корзины (language, level, character, topic_hint) держит до
+    `size` готовых ситуаций. Запрос забирает одну сразу, а фоновый заполнитель
+    (один на корзину) догенерирует недостающие. Каждая ситуация отдаётся
+    ровно один раз, так что разнообразие сохраняется.
+
+    Наполняются только корзины, которые запросили больше одного раза: разовый
+    запрос стоит одну генерацию. Заполнитель работает в общем фоновом бюджете
+    LLM_BACKGROUND_SEMAPHORE и не отнимает у живых запросов последний слот
+    (при бюджете 0 пул не наполняется вовсе).
+    """
+
+    def __init__(self, size: int, max_buckets: int) -> None:
+        self.size = max(0, size)
+        self.max_buckets = max(1, max_buckets)
+        self._buckets: "OrderedDict[tuple, deque]" = OrderedDict()
+        self._requests: Dict[tuple, GenerateSituationRequest] = {}
+        self._demand: Dict[tuple, int] = {}
+        self._fillers: Dict[tuple, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.errors = 0
+        self.coalesced = 0
+        self.evicted_buckets = 0
+
+    async def get(self, req: GenerateSituationRequest) -> SituationContext:
+        if self.size <= 0:
+            return await call_generate_situation(req)
+
+        key = _situation_bucket(req)
+        items = self._buckets.get(key)
+        if items is None:
+            items = self._buckets[key] = deque()
+            self._evict()
+        self._buckets.move_to_end(key)
+        self._requests[key] = req
+        self._demand[key] = self._demand.get(key, 0) + 1
+
+        if items:
+            self.hits += 1
+            situation = items.popleft()
+            self._schedule_fill(key)
+            return situation
+
+        # пул пуст — генерируем для этого запроса сами, корзину наполняем в фоне
+        self.misses += 1
+        self._schedule_fill(key)
+        return await call_generate_situation(req)
+
+    def _schedule_fill(self, key: tuple) -> None:
+        if LLM_BACKGROUND_CONCURRENCY <= 0 or self._demand.get(key, 0) < 2:
+            return
+        if key in self._fillers:
+            self.coalesced += 1
+            return
+        task = asyncio.create_task(self._fill(key))
+        self._fillers[key] = task
+        task.add_done_callback(lambda _t, k=key: self._fillers.pop(k, None))
+
+    async def _fill(self, key: tuple) -> None:
+        while True:
+            items = self._buckets.get(key)
+            req = self._requests.get(key)
+            if items is None or req is None or len(items) >= self.size:
+                return
+            async with LLM_BACKGROUND_SEMAPHORE:
+                try:
+                    situation = await _generate_situation_llm(req)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # не крутимся в цикле при лежащей модели: следующий запрос запустит снова
+                    self.errors += 1
+                    logger.warning("[SITUATION_POOL] fill failed for %s: %s", key, e)
+                    return
+            self.generated += 1
+            items = self._buckets.get(key)
+            if items is not None:
+                items.append(situation)
+
+    def _evict(self) -> None:
+        while len(self._buckets) > self.max_buckets:
+            key, _ = self._buckets.popitem(last=False)
+            self._requests.pop(key, None)
+            self._demand.pop(key, None)
+            task = self._fillers.pop(key, None)
+            if task is not None:
+                task.cancel()
+            self.evicted_buckets += 1
+
+    def close(self) -> None:
+        for task in list(self._fillers.values()):
+            task.cancel()
+        self._fillers.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "buckets": len(self._buckets),
+            "ready": sum(len(items) for items in self._buckets.values()),
+            "filling": len(self._fillers),
+            "hits": self.hits,
+            "misses": self.misses,
+            "generated": self.generated,
+            "errors": self.errors,
+            "coalesced": self.coalesced,
+            "evicted_buckets": self.evicted_buckets,
+        }
+
+
+SITUATION_POOL = SituationPool(SITUATION_POOL_SIZE, SITUATION_POOL_MAX_BUCKETS)
+
+
+
+# ---------- Словарь переводов слов ----------
+
+
+_WORD_EDGE_PUNCT_RE = re.compile(r"^[^\w]+|[^\w]+$")
+
+
+def _translation_key(language: str, word: str) -> tuple[str, str]:
+    """(код языка, слово в нижнем регистре без пунктуации по краям)."""
+    w = unicodedata.normalize("NFC", word or "").casefold().translate(_ANSWER_QUOTES)
+    w = " ".join(_WORD_EDGE_PUNCT_RE.sub("", w).split())
+    return normalize_lang_code(language or ""), w
+
+
+class TranslationStore:
+    """
+    Переводы слов целиком в памяти: {(lang, word): {translation, example, example_translation}}.
+    При старте заполняется из SQLite (ответы LLM прошлых запусков) и словаря
+    TRANSLATION_LEXICON_PATH; новые ответы LLM пишутся сразу в оба места.
+    _lock защищает словарь и счётчики (держится мгновенно, можно брать из event loop),
+    _db_lock — соединение SQLite (только из потоков).
+    """
+
+    def __init__(self, lexicon_path: str):
+        self.lexicon_path = lexicon_path
+        self._entries: Dict[tuple[str, str], Dict[str, str]] = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(str(CACHE_DB_PATH), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS translations (
+                    lang TEXT,
+                    word TEXT,
+                    value TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (lang, word)
+                )
+                """
+            )
+        self.counters = {"hits": 0, "misses": 0, "learned": 0, "lexicon_entries": 0, "stored_entries": 0}
+
+    def load(self) -> None:
+        entries: Dict[tuple[str, str], Dict[str, str]] = {}
+        with self._db_lock:
+            rows = self._db.execute("SELECT lang, word, value FROM translations").fetchall()
+        for lang, word, value in rows:
+            try:
+                entries[(lang, word)] = json.loads(value)
+            except Exception:
+                continue
+        stored = len(entries)
+
+        lexicon = self._read_lexicon() if self.lexicon_path else {}
+        # курируемый словарь важнее ответов LLM
+        entries.update(lexicon)
+
+        with self._lock:
+            entries.update(self._entries)   # то, что успели выучить, пока грузились
+            self._entries = entries
+            self.counters["stored_entries"] = stored
+            self.counters["lexicon_entries"] = len(lexicon)
+        logger.info(
+            "[TRANSLATE] store loaded: %d from db, %d from lexicon %s",
+            stored,
+            len(lexicon),
+            self.lexicon_path or "-",
+        )
+
+    def _read_lexicon(self) -> Dict[tuple[str, str], Dict[str, str]]:
+        path = Path(self.lexicon_path)
+        out: Dict[tuple[str, str], Dict[str, str]] = {}
+        try:
+            if path.suffix.lower() == ".json":
+                data = json.loads(path.read_text(encoding="utf-8"))
+                for lang, words in data.items():
+                    for word, value in (words or {}).items():
+                        entry = value if isinstance(value, dict) else {"translation": value}
+                        if str(entry.get("translation") or "").strip():
+                            out[_translation_key(lang, word)] = {
+                                "translation": str(entry["translation"]).strip(),
+                                "example": str(entry.get("example") or "").strip(),
+                                "example_translation": str(entry.get("example_translation") or "").strip(),
+                            }
+            else:
+                with path.open(encoding="utf-8") as f:
+                    for line in f:
+                        parts = line.rstrip("\n").split("\t")
+                        if len(parts) < 3 or line.startswith("#") or not parts[2].strip():
+                            continue
+                        parts += [""] * (5 - len(parts))
+                        out[_translation_key(parts[0], parts[1])] = {
+                            "translation": parts[2].strip(),
+                            "example": parts[3].strip(),
+                            "example_translation": parts[4].strip(),
+                        }
+        except Exception as e:
+            logger.error("[TRANSLATE] failed to read lexicon %s: %s", path, e)
+        return out
+
+    def get(self, language: str, word: str) -> Optional[Dict[str, str]]:
+        key = _translation_key(language, word)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+            else:
+                self.counters["hits"] += 1
+        return entry
+
+    def put_many(self, language: str, entries: Dict[str, Dict[str, str]]) -> None:
+        """Пачка переводов (слово -> entry) — одной транзакцией SQLite."""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for word, entry in entries.items():
+                key = _translation_key(language, word)
+                if not key[1]:
+                    continue
+                self._entries[key] = entry
+                rows.append((key[0], key[1], json.dumps(entry, ensure_ascii=False), now))
+            self.counters["learned"] += len(rows)
+        if not rows:
+            return
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO translations (lang, word, value, created_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def put(self, language: str, word: str, entry: Dict[str, str]) -> None:
+        self.put_many(language, {word: entry})
+
+    async def aput(self, language: str, word: str, entry: Dict[str, str]) -> None:
+        await asyncio.to_thread(self.put, language, word, entry)
+
+    async def aput_many(self, language: str, entries: Dict[str, Dict[str, str]]) -> None:
+        await asyncio.to_thread(self.put_many, language, entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "entries": size,
+            "hit_rate": round(counters["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._db_lock:
+            self._db.close()
+
+
+TRANSLATION_STORE = TranslationStore(TRANSLATION_LEXICON_PATH)
+_TRANSLATE_SINGLE_FLIGHT = _AsyncSingleFlight()
+
+
+async def _llm_translate_entry(language: str, word: str) -> Dict[str, str]:
+    """
+    Перевод через LLM. Разобранный JSON с переводом запоминаем в словаре;
+    сырой текст модели (fallback) — нет. Если LLM недоступна — пустой перевод
+    (клиенту уйдёт само слово), в словарь ничего не пишем.
+    """
+    system_prompt = f"""
+You are a translator.
+Your task: translate ONE word or a very short phrase from {language} to Russian
+and give ONE short example sentence in {language} with this word,
+AND also provide a Russian translation of this example sentence.
+
+Answer STRICTLY as JSON, without any extra text:
+
+{{
+  "translation": "перевод на русский",
+  "example": "пример предложения на {language}",
+  "example_translation": "перевод примера на русский"
+}}
+"""
+
+    user_prompt = f"Word: {word}\nLanguage: {language}\nTarget: Russian"
+
+    try:
+        content = await llm_chat_completion(
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=0.2,
+            endpoint="translate",
+            raise_errors=True,
+        )
+    except Exception as e:
+        logger.warning("[TRANSLATE] LLM failed for %r: %r", word, e)
+        return {"translation": "", "example": "", "example_translation": ""}
+
+    data = _parse_json_content(content)
+    if data:
+        entry = {
+            "translation": str(data.get("translation", "")).strip(),
+            "example": str(data.get("example", "")).strip(),
+            "example_translation": str(data.get("example_translation", "")).strip(),
+        }
+        if entry["translation"]:
+            await TRANSLATION_STORE.aput(language, word, entry)
+        return entry
+
+    # fallback: просто отдать весь текст в перевод
+    return {"translation": (content or "").strip(), "example": "", "example_translation": ""}
+
+
+async def call_llm_translate(
+    language: str,
+    word: str,
+    include_audio: bool = False,
+    audio_format: Optional[str] = None,
+) -> TranslateResponse:
+    """
+    Перевод одного слова/фразы на русский + пример и перевод примера.
+    Озвучка слова через Piper (если include_audio = True).
+    """
+
+    # ---------- 1. Перевод: словарь, иначе LLM ----------
+    entry = TRANSLATION_STORE.get(language, word)
+    if entry is None:
+        key = "|".join(_translation_key(language, word))
+        entry = await _TRANSLATE_SINGLE_FLIGHT.do(key, lambda: _llm_translate_entry(language, word))
+
+    # ---------- 2. Озвучка через Piper + кеш  ----------
+    audio_url = await _word_audio_url(word, language, audio_format) if include_audio else None
+    return _translate_response(word, entry, audio_url)
+
+
+def _translate_response(word: str, entry: Dict[str, str], audio_url: Optional[str]) -> TranslateResponse:
+    # Подстраховка, чтобы не возвращать пустые строки
+    return TranslateResponse(
+        translation=entry.get("translation") or word,
+        example=entry.get("example") or word,
+        example_translation=entry.get("example_translation") or "перевод примера не указан",
+        audio_url=audio_url,
+    )
+
+
+# Озвучка слов для /translate-word(s): не больше задач в пуле потоков, чем воркеров Piper,
+# иначе пачка из 200 слов забивает executor и хвост падает по таймауту воркера
+_WORD_AUDIO_SEMAPHORE = asyncio.Semaphore(
+    int(os.getenv("TRANSLATE_AUDIO_CONCURRENCY", str(PIPER_WORKERS_PER_MODEL)))
+)
+
+
+async def _word_audio_url(word: str, language: str, audio_format: Optional[str]) -> Optional[str]:
+    try:
+        text = (word or "").strip()
+        if text:
+            async with _WORD_AUDIO_SEMAPHORE:
+                filepath = await asyncio.to_thread(
+                    _ensure_cached_tts_file,
+                    text,
+                    language,
+                    voice=None,
+                    sample_rate=None,
+                    audio_format=audio_format,
+                )
+            return _build_audio_url(filepath.name)
+    except Exception:
+        logger.exception("TTS ERROR (Piper) language=%s text=%r", language, word)
+    return None
+
+
+# ---------- Пакетный перевод слов ----------
+
+TRANSLATE_BATCH_MAX_WORDS = int(os.getenv("TRANSLATE_BATCH_MAX_WORDS", "200"))
+# Сколько слов максимум добиваем поштучно, если пачка не удалась или модель что-то пропустила
+TRANSLATE_SINGLE_FALLBACK_MAX = int(os.getenv("TRANSLATE_SINGLE_FALLBACK_MAX", "5"))
+TRANSLATE_BATCH_CHUNK = int(os.getenv("TRANSLATE_BATCH_CHUNK", "30"))   # слов в одном промпте
+
+
+async def _llm_translate_packed(language: str, words: List[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Один промпт на пачку слов. Возвращает {нормализованное слово: entry} для того,
+    что модель перевела; всё переведённое одной транзакцией попадает в TRANSLATION_STORE.
+    """
+    system_prompt = f"""
+You are a translator.
+Your task: for EACH word or very short phrase in the list, translate it from {language} to Russian,
+give ONE short example sentence in {language} with this word,
+AND a Russian translation of this example sentence.
+
+Answer STRICTLY as JSON, without any extra text, one item per input word, same spelling in "word":
+
+{{
+  "items": [
+    {{
+      "word": "исходное слово",
+      "translation": "перевод на русский",
+      "example": "пример предложения на {language}",
+      "example_translation": "перевод примера на русский"
+    }}
+  ]
+}}
+"""
+    content = await llm_chat_completion(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps({"language": language, "words": words}, ensure_ascii=False)},
+        ],
+        temperature=0.2,
+        endpoint="translate_batch",
+        raise_errors=True,
+    )
+    data = _parse_json_content(content)
+    rows = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(rows, list):
+        raise ValueError("Invalid batch translation JSON")
+
+    wanted = {_translation_key(language, w)[1] for w in words}
+    out: Dict[str, Dict[str, str]] = {}
+    for row in rows:
+        if not isinstance(row, dict):
+            continue
+        norm = _translation_key(language, str(row.get("word", "")))[1]
+        entry = {
+            "translation": str(row.get("translation", "")).strip(),
+            "example": str(row.get("example", "")).strip(),
+            "example_translation": str(row.get("example_translation", "")).strip(),
+        }
+        if norm in wanted and norm not in out and entry["translation"]:
+            out[norm] = entry
+    await TRANSLATION_STORE.aput_many(language, out)
+    return out
+
+
+class TranslateBatchRequest(BaseModel):
+    words: List[str]
+    language: Optional[str] = "English"
+    with_audio: Optional[bool] = False
+    audio_format: Optional[Literal["mp3", "opus"]] = None
+
+
+class TranslateBatchItem(TranslateResponse):
+    word: str
+
+
+class TranslateBatchResponse(BaseModel):
+    items: List[TranslateBatchItem]
+
+
+@app.post("/translate-words", response_model=TranslateBatchResponse)
+async def translate_words_endpoint(payload: TranslateBatchRequest):
+    """
+    Глоссы для всех слов реплики/урока за один запрос: словарь -> один упакованный
+    промпт на промахи (по TRANSLATE_BATCH_CHUNK слов) -> по одному для того, что модель
+    пропустила (не больше TRANSLATE_SINGLE_FALLBACK_MAX и не после таймаута — LLM и так
+    перегружена). Озвучка идёт параллельно с переводом, не больше воркеров Piper за раз.
+    """
+    lang = payload.language or "English"
+    if len(payload.words) > TRANSLATE_BATCH_MAX_WORDS:
+        raise HTTPException(status_code=422, detail=f"Too many words (max {TRANSLATE_BATCH_MAX_WORDS})")
+
+    # порядок как в запросе, повторы (Cat / cat,) переводим один раз
+    words: Dict[str, str] = {}
+    for w in payload.words:
+        norm = _translation_key(lang, w)[1]
+        if norm and norm not in words:
+            words[norm] = w.strip()
+
+    entries: Dict[str, Dict[str, str]] = {}
+    misses: List[str] = []
+    for norm, word in words.items():
+        entry = TRANSLATION_STORE.get(lang, word)
+        if entry is not None:
+            entries[norm] = entry
+        else:
+            misses.append(norm)
+
+    async def _audio_all() -> List[Optional[str]]:
+        if not payload.with_audio:
+            return [None] * len(words)
+        return await asyncio.gather(*(_word_audio_url(w, lang, payload.audio_format) for w in words.values()))
+
+    async def _translate_misses() -> None:
+        timed_out = False
+        if len(misses) > 1:
+            chunks = [misses[i : i + TRANSLATE_BATCH_CHUNK] for i in range(0, len(misses), TRANSLATE_BATCH_CHUNK)]
+            packed = await asyncio.gather(
+                *(_llm_translate_packed(lang, chunk) for chunk in chunks), return_exceptions=True
+            )
+            for outcome in packed:
+                if isinstance(outcome, Exception):
+                    logger.warning("[TRANSLATE] packed translation failed: %r", outcome)
+                    timed_out = timed_out or isinstance(outcome, (asyncio.TimeoutError, httpx.TimeoutException))
+                    continue
+                entries.update(outcome)
+        if timed_out:
+            # LLM не успевает — поштучные вызовы только добавят ей нагрузки
+            return
+        leftovers = [norm for norm in misses if norm not in entries][:TRANSLATE_SINGLE_FALLBACK_MAX]
+        singles = await asyncio.gather(
+            *(
+                _TRANSLATE_SINGLE_FLIGHT.do(
+                    "|".join(_translation_key(lang, norm)),
+                    lambda w=words[norm]: _llm_translate_entry(lang, w),
+                )
+                for norm in leftovers
+            ),
+            return_exceptions=True,
+        )
+        for norm, outcome in zip(leftovers, singles):
+            if isinstance(outcome, Exception):
+                logger.warning("[TRANSLATE] %r failed: %s", words[norm], outcome)
+                continue
+            entries[norm] = outcome
+
+    # озвучка не зависит от перевода — идёт параллельно с LLM
+    audio_urls, _ = await asyncio.gather(_audio_all(), _translate_misses())
+
+    return TranslateBatchResponse(
+        items=[
+            TranslateBatchItem(word=word, **_translate_response(word, entries.get(norm, {}), url).dict())
+            for (norm, word), url in zip(words.items(), audio_urls)
+        ]
+    )
+
+
+
+
+# ---------- Распознавание речи: пул whisper-server, декодирование, VAD ----------
+
+
+class WhisperQueueFull(Exception):
+    pass
+
+
+class WhisperServerPool:
+    """
+    Пул whisper-server процессов (whisper.cpp), у каждого модель уже в памяти.
+    Запросы раздаём свободным серверам через очередь; если пул недоступен,
+    /stt откатывается на одноразовый whisper-cli.
+    """
+
+    def __init__(self, workers: int, external_urls: List[str]):
+        self.workers = workers
+        self.external_urls = external_urls
+        self.procs: Dict[str, subprocess.Popen] = {}
+        self._idle: Optional[asyncio.Queue] = None
+        self._http: Optional[httpx.AsyncClient] = None
+        self._starting = 0
+        self._alive = 0
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "rejected": 0,
+            "waiting": 0,
+            "max_waiting": 0,
+            "wait_ms_total": 0.0,
+            "infer_ms_total": 0.0,
+            "restarts": 0,
+        }
+
+    def configured(self) -> bool:
+        if self.external_urls:
+            return True
+        return self.workers > 0 and os.path.exists(WHISPER_SERVER_BIN) and os.path.exists(WHISPER_MODEL)
+
+    def available(self) -> bool:
+        return self._idle is not None and (self._alive > 0 or self._starting > 0)
+
+    async def start(self) -> None:
+        if not self.configured():
+            logger.info("[STT] whisper-server pool disabled, using whisper-cli per request")
+            return
+        self._idle = asyncio.Queue()
+        self._http = httpx.AsyncClient(timeout=WHISPER_TIMEOUT, trust_env=False)
+        if self.external_urls:
+            for url in self.external_urls:
+                self._starting += 1
+                asyncio.create_task(self._register_when_ready(url))
+            return
+        for i in range(self.workers):
+            self._launch(f"http://{WHISPER_SERVER_HOST}:{WHISPER_SERVER_BASE_PORT + i}")
+
+    def _launch(self, url: str) -> None:
+        port = url.rsplit(":", 1)[-1]
+        cmd = [
+            WHISPER_SERVER_BIN,
+            "-m", WHISPER_MODEL,
+            "--host", WHISPER_SERVER_HOST,
+            "--port", port,
+            "-t", str(WHISPER_SERVER_THREADS),
+        ]
+        if WHISPER_SERVER_CONVERT:
+            cmd.append("--convert")
+        logger.info("[STT] starting whisper-server %s", url)
+        self.procs[url] = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self._starting += 1
+        asyncio.create_task(self._register_when_ready(url))
+
+    async def _register_when_ready(self, url: str) -> None:
+        deadline = time.time() + WHISPER_STARTUP_TIMEOUT
+        try:
+            while time.time() < deadline:
+                proc = self.procs.get(url)
+                if proc is not None and proc.poll() is not None:
+                    logger.error("[STT] whisper-server %s exited with code %s", url, proc.returncode)
+                    return
+                try:
+                    resp = await self._http.get(url + "/", timeout=2)
+                    if resp.status_code < 500:
+                        self._alive += 1
+                        self._idle.put_nowait(url)
+                        logger.info("[STT] whisper-server ready %s", url)
+                        return
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.5)
+            logger.error("[STT] whisper-server %s not ready after %.0fs", url, WHISPER_STARTUP_TIMEOUT)
+        finally:
+            self._starting -= 1
+
+    def _restart(self, url: str) -> None:
+        self._alive -= 1
+        self.stats["restarts"] += 1
+        proc = self.procs.pop(url, None)
+        if proc is None:
+            # внешний сервер — просто ждём, пока снова ответит
+            self._starting += 1
+            asyncio.create_task(self._register_when_ready(url))
+            return
+        self._starting += 1
+        asyncio.create_task(self._relaunch(url, proc))
+
+    async def _relaunch(self, url: str, proc: subprocess.Popen) -> None:
+        # дожидаемся смерти старого процесса: не оставляем зомби и освобождаем порт
+        try:
+            proc.kill()
+            await asyncio.to_thread(proc.wait, 10)
+        except Exception:
+            logger.exception("[STT] failed to reap whisper-server %s", url)
+        finally:
+            self._starting -= 1
+        self._launch(url)
+
+    async def transcribe(self, audio_bytes: bytes, filename: str, lang_code: str) -> str:
+        if self.stats["waiting"] >= WHISPER_QUEUE_MAX:
+            self.stats["rejected"] += 1
+            raise WhisperQueueFull()
+
+        t_wait = time.time()
+        self.stats["waiting"] += 1
+        self.stats["max_waiting"] = max(self.stats["max_waiting"], self.stats["waiting"])
+        try:
+            url = await asyncio.wait_for(self._idle.get(), timeout=WHISPER_TIMEOUT)
+        finally:
+            self.stats["waiting"] -= 1
+        self.stats["wait_ms_total"] += (time.time() - t_wait) * 1000
+
+        t0 = time.time()
+        self.stats["requests"] += 1
+        # сервер возвращаем в пул при любом исходе, включая CancelledError
+        # (отмена partial-декодирования при закрытии WebSocket); кроме перезапуска
+        release = True
+        try:
+            resp = await self._http.post(
+                url + "/inference",
+                data={"response_format": "json", "language": lang_code, "temperature": "0.0"},
+                files={"file": (filename, audio_bytes)},
+            )
+            resp.raise_for_status()
+            text = str(resp.json().get("text", "")).strip()
+        except (httpx.ConnectError, httpx.RemoteProtocolError, httpx.ReadTimeout):
+            self.stats["errors"] += 1
+            release = False
+            self._restart(url)
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            if release:
+                self._idle.put_nowait(url)
+
+        dt_ms = (time.time() - t0) * 1000
+        self.stats["infer_ms_total"] += dt_ms
+        logger.info("[STT] whisper-server %s in %.0fms text_len=%d", url, dt_ms, len(text))
+        return text
+
+    def snapshot(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        done = stats["requests"] or 1
+        stats["wait_ms_avg"] = round(stats["wait_ms_total"] / done, 1)
+        stats["infer_ms_avg"] = round(stats["infer_ms_total"] / done, 1)
+        stats["alive"] = self._alive
+        stats["starting"] = self._starting
+        stats["mode"] = "server" if self.available() else "cli"
+        return stats
+
+    async def close(self) -> None:
+        for proc in self.procs.values():
+            proc.terminate()
+        for proc in self.procs.values():
+            try:
+                proc.wait(timeout=5)
+            except Exception:
+                proc.kill()
+                proc.wait()
+        self.procs.clear()
+        if self._http is not None:
+            await self._http.aclose()
 
 
-def call_generate_situation(req: GenerateSituationRequest) -> SituationContext:
-    """Генерация ситуации диалога через тот же LLM."""
-    system_prompt = f"""
-Ты придумываешь неожиданные, забавные, иногда слегка абсурдные ситуации для диалогов.
-Сгенерируй 3 строки (каждая 6-20 слов):
-- my_role
-- partner_role
-- circumstances (место/цель/обстоятельства/настроение)
+WHISPER_POOL = WhisperServerPool(WHISPER_SERVER_WORKERS, WHISPER_SERVER_URLS)
 
-Входные параметры:
-- language: {req.language}
-- level: {req.level}
-- partner persona/name: {req.character}
 
-Требования:
-- Сделай сценарий необычным и весёлым, но безопасным (без насилия/секса/политики/токсичности).
-- Соответствуй языку и уровню; вплети персонажа в partner_role и обстоятельства.
-- Добавляй рандомные неожиданные элементы (например: странные места, юморные ограничения, любопытные цели).
-- Верни ТОЛЬКО JSON без дополнительного текста:
-{{"my_role":"...","partner_role":"...","circumstances":"..."}}
-"""
+def _decode_to_pcm16k_av(audio_bytes: bytes) -> bytes:
+    out = bytearray()
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=STT_SAMPLE_RATE)
+    with av.open(io.BytesIO(audio_bytes), mode="r") as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                out += bytes(resampled.planes[0])[: resampled.samples * 2]
+    for resampled in resampler.resample(None):
+        out += bytes(resampled.planes[0])[: resampled.samples * 2]
+    return bytes(out)
 
-    user_payload = {
-        "language": req.language,
-        "level": req.level,
-        "character": req.character,
-        "topic_hint": req.topic_hint,
-    }
 
-    content = llm_chat_completion(
+def _decode_to_pcm16k_ffmpeg(audio_bytes: bytes) -> bytes:
+    proc = subprocess.run(
         [
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": json.dumps(user_payload, ensure_ascii=False),
-            },
+            FFMPEG_BIN,
+            "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0",
+            "-f", "s16le", "-ac", "1", "-ar", str(STT_SAMPLE_RATE),
+            "pipe:1",
         ],
-        temperature=0.7,
+        input=audio_bytes,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
     )
-
-    data = _parse_json_content(content)
-    return _normalize_situation_from_dict(data or {}, req)
-
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode("utf-8", "ignore")[:500])
+    return proc.stdout
 
 
-def call_llm_translate(
-    language: str,
-    word: str,
-    include_audio: bool = False,
-) -> TranslateResponse:
+def decode_to_pcm16k(audio_bytes: bytes, suffix: str) -> bytes:
     """
-    Перевод одного слова/фразы на русский + пример и перевод примера.
-    Озвучка слова через Piper (если include_audio = True).
+    Любой поддерживаемый контейнер (.wav/.m4a/.webm/.ogg/...) -> 16 кГц mono s16le PCM в памяти.
     """
+    if suffix.lower() == ".wav":
+        try:
+            pcm, sample_rate, channels = _wav_to_pcm(audio_bytes)
+            if sample_rate == STT_SAMPLE_RATE and channels == 1:
+                return pcm
+        except Exception:
+            pass
 
-    # ---------- 1. Получаем перевод и пример через LLM ----------
-    system_prompt = f"""
-You are a translator.
-Your task: translate ONE word or a very short phrase from {language} to Russian
-and give ONE short example sentence in {language} with this word,
-AND also provide a Russian translation of this example sentence.
+    if av is not None:
+        return _decode_to_pcm16k_av(audio_bytes)
+    return _decode_to_pcm16k_ffmpeg(audio_bytes)
 
-Answer STRICTLY as JSON, without any extra text:
 
-{{
-  "translation": "перевод на русский",
-  "example": "пример предложения на {language}",
-  "example_translation": "перевод примера на русский"
-}}
-"""
+def _frame_rms(samples: array, frame: int) -> List[float]:
+    """RMS каждого полного кадра из frame сэмплов."""
+    count = len(samples) // frame
+    if np is not None:
+        data = np.frombuffer(samples, dtype=np.int16, count=count * frame).astype(np.float64)
+        return np.sqrt((data.reshape(count, frame) ** 2).mean(axis=1)).tolist()
+    # без numpy считаем по каждому второму сэмплу: для порога речи точности хватает,
+    # а длинная запись обрабатывается вдвое быстрее
+    rms = []
+    for pos in range(0, count * frame, frame):
+        chunk = samples[pos:pos + frame:2]
+        rms.append((sum(map(operator.mul, chunk, chunk)) / len(chunk)) ** 0.5)
+    return rms
 
-    user_prompt = f"Word: {word}\nLanguage: {language}\nTarget: Russian"
 
-    content = llm_chat_completion(
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.2,
-    )
+def _trim_silence(pcm: bytes, sample_rate: int = STT_SAMPLE_RATE, frame_ms: int = 30) -> bytes:
+    """
+    Простейший энергетический VAD: отрезаем тишину в начале и в конце.
+    Порог — уровень шума (10-й перцентиль кадров) * 2.5, но не выше
+    STT_VAD_MAX_SPEECH_RATIO от уровня речи и не ниже STT_VAD_RMS_MIN.
+    Возвращает b"", если речи не нашлось.
+    """
+    samples = array("h")
+    samples.frombytes(pcm[: len(pcm) - len(pcm) % 2])
+    frame = max(1, sample_rate * frame_ms // 1000)
+    if len(samples) < frame:
+        return pcm
+
+    rms = _frame_rms(samples, frame)
+    ranked = sorted(rms)
+    noise = ranked[len(ranked) // 10]
+    speech = ranked[len(ranked) * 9 // 10]
+    threshold = max(STT_VAD_RMS_MIN, min(noise * 2.5, speech * STT_VAD_MAX_SPEECH_RATIO))
+    voiced = [i for i, level in enumerate(rms) if level >= threshold]
+    if not voiced:
+        return b""
 
-    data = _parse_json_content(content)
-    if data:
-        translation = str(data.get("translation", "")).strip()
-        example = str(data.get("example", "")).strip()
-        example_translation = str(data.get("example_translation", "")).strip()
-    else:
-        # fallback: просто отдать весь текст в перевод
-        translation = (content or "").strip()
-        example = ""
-        example_translation = ""
+    pad = STT_VAD_PAD_MS * sample_rate // 1000
+    start = max(0, voiced[0] * frame - pad)
+    end = min(len(samples), (voiced[-1] + 1) * frame + pad)
+    return samples[start:end].tobytes()
 
-    # Подстраховка, чтобы не возвращать пустые строки
-    if not translation:
-        translation = word
 
-    if not example:
-        example = word
+def _normalize_stt_audio(audio_bytes: bytes, suffix: str) -> Optional[bytes]:
+    """
+    Загрузка -> компактный 16 кГц mono WAV без тишины по краям (всё в памяти).
+    b"" — в записи нет речи; None — декодировать не удалось, шлём как есть.
+    """
+    t0 = time.perf_counter()
+    try:
+        pcm = decode_to_pcm16k(audio_bytes, suffix)
+    except Exception as e:
+        logger.warning("[STT] decode failed for %s (%d bytes): %s", suffix, len(audio_bytes), e)
+        return None
 
-    if not example_translation:
-        example_translation = "перевод примера не указан"
+    t1 = time.perf_counter()
+    trimmed = _trim_silence(pcm) if STT_VAD_ENABLED else pcm
+    t2 = time.perf_counter()
+    logger.info(
+        "[STT] normalized %s %d bytes -> %.2fs audio, %.2fs after VAD (decode=%.0fms vad=%.0fms)",
+        suffix,
+        len(audio_bytes),
+        len(pcm) / (2 * STT_SAMPLE_RATE),
+        len(trimmed) / (2 * STT_SAMPLE_RATE),
+        (t1 - t0) * 1000,
+        (t2 - t1) * 1000,
+    )
+    if not trimmed:
+        return b""
+    return _pcm_to_wav(trimmed, STT_SAMPLE_RATE)
 
-    # ---------- 2. Озвучка через Piper + кеш  ----------
-    audio_url: Optional[str] = None
 
-    if include_audio:
+async def _transcribe_audio(audio_bytes: bytes, suffix: str, lang_code: str) -> str:
+    """Распознаёт аудио через пул whisper-server, при сбое — через whisper-cli."""
+    if WHISPER_POOL.available():
         try:
-            text = (word or "").strip()
-            if text:
-                filepath = _ensure_cached_tts_file(
-                    text,
-                    language,
-                    voice=None,
-                    sample_rate=None,
-                )
-                audio_url = _build_audio_url(filepath.name)
+            return await WHISPER_POOL.transcribe(audio_bytes, f"audio{suffix}", lang_code)
+        except WhisperQueueFull:
+            raise
         except Exception:
-            logger.exception("TTS ERROR (Piper) language=%s text=%r", language, word)
-            audio_url = None
+            logger.exception("[STT] whisper-server failed, falling back to whisper-cli")
 
-    return TranslateResponse(
-        translation=translation,
-        example=example,
-        example_translation=example_translation,
-        audio_url=audio_url,
-    )
+    result = await asyncio.to_thread(_run_whisper_stt, lang_code, audio_bytes, suffix)
+    return result.text
+
+
+_NON_SPEECH_RE = re.compile(r"\[BLANK_AUDIO\]|\[(?:MUSIC|NOISE|SILENCE)\]", re.IGNORECASE)
+
+
+def _quietest_cut(pcm: bytes, sample_rate: int, search_s: float = 2.0) -> int:
+    """
+    Байтовое смещение самого тихого 100мс-фрейма в последних search_s секундах —
+    там режем окно, чтобы не разрубить слово пополам.
+    """
+    samples = array("h")
+    samples.frombytes(pcm[: len(pcm) - len(pcm) % 2])
+    frame = max(1, sample_rate // 10)
+    start = max(0, len(samples) - int(search_s * sample_rate))
+    best_pos, best_energy = len(samples), None
+    for pos in range(start, len(samples) - frame + 1, frame):
+        energy = sum(x * x for x in samples[pos:pos + frame])
+        if best_energy is None or energy < best_energy:
+            best_pos, best_energy = pos + frame // 2, energy
+    return best_pos * 2
+
+
+class _STTStreamSession:
+    """
+    Одна WebSocket-сессия потокового распознавания.
 
+    Аудио копится в pending; раз в STT_STREAM_STEP_S декодируем всё окно
+    и шлём partial. Когда окно длиннее STT_STREAM_WINDOW_S, отрезаем его
+    по самому тихому месту, распознаём и фиксируем текст (committed), так что
+    каждое декодирование обрабатывает не больше окна.
+    """
 
+    def __init__(self, lang_code: str, sample_rate: int, send):
+        self.lang_code = lang_code
+        self.sample_rate = sample_rate
+        self.send = send
+        self.bytes_per_s = sample_rate * 2
+        self.committed: List[str] = []
+        self.pending = bytearray()
+        self.since_partial = 0
+        self.total = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _decode(self, pcm: bytes) -> str:
+        if STT_VAD_ENABLED:
+            pcm = await asyncio.to_thread(_trim_silence, pcm, self.sample_rate)
+        if len(pcm) < self.bytes_per_s // 4:
+            return ""
+        text = await _transcribe_audio(_pcm_to_wav(pcm, self.sample_rate), ".wav", self.lang_code)
+        return _NON_SPEECH_RE.sub("", text).strip()
+
+    def _text(self, tail: str = "") -> str:
+        return " ".join(t for t in self.committed + [tail] if t)
+
+    async def _partial(self, pcm: bytes) -> None:
+        try:
+            tail = await self._decode(pcm)
+            await self.send({"type": "partial", "text": self._text(tail)})
+        except Exception:
+            logger.exception("[STT_STREAM] partial decode failed")
+
+    async def _wait_task(self) -> None:
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def add_audio(self, chunk: bytes) -> bool:
+        """False — сессия упёрлась в STT_STREAM_MAX_S."""
+        self.pending += chunk
+        self.since_partial += len(chunk)
+        self.total += len(chunk)
+        if self.total > STT_STREAM_MAX_S * self.bytes_per_s:
+            return False
+
+        if len(self.pending) > STT_STREAM_WINDOW_S * self.bytes_per_s:
+            await self._wait_task()
+            cut = _quietest_cut(bytes(self.pending), self.sample_rate)
+            head = bytes(self.pending[:cut])
+            del self.pending[:cut]
+            text = await self._decode(head)
+            if text:
+                self.committed.append(text)
+            self.since_partial = 0
+            await self.send({"type": "partial", "text": self._text()})
+        elif self.since_partial >= STT_STREAM_STEP_S * self.bytes_per_s and (
+            self._task is None or self._task.done()
+        ):
+            self.since_partial = 0
+            self._task = asyncio.create_task(self._partial(bytes(self.pending)))
+        return True
+
+    async def finish(self) -> str:
+        await self._wait_task()
+        tail = await self._decode(bytes(self.pending))
+        self.pending.clear()
+        return self._text(tail)
+
+    def cancel(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
 
 
 # ---------- Эндпоинты FastAPI ----------
@@ -1318,6 +4098,96 @@ def _run_whisper_stt(lang_code: str, audio_bytes: bytes, suffix: str) -> STTResp
 async def health_check():
     return {"status": "ok"}
 
+
+@app.get("/stats")
+async def stats_endpoint():
+    return {
+        "llm": _llm_stats_snapshot(),
+        "tts": _tts_stage_stats_snapshot(),
+        "piper_workers": PIPER_ENGINE.stats(),
+        "tts_cache": TTS_CACHE.stats(),
+        "stt": WHISPER_POOL.snapshot(),
+        "course_catalog": COURSE_CATALOG.stats(),
+        "lesson_cache": {
+            **LESSON_CACHE.stats(),
+            "in_flight": _LESSON_SINGLE_FLIGHT.in_flight(),
+            "coalesced": _LESSON_SINGLE_FLIGHT.coalesced,
+        },
+        "chat_sessions": {
+            **CHAT_SESSION_STATS,
+            "summaries": {**CHAT_SUMMARY_STATS, "in_flight": len(_CHAT_SUMMARY_TASKS)},
+            "backend": CHAT_SESSIONS.name,
+            "active": await CHAT_SESSIONS.count(),
+        },
+        "translations": TRANSLATION_STORE.stats(),
+        "answer_check": {
+            **ANSWER_CHECK_STATS,
+            "cache": ANSWER_CACHE.stats(),
+            "coalesced": _ANSWER_SINGLE_FLIGHT.coalesced,
+        },
+        "pregen": {
+            "jobs": len(_PREGEN_JOBS),
+            "running": len(_PREGEN_TASKS),
+            "concurrency": LLM_BACKGROUND_CONCURRENCY,
+        },
+        "course_plan_cache": {
+            **COURSE_PLAN_CACHE.stats(),
+            "in_flight": _COURSE_PLAN_SINGLE_FLIGHT.in_flight(),
+            "coalesced": _COURSE_PLAN_SINGLE_FLIGHT.coalesced,
+        },
+        "tts_singleflight": {
+            "in_flight": _TTS_SINGLE_FLIGHT.in_flight(),
+            "coalesced": _TTS_SINGLE_FLIGHT.coalesced,
+        },
+        "situation_pool": SITUATION_POOL.stats(),
+    }
+
+
+AUDIO_MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg",
+    "wav": "audio/wav",
+}
+
+
+@app.get("/audio/{filename}")
+async def audio_file_endpoint(filename: str, range_header: Optional[str] = Header(None, alias="range")):
+    """Отдаёт клип из TTS-кэша (RAM-слой или диск), с поддержкой Range для плееров."""
+    if "/" in filename or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    # read() сначала смотрит в RAM-слой; касание индекса может сбросить его в SQLite,
+    # поэтому даже попадание в RAM не выполняем в event loop
+    data = await asyncio.to_thread(TTS_CACHE.read, filename)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    media_type = AUDIO_MEDIA_TYPES.get(filename.rsplit(".", 1)[-1], "application/octet-stream")
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "public, max-age=31536000, immutable"}
+
+    if range_header and range_header.startswith("bytes="):
+        start_raw, _, end_raw = range_header[len("bytes="):].split(",")[0].partition("-")
+        try:
+            if start_raw:
+                start = int(start_raw)
+                end = int(end_raw) if end_raw else len(data) - 1
+            else:
+                start = max(0, len(data) - int(end_raw))
+                end = len(data) - 1
+        except ValueError:
+            start, end = 0, len(data) - 1
+        end = min(end, len(data) - 1)
+        if start > end:
+            raise HTTPException(
+                status_code=416,
+                detail="Range not satisfiable",
+                headers={"Content-Range": f"bytes */{len(data)}"},
+            )
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        return Response(data[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+    return Response(data, media_type=media_type, headers=headers)
+
 @app.post("/stt", response_model=STTResponse)
 async def stt_endpoint(
     language_code: str = Query("en", alias="language_code"),
@@ -1343,8 +4213,22 @@ async def stt_endpoint(
     if not ext:
         ext = ".wav"
 
+    normalized = await asyncio.to_thread(_normalize_stt_audio, contents, ext)
+    if normalized == b"":
+        # одна тишина — распознавать нечего
+        return STTResponse(text="", language=language_code)
+    if normalized is not None:
+        contents, ext = normalized, ".wav"
+
     try:
-        return await asyncio.to_thread(_run_whisper_stt, language_code, contents, ext)
+        text = await _transcribe_audio(contents, ext, language_code)
+        return STTResponse(text=text, language=language_code)
+    except WhisperQueueFull:
+        raise HTTPException(
+            status_code=503,
+            detail="STT is busy, try again",
+            headers={"Retry-After": "2"},
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -1352,6 +4236,67 @@ async def stt_endpoint(
         raise HTTPException(status_code=500, detail=f"STT internal error: {e}")
 
 
+@app.websocket("/ws/stt")
+async def stt_stream_endpoint(
+    websocket: WebSocket,
+    language_code: str = "en",
+    sample_rate: int = STT_STREAM_SAMPLE_RATE,
+):
+    """
+    Потоковое распознавание речи.
+
+    Клиент: бинарные сообщения — сырой PCM s16le mono (sample_rate, по умолчанию 16 кГц),
+    текстовое {"type": "stop"} — речь закончилась.
+    Сервер: {"type": "partial", "text"} по ходу речи, {"type": "final", "text"} в конце.
+    """
+    await websocket.accept()
+    session = _STTStreamSession(language_code, sample_rate, websocket.send_json)
+    t0 = time.time()
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+            if message.get("bytes"):
+                if not await session.add_audio(message["bytes"]):
+                    await websocket.send_json({"type": "error", "detail": "audio too long"})
+                    break
+                continue
+
+            command = (message.get("text") or "").strip()
+            try:
+                command = str(json.loads(command).get("type", ""))
+            except Exception:
+                pass
+            if command in ("stop", "end"):
+                break
+
+        t_stop = time.time()
+        text = await session.finish()
+        await websocket.send_json({"type": "final", "text": text, "language": language_code})
+        logger.info(
+            "[STT_STREAM] final in %.0fms after stop, session %.1fs text_len=%d",
+            (time.time() - t_stop) * 1000,
+            time.time() - t0,
+            len(text),
+        )
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    except WhisperQueueFull:
+        await websocket.send_json({"type": "error", "detail": "STT is busy, try again"})
+        await websocket.close()
+    except Exception:
+        logger.exception("[STT_STREAM] session failed")
+        try:
+            await websocket.close(code=1011)
+        except Exception:
+            pass
+    finally:
+        session.cancel()
+
+
 @app.get("/topics")
 async def get_topics(language: str = "English"):
     return {
@@ -1364,7 +4309,7 @@ async def get_topics(language: str = "English"):
 async def generate_situation_endpoint(req: GenerateSituationRequest):
     t0 = time.time()
     try:
-        situation = await asyncio.to_thread(call_generate_situation, req)
+        situation = await SITUATION_POOL.get(req)
         return situation
     except Exception as e:
         logger.exception("[GENERATE_SITUATION] failed: %s", e)
@@ -1389,10 +4334,206 @@ async def chat_endpoint(payload: dict = Body(...)):
 
 
     # НОВЫЙ ВЫЗОВ
-    response = await asyncio.to_thread(call_llm_chat, req)
+    response = await call_llm_chat(req)
+
+    if req.with_audio and response.reply:
+        try:
+            response.audio_url = await _synthesize_audio_url(
+                response.reply,
+                req.language,
+                req.audio_format,
+            )
+        except Exception:
+            logger.exception("[CHAT] TTS failed language=%s", req.language)
     return response
 
 
+def _sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+_SENTENCE_END_RE = re.compile(r"[.!?…。！？]+[\"'»”)]*\s+")
+
+
+class _SentenceSplitter:
+    """
+    Режет поток текста на законченные предложения, чтобы отдавать их в TTS,
+    не дожидаясь конца ответа. Слишком короткие куски ("Mr.", "Ok.") склеиваем
+    со следующим предложением.
+    """
+
+    def __init__(self, min_chars: int = 12):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        self.buffer += text
+        sentences: List[str] = []
+        start = 0
+        for m in _SENTENCE_END_RE.finditer(self.buffer):
+            candidate = self.buffer[start:m.end()].strip()
+            if len(candidate) < self.min_chars:
+                continue
+            sentences.append(candidate)
+            start = m.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self) -> List[str]:
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+
+async def _synthesize_audio_url(
+    text: str,
+    language: str,
+    audio_format: Optional[str],
+    stop: Optional[threading.Event] = None,
+) -> Optional[str]:
+    def _run() -> Optional[Path]:
+        # поток из to_thread отменить нельзя: задачи, ещё ждущие в пуле, просто не стартуют
+        if stop is not None and stop.is_set():
+            return None
+        return _ensure_cached_tts_file(
+            text,
+            language,
+            voice=None,
+            sample_rate=None,
+            audio_format=audio_format,
+        )
+
+    filepath = await asyncio.to_thread(_run)
+    return _build_audio_url(filepath.name) if filepath is not None else None
+
+
+async def _chat_stream_events(req: ChatRequest) -> AsyncIterator[str]:
+    session = await _load_chat_session(req)
+    (
+        partner_name,
+        messages,
+        has_user_message,
+        last_message_from_user,
+    ) = _prepare_chat_messages(req, session)
+    show_corrections = has_user_message and last_message_from_user
+
+    splitter = _ChatStreamSplitter()
+    sentences = _SentenceSplitter() if req.with_audio else None
+    # озвучка предложений идёт параллельно с генерацией; события audio отдаём строго по порядку
+    tts_tasks: List[tuple[str, "asyncio.Task[Optional[str]]"]] = []
+    tts_stop = threading.Event()
+    next_audio = 0
+
+    def start_tts(sentence_list: List[str]) -> None:
+        for sentence in sentence_list:
+            task = asyncio.create_task(
+                _synthesize_audio_url(sentence, req.language, req.audio_format, tts_stop)
+            )
+            tts_tasks.append((sentence, task))
+
+    def audio_event(index: int) -> str:
+        sentence, task = tts_tasks[index]
+        if task.exception() is not None:
+            logger.error("[CHAT_STREAM] TTS failed for sentence %d: %s", index, task.exception())
+            return _sse_event("audio", {"index": index, "text": sentence, "audio_url": None})
+        return _sse_event("audio", {"index": index, "text": sentence, "audio_url": task.result()})
+
+    # GeneratorExit (клиент отвалился) может прилететь на любом yield —
+    # озвучку гасим в общем finally, а не только в финальном цикле
+    try:
+        yield _sse_event("meta", {"partner_name": partner_name, "session_id": session["id"] if session else None})
+
+        parts: List[str] = []
+        stream_ok = True
+        try:
+            async for piece in llm_chat_completion_stream(messages, temperature=0.4, endpoint="chat"):
+                parts.append(piece)
+                for field, delta in splitter.feed(piece):
+                    if field == "reply":
+                        yield _sse_event("reply", {"delta": delta})
+                        if sentences is not None:
+                            start_tts(sentences.feed(delta))
+                    elif show_corrections:
+                        yield _sse_event("corrections", {"delta": delta})
+
+                while next_audio < len(tts_tasks) and tts_tasks[next_audio][1].done():
+                    yield audio_event(next_audio)
+                    next_audio += 1
+        except Exception as e:
+            stream_ok = False
+            logger.exception("[CHAT_STREAM] LLM stream failed: %s", e)
+            yield _sse_event("error", {"detail": "LLM stream failed"})
+
+        if sentences is not None:
+            start_tts(sentences.flush())
+        while next_audio < len(tts_tasks):
+            await asyncio.wait([tts_tasks[next_audio][1]])
+            yield audio_event(next_audio)
+            next_audio += 1
+
+        # финальный ответ собираем тем же разбором, что и у /chat
+        response = _build_chat_response(
+            "".join(parts).strip(),
+            partner_name,
+            has_user_message,
+            last_message_from_user,
+        )
+        if session is not None:
+            # оборванный поток в историю не пишем: недописанная реплика собьёт модель
+            await _save_chat_turn(session, response, llm_ok=stream_ok and bool("".join(parts).strip()))
+        yield _sse_event("done", response.dict())
+    finally:
+        # клиент отвалился — не синтезируем дальше впустую
+        tts_stop.set()
+        pending = [task for _, task in tts_tasks[next_audio:] if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(payload: dict = Body(...)):
+    """
+    Потоковый вариант /chat (Server-Sent Events), тот же формат запроса.
+
+    События:
+      meta        {"partner_name": ...}
+      reply       {"delta": "..."}  — кусок ответа собеседника
+      corrections {"delta": "..."}  — кусок исправлений
+      audio       {"index", "text", "audio_url"} — озвученное предложение (with_audio=true),
+                  приходит, пока модель ещё пишет следующие
+      done        полный ChatResponse (как у /chat)
+    """
+    req = _build_chat_request_from_payload(payload)
+    return StreamingResponse(
+        _chat_stream_events(req),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/chat/session/{session_id}")
+async def get_chat_session(session_id: str):
+    """История сессии — чтобы клиент мог восстановить экран чата."""
+    session = await CHAT_SESSIONS.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {
+        "session_id": session_id,
+        "partner_name": session.get("partner_name"),
+        "messages": session["messages"],
+        "turns": session["turns"],
+        "summary": session.get("summary", ""),
+    }
+
+
+@app.delete("/chat/session/{session_id}")
+async def delete_chat_session(session_id: str):
+    await CHAT_SESSIONS.delete(session_id)
+    return {"ok": True}
+
+
 @app.post("/tts")
 async def tts_endpoint(req: TTSRequest):
     text = (req.text or "").strip()
@@ -1441,11 +4582,11 @@ async def tts_endpoint(req: TTSRequest):
 @app.post("/translate-word", response_model=TranslateResponse)
 async def translate_word_endpoint(payload: TranslateRequest):
     lang = payload.language or "English"
-    return await asyncio.to_thread(
-        call_llm_translate,
+    return await call_llm_translate(
         lang,
         payload.word,
         bool(payload.with_audio),
+        payload.audio_format,
     )
 
 def _courses_lang_dir(lang: str) -> Path:
@@ -1506,65 +4647,260 @@ def _lesson_summary_from_file(lesson_path: Path) -> Optional[Dict[str, str]]:
     }
 
 
-def _load_lessons_grouped_by_skill(lang: str) -> Dict[str, List[Dict[str, str]]]:
-    lang_dir = _courses_lang_dir(lang)
+def _build_skill_tracks(lessons_by_skill: Dict[str, List[Dict[str, str]]]) -> List[Dict[str, Any]]:
+    tracks = []
+    for skill_id in SKILL_ORDER:
+        meta = SKILL_META.get(skill_id, {})
+        lessons = lessons_by_skill.get(skill_id, [])
+        lessons_count = len(lessons)
+
+        tracks.append(
+            {
+                "id": skill_id,
+                "title": meta.get("title", skill_id.title()),
+                "description": meta.get("description", ""),
+                "lessonsCount": lessons_count,
+                "xp": 0,
+                "xpGoal": max(100, lessons_count * 50),
+            }
+        )
+    return tracks
+
 
-    grouped: Dict[str, List[Dict[str, str]]] = {k: [] for k in SKILL_META.keys()}
+class CourseCatalog:
+    """
+    Индекс уроков COURSES_V2_DIR, построенный один раз при старте.
 
-    if not lang_dir.exists():
-        logger.warning("[SKILLS] language dir not found: %s", lang_dir)
-        return grouped
+    На каждый язык (подпапку) держим готовые ответы /skills: список треков
+    и уроки по навыкам. Раз в COURSES_CATALOG_POLL_S фоном сверяем mtime/size
+    файлов и перечитываем только изменившиеся уроки.
+    """
 
-    for lesson_path in _iter_lesson_files(lang_dir):
-        summary = _lesson_summary_from_file(lesson_path)
-        if not summary:
-            continue
-        grouped.setdefault(summary["skill"], []).append(summary)
+    def __init__(self, root: Path):
+        self.root = root
+        self._langs: Dict[str, Dict[str, Any]] = {}
+        self._files: Dict[str, tuple[int, int, Optional[Dict[str, str]]]] = {}
+        self._lock = threading.Lock()
+        self.last_refresh_ms = 0.0
+
+    def refresh(self) -> bool:
+        """Пересобирает индекс; True — что-то поменялось."""
+        with self._lock:
+            t0 = time.perf_counter()
+            changed = False
+            files: Dict[str, tuple[int, int, Optional[Dict[str, str]]]] = {}
+            langs: Dict[str, Dict[str, Any]] = {}
+
+            lang_dirs = sorted(p for p in self.root.iterdir() if p.is_dir()) if self.root.is_dir() else []
+            for lang_dir in lang_dirs:
+                grouped: Dict[str, List[Dict[str, str]]] = {k: [] for k in SKILL_META.keys()}
+                paths: Dict[str, tuple[Path, tuple[int, int]]] = {}
+                for lesson_path in _iter_lesson_files(lang_dir):
+                    key = str(lesson_path)
+                    try:
+                        st = lesson_path.stat()
+                    except FileNotFoundError:
+                        continue
+                    cached = self._files.get(key)
+                    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                        summary = cached[2]
+                    else:
+                        summary = _lesson_summary_from_file(lesson_path)
+                        changed = True
+                    files[key] = (st.st_mtime_ns, st.st_size, summary)
+                    if summary:
+                        grouped.setdefault(summary["skill"], []).append(summary)
+                        paths.setdefault(summary["lessonId"], (lesson_path, (st.st_mtime_ns, st.st_size)))
+
+                langs[lang_dir.name] = {
+                    "dir": lang_dir,
+                    "grouped": grouped,
+                    "paths": paths,
+                    "tracks": _build_skill_tracks(grouped),
+                    "lessons": {
+                        skill: [
+                            {"lessonId": lesson["lessonId"], "title": lesson["title"], "progress": 0}
+                            for lesson in lessons
+                        ]
+                        for skill, lessons in grouped.items()
+                    },
+                }
+
+            changed = changed or files.keys() != self._files.keys() or langs.keys() != self._langs.keys()
+            self._files = files
+            self._langs = langs
+            self.last_refresh_ms = (time.perf_counter() - t0) * 1000
+
+        if changed:
+            logger.info(
+                "[SKILLS] catalog rebuilt: %d languages, %d lessons in %.0fms",
+                len(langs),
+                len(files),
+                self.last_refresh_ms,
+            )
+        return changed
+
+    def get(self, lang: str) -> Optional[Dict[str, Any]]:
+        # те же правила, что в _courses_lang_dir: точное имя папки, потом код языка
+        langs = self._langs
+        entry = langs.get(lang or "")
+        if entry is None:
+            entry = langs.get(normalize_lang_code(lang or ""))
+        return entry
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "languages": len(self._langs),
+            "lessons": len(self._files),
+            "last_refresh_ms": round(self.last_refresh_ms, 1),
+        }
 
-    return grouped
 
+COURSE_CATALOG = CourseCatalog(COURSES_V2_DIR)
+_EMPTY_SKILL_TRACKS = _build_skill_tracks({})
 
-@app.get("/skills/{lang}")
-def list_skills(lang: str):
-    lessons_by_skill = _load_lessons_grouped_by_skill(lang)
 
-    tracks = []
-    for skill_id in SKILL_ORDER:
-        meta = SKILL_META.get(skill_id, {})
-        lessons = lessons_by_skill.get(skill_id, [])
-        lessons_count = len(lessons)
+# ---------- Раздача уроков: ETag + заранее сжатые тела ----------
+
+try:
+    import brotli
+except Exception:
+    brotli = None
+
+LESSON_BODY_CACHE_MAX = int(os.getenv("LESSON_BODY_CACHE_MAX", "2000"))
+_LESSON_BODIES: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_LESSON_BODIES_LOCK = threading.Lock()
+
+
+def _build_lesson_body(path: Path) -> Dict[str, Any]:
+    """Компактный JSON урока + gzip/brotli варианты и strong ETag (sha256 тела)."""
+    data = json.loads(path.read_text(encoding="utf-8"))
+    identity = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    bodies = {
+        "identity": identity,
+        "gzip": gzip.compress(identity, compresslevel=9, mtime=0),
+    }
+    if brotli is not None:
+        bodies["br"] = brotli.compress(identity, quality=11)
+    return {"etag": hashlib.sha256(identity).hexdigest()[:32], "bodies": bodies}
+
+
+def _get_lesson_body(path: Path, version: tuple[int, int]) -> Dict[str, Any]:
+    key = str(path)
+    with _LESSON_BODIES_LOCK:
+        cached = _LESSON_BODIES.get(key)
+        if cached is not None and cached["version"] == version:
+            _LESSON_BODIES.move_to_end(key)
+            return cached
+
+    body = _build_lesson_body(path)
+    body["version"] = version
+    with _LESSON_BODIES_LOCK:
+        _LESSON_BODIES[key] = body
+        while len(_LESSON_BODIES) > LESSON_BODY_CACHE_MAX:
+            _LESSON_BODIES.popitem(last=False)
+    return body
+
+
+_ETAG_SUFFIXES = {"identity": "", "gzip": "-gz", "br": "-br"}
+
+
+def _pick_content_encoding(accept_encoding: Optional[str], available: Dict[str, bytes]) -> str:
+    accepted: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    for encoding in ("br", "gzip"):
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return "identity"
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        tag = tag.removeprefix("W/").strip('"')
+        for suffix in ("-gz", "-br"):
+            tag = tag.removesuffix(suffix)
+        if tag == etag:
+            return True
+    return False
+
+
+@app.get("/lessons/{lang}/{lesson_id}")
+async def get_lesson_content(
+    lang: str,
+    lesson_id: str,
+    if_none_match: Optional[str] = Header(None, alias="if-none-match"),
+    accept_encoding: Optional[str] = Header(None, alias="accept-encoding"),
+):
+    """
+    Полный JSON урока из COURSES_V2_DIR.
+    Отдаём сжатым (br/gzip), с ETag; на If-None-Match с тем же ETag — 304 без тела.
+    """
+    entry = COURSE_CATALOG.get(lang)
+    found = entry["paths"].get(lesson_id) if entry else None
+    if found is None:
+        raise HTTPException(status_code=404, detail="Lesson not found")
+
+    path, version = found
+    try:
+        body = await asyncio.to_thread(_get_lesson_body, path, version)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Lesson not found")
+
+    encoding = _pick_content_encoding(accept_encoding, body["bodies"])
+    headers = {
+        "ETag": f'"{body["etag"]}{_ETAG_SUFFIXES[encoding]}"',
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",
+    }
+    if _etag_matches(if_none_match, body["etag"]):
+        return Response(status_code=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(body["bodies"][encoding], media_type="application/json", headers=headers)
+
+
+async def _poll_course_catalog() -> None:
+    while True:
+        await asyncio.sleep(COURSES_CATALOG_POLL_S)
+        try:
+            await asyncio.to_thread(COURSE_CATALOG.refresh)
+        except Exception:
+            logger.exception("[SKILLS] catalog refresh failed")
 
-        tracks.append(
-            {
-                "id": skill_id,
-                "title": meta.get("title", skill_id.title()),
-                "description": meta.get("description", ""),
-                "lessonsCount": lessons_count,
-                "xp": 0,
-                "xpGoal": max(100, lessons_count * 50),
-            }
-        )
 
-    return tracks
+@app.get("/skills/{lang}")
+async def list_skills(lang: str):
+    entry = COURSE_CATALOG.get(lang)
+    if entry is None:
+        return _EMPTY_SKILL_TRACKS
+    return entry["tracks"]
 
 
 @app.get("/skills/{lang}/{skill_id}")
-def list_lessons_for_skill(lang: str, skill_id: str):
+async def list_lessons_for_skill(lang: str, skill_id: str):
     skill_key = (skill_id or "").strip().lower()
     if skill_key not in SKILL_META:
         return []
 
-    lessons_by_skill = _load_lessons_grouped_by_skill(lang)
-    lessons = lessons_by_skill.get(skill_key, [])
-
-    return [
-        {
-            "lessonId": lesson["lessonId"],
-            "title": lesson["title"],
-            "progress": 0,
-        }
-        for lesson in lessons
-    ]
+    entry = COURSE_CATALOG.get(lang)
+    if entry is None:
+        return []
+    return entry["lessons"].get(skill_key, [])
 
 def _fallback_course_plan(prefs: CoursePreferences) -> CoursePlan:
     # Минимальный валидный план, чтобы фронт не падал
@@ -1706,191 +5042,401 @@ def _fallback_lesson(req: LessonRequest) -> LessonContent:
 
 
 
+async def _generate_course_plan_llm(prefs: CoursePreferences) -> CoursePlan:
+    """Генерирует план курса через LLM. Бросает исключение при невалидном ответе."""
+    user_content = json.dumps(prefs.dict(), ensure_ascii=False)
+
+    content = await llm_chat_completion(
+        [
+            {"role": "system", "content": COURSE_PLAN_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Вот данные ученика в JSON:\n{user_content}"},
+        ],
+        temperature=0.4,
+        endpoint="course_plan",
+    )
+
+    data = _parse_json_content(content)
+    if not data or not isinstance(data, dict):
+        raise ValueError("Failed to parse course plan JSON from model")
+
+    if ("language" not in data) or (not isinstance(data.get("language"), str)):
+        data["language"] = prefs.language
+
+    if ("overall_level" not in data) or (not isinstance(data.get("overall_level"), str)):
+        data["overall_level"] = (prefs.level_hint or "").strip()
+
+    if "levels" not in data or not isinstance(data["levels"], list):
+        raise ValueError("Model did not provide 'levels' list in course plan")
+
+    plan = CoursePlan(**data)
+    plan = _ensure_min_lessons(plan, prefs, min_lessons=6)
+    return plan
+
+
+async def _generate_and_cache_course_plan(key: str, prefs: CoursePreferences) -> Dict[str, Any]:
+    plan = await _generate_course_plan_llm(prefs)
+    data = plan.dict()
+    await COURSE_PLAN_CACHE.aput(key, data)
+    return data
+
+
+def _personalize_course_plan(data: Dict[str, Any], prefs: CoursePreferences) -> CoursePlan:
+    """
+    Копия общего плана под конкретного ученика: язык и уровень в его написании,
+    уроки, пересекающиеся с его целями, помечены matches_goals.
+    Порядок уроков — учебная программа — не меняется.
+    """
+    plan = CoursePlan(**copy.deepcopy(data))
+    plan.language = prefs.language or plan.language
+    level = _cefr_bucket(prefs.level_hint)
+    if level:
+        plan.overall_level = level
+
+    goal_words = {w for w in re.findall(r"\w{4,}", (prefs.goals or "").casefold())}
+    for lvl in plan.levels:
+        for lesson in lvl.lessons:
+            text = " ".join([lesson.title, lesson.description, *lesson.vocab_topics]).casefold()
+            lesson.matches_goals = any(w in text for w in goal_words)
+    return plan
+
+
 @app.post("/generate_course_plan", response_model=CoursePlan)
-def generate_course_plan(prefs: CoursePreferences):
+async def generate_course_plan(prefs: CoursePreferences):
     """
     Генерирует поуровневый план курса на основе предпочтений ученика.
+    Похожие ученики (язык, уровень, интересы, возраст) получают общий план из кэша.
     """
+    key = _course_plan_cache_key(prefs)
     try:
-        user_content = json.dumps(prefs.dict(), ensure_ascii=False)
+        data = await COURSE_PLAN_CACHE.aget_or_miss(key)
+        if data is None:
+            data = await _COURSE_PLAN_SINGLE_FLIGHT.do(
+                key, lambda: _generate_and_cache_course_plan(key, prefs)
+            )
+        plan = _personalize_course_plan(data, prefs)
+    except Exception as e:
+        logger.exception("[COURSE_PLAN] failed, returning fallback: %s", e)
+        return _fallback_course_plan(prefs)
 
-        content = llm_chat_completion(
-            [
-                {"role": "system", "content": COURSE_PLAN_SYSTEM_PROMPT},
-                {"role": "user", "content": f"Вот данные ученика в JSON:\n{user_content}"},
-            ],
-            temperature=0.4,
-        )
+    if PREGEN_ON_COURSE_PLAN and LLM_BACKGROUND_CONCURRENCY > 0:
+        # первые уроки готовим заранее, пока ученик смотрит на план
+        # level_hint — сырое значение ученика: план его переписывает в CEFR,
+        # а клиент шлёт в /generate_lesson именно исходный userLevel
+        _start_pregen_job(plan, PREGEN_LESSONS_PER_LEVEL, prefs.interests, prefs.level_hint)
+    return plan
 
-        data = _parse_json_content(content)
-        if not data or not isinstance(data, dict):
-            raise ValueError("Failed to parse course plan JSON from model")
 
-        if ("language" not in data) or (not isinstance(data.get("language"), str)):
-            data["language"] = prefs.language
 
-        if ("overall_level" not in data) or (not isinstance(data.get("overall_level"), str)):
-            data["overall_level"] = (prefs.level_hint or "").strip()
+async def _generate_lesson_llm(req: LessonRequest) -> LessonContent:
+    """
+    Генерирует урок через LLM и нормализует упражнения.
+    Бросает исключение, если валидного урока не получилось.
+    """
+    user_payload = {
+        "language": req.language,
+        "level_hint": req.level_hint,
+        "lesson_title": req.lesson_title,
+        "grammar_topics": req.grammar_topics,
+        "vocab_topics": req.vocab_topics,
+        "interests": req.interests,
+    }
+    if req.skill:
+        user_payload["skill_focus"] = _normalize_lesson_skill(req.skill)
 
-        if "levels" not in data or not isinstance(data["levels"], list):
-            raise ValueError("Model did not provide 'levels' list in course plan")
+    content = await llm_chat_completion(
+        [
+            {"role": "system", "content": LESSON_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": f"Сгенерируй урок строго в JSON формате.\nВходные данные:\n{json.dumps(user_payload, ensure_ascii=False)}",
+            },
+        ],
+        temperature=0.5,
+        endpoint="lesson",
+    )
 
-        plan = CoursePlan(**data)
-        plan = _ensure_min_lessons(plan, prefs, min_lessons=6)
-        return plan
+    data = _parse_json_content(content)
+    if not data or not isinstance(data, dict):
+        raise ValueError("Invalid lesson JSON")
+
+    # --- нормализация базовых полей ---
+    data.setdefault("lesson_title", req.lesson_title or "Lesson")
+    data.setdefault("description", "Auto-generated lesson")
+    data.setdefault(
+        "lesson_id",
+        (data["lesson_title"] or "lesson").replace(" ", "_").lower(),
+    )
 
+    raw_exercises = data.get("exercises", [])
+    fixed_exercises = []
 
-    except Exception as e:
-        logger.exception("[COURSE_PLAN] failed, returning fallback: %s", e)
-        return _fallback_course_plan(prefs)
+    for i, ex in enumerate(raw_exercises):
+        if not isinstance(ex, dict):
+            continue
 
+        ex_type = str(ex.get("type") or "").strip().lower()
+        if not ex_type:
+            continue
 
+        instruction = str(ex.get("instruction") or "").strip()
+        question = str(ex.get("question") or "").strip()
+        explanation = str(ex.get("explanation") or "").strip()
 
-@app.post("/generate_lesson", response_model=LessonContent)
-def generate_lesson(req: LessonRequest):
-    try:
-        user_payload = {
-            "language": req.language,
-            "level_hint": req.level_hint,
-            "lesson_title": req.lesson_title,
-            "grammar_topics": req.grammar_topics,
-            "vocab_topics": req.vocab_topics,
-            "interests": req.interests,
+        if ex_type == "translate_sentence" and not instruction:
+            instruction = "Переведите предложение на английский язык."
+
+        ex_fixed: Dict[str, Any] = {
+            "id": ex.get("id", f"ex_{i+1}"),
+            "type": ex_type,
+            "instruction": instruction or "Выполните задание.",
+            "question": question,
+            "explanation": explanation or "Разбор будет показан после проверки.",
         }
 
-        content = llm_chat_completion(
-            [
-                {"role": "system", "content": LESSON_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": f"Сгенерируй урок строго в JSON формате.\nВходные данные:\n{json.dumps(user_payload, ensure_ascii=False)}",
-                },
-            ],
-            temperature=0.5,
-        )
+        if ex_type in ("multiple_choice", "choose_correct_form"):
+            options = ex.get("options", [])
+            correct = ex.get("correct_index")
+
+            if (
+                isinstance(options, list)
+                and len(options) >= 2
+                and isinstance(correct, int)
+            ):
+                ex_fixed["options"] = [str(opt) for opt in options]
+                ex_fixed["correct_index"] = correct
+            else:
+                continue
+
+        elif ex_type in ("translate_sentence", "fill_in_blank"):
+            answer = ex.get("correct_answer")
+            if isinstance(answer, str) and answer.strip():
+                ex_fixed["correct_answer"] = answer
+                alternates = ex.get("accepted_answers")
+                if isinstance(alternates, list):
+                    ex_fixed["accepted_answers"] = [str(a) for a in alternates if str(a).strip()] or None
+                if ex_type == "fill_in_blank":
+                    gap_sentence = ex.get("sentence_with_gap")
+                    if isinstance(gap_sentence, str) and gap_sentence.strip():
+                        ex_fixed["sentence_with_gap"] = gap_sentence
+            else:
+                continue
 
-        data = _parse_json_content(content)
-        if not data or not isinstance(data, dict):
-            raise ValueError("Invalid lesson JSON")
+        elif ex_type in ("reorder_words", "sentence_order"):
+            words = ex.get("reorder_words") or ex.get("words")
+            correct_order = ex.get("reorder_correct")
+            correct_sentence = ex.get("correct_sentence") or ex.get("correct_answer")
 
-        # --- нормализация базовых полей ---
-        data.setdefault("lesson_title", req.lesson_title or "Lesson")
-        data.setdefault("description", "Auto-generated lesson")
-        data.setdefault(
-            "lesson_id",
-            (data["lesson_title"] or "lesson").replace(" ", "_").lower(),
-        )
+            if not isinstance(words, list) or len(words) < 2:
+                continue
 
-        raw_exercises = data.get("exercises", [])
-        fixed_exercises = []
+            if not isinstance(correct_order, list) and isinstance(correct_sentence, str):
+                tokens = [w.strip() for w in correct_sentence.split() if w.strip()]
+                correct_order = tokens
 
-        for i, ex in enumerate(raw_exercises):
-            if not isinstance(ex, dict):
+            if not isinstance(correct_order, list) or not correct_order:
                 continue
 
-            ex_type = str(ex.get("type") or "").strip().lower()
-            if not ex_type:
+            ex_fixed["reorder_words"] = [str(w) for w in words]
+            ex_fixed["reorder_correct"] = [str(w) for w in correct_order]
+            if isinstance(correct_sentence, str) and correct_sentence.strip():
+                ex_fixed["correct_answer"] = correct_sentence.strip()
+
+        elif ex_type == "open_answer":
+            sample_answer = ex.get("sample_answer") or ex.get("sampleAnswer")
+            evaluation = ex.get("evaluation_criteria") or ex.get("evaluationCriteria")
+            if not isinstance(sample_answer, str) or not sample_answer.strip():
                 continue
 
-            instruction = str(ex.get("instruction") or "").strip()
-            question = str(ex.get("question") or "").strip()
-            explanation = str(ex.get("explanation") or "").strip()
+            ex_fixed["sample_answer"] = sample_answer.strip()
+            ex_fixed["evaluation_criteria"] = (
+                evaluation.strip()
+                if isinstance(evaluation, str) and evaluation.strip()
+                else "Оцените грамматику, лексику и связность ответа."
+            )
 
-            if ex_type == "translate_sentence" and not instruction:
-                instruction = "Переведите предложение на английский язык."
+        else:
+            # неизвестный тип — пропускаем
+            continue
 
-            ex_fixed: Dict[str, Any] = {
-                "id": ex.get("id", f"ex_{i+1}"),
-                "type": ex_type,
-                "instruction": instruction or "Выполните задание.",
-                "question": question,
-                "explanation": explanation or "Разбор будет показан после проверки.",
-            }
+        fixed_exercises.append(LessonExercise(**ex_fixed))
 
-            if ex_type in ("multiple_choice", "choose_correct_form"):
-                options = ex.get("options", [])
-                correct = ex.get("correct_index")
-
-                if (
-                    isinstance(options, list)
-                    and len(options) >= 2
-                    and isinstance(correct, int)
-                ):
-                    ex_fixed["options"] = [str(opt) for opt in options]
-                    ex_fixed["correct_index"] = correct
-                else:
-                    continue
+    if not fixed_exercises:
+        raise ValueError("no valid exercises in generated lesson")
 
-            elif ex_type in ("translate_sentence", "fill_in_blank"):
-                answer = ex.get("correct_answer")
-                if isinstance(answer, str) and answer.strip():
-                    ex_fixed["correct_answer"] = answer
-                    if ex_type == "fill_in_blank":
-                        gap_sentence = ex.get("sentence_with_gap")
-                        if isinstance(gap_sentence, str) and gap_sentence.strip():
-                            ex_fixed["sentence_with_gap"] = gap_sentence
-                else:
-                    continue
+    return LessonContent(
+        lesson_id=data["lesson_id"],
+        lesson_title=data["lesson_title"],
+        description=data["description"],
+        exercises=fixed_exercises,
+    )
 
-            elif ex_type in ("reorder_words", "sentence_order"):
-                words = ex.get("reorder_words") or ex.get("words")
-                correct_order = ex.get("reorder_correct")
-                correct_sentence = ex.get("correct_sentence") or ex.get("correct_answer")
 
-                if not isinstance(words, list) or len(words) < 2:
-                    continue
 
-                if not isinstance(correct_order, list) and isinstance(correct_sentence, str):
-                    tokens = [w.strip() for w in correct_sentence.split() if w.strip()]
-                    correct_order = tokens
+async def _generate_and_cache_lesson(key: str, req: LessonRequest) -> LessonContent:
+    lesson = await _generate_lesson_llm(req)
+    await LESSON_CACHE.aput(key, lesson.dict())
+    return lesson
 
-                if not isinstance(correct_order, list) or not correct_order:
-                    continue
 
-                ex_fixed["reorder_words"] = [str(w) for w in words]
-                ex_fixed["reorder_correct"] = [str(w) for w in correct_order]
-                if isinstance(correct_sentence, str) and correct_sentence.strip():
-                    ex_fixed["correct_answer"] = correct_sentence.strip()
+@app.post("/generate_lesson", response_model=LessonContent)
+async def generate_lesson(req: LessonRequest):
+    key = _lesson_cache_key(req)
+    if not req.regenerate:
+        cached = await LESSON_CACHE.aget_or_miss(key)
+        if cached is not None:
+            return LessonContent(**cached)
 
-            elif ex_type == "open_answer":
-                sample_answer = ex.get("sample_answer") or ex.get("sampleAnswer")
-                evaluation = ex.get("evaluation_criteria") or ex.get("evaluationCriteria")
-                if not isinstance(sample_answer, str) or not sample_answer.strip():
-                    continue
+    try:
+        # одинаковые запросы, пришедшие одновременно, ждут одну генерацию
+        return await _LESSON_SINGLE_FLIGHT.do(key, lambda: _generate_and_cache_lesson(key, req))
+    except Exception as e:
+        logger.exception("[LESSON] generation failed, returning fallback: %s", e)
+        return _fallback_lesson(req)
 
-                ex_fixed["sample_answer"] = sample_answer.strip()
-                ex_fixed["evaluation_criteria"] = (
-                    evaluation.strip()
-                    if isinstance(evaluation, str) and evaluation.strip()
-                    else "Оцените грамматику, лексику и связность ответа."
-                )
 
-            else:
-                # неизвестный тип — пропускаем
-                continue
+# ---------- Пре-генерация уроков по плану курса ----------
+
 
-            fixed_exercises.append(LessonExercise(**ex_fixed))
+class PregenerateRequest(BaseModel):
+    """Запрос на фоновую генерацию уроков из плана курса."""
+    plan: CoursePlan
+    lessons_per_level: Optional[int] = None   # None -> PREGEN_LESSONS_PER_LEVEL
+    interests: Optional[List[str]] = None
+    # ровно то, что клиент потом пришлёт в /generate_lesson (иначе ключи кэша не совпадут);
+    # None -> plan.overall_level
+    level_hint: Optional[str] = None
 
-        if not fixed_exercises:
-            logger.warning("[LESSON] no valid exercises, returning fallback lesson")
-            return _fallback_lesson(req)
 
-        return LessonContent(
-            lesson_id=data["lesson_id"],
-            lesson_title=data["lesson_title"],
-            description=data["description"],
-            exercises=fixed_exercises,
+_PREGEN_JOBS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_PREGEN_TASKS: Dict[str, asyncio.Task] = {}
+
+
+def _pregen_lesson_requests(
+    plan: CoursePlan, per_level: int, interests: Optional[List[str]], level_hint: Optional[str]
+) -> List[LessonRequest]:
+    reqs: List[LessonRequest] = []
+    seen = set()
+    for lvl in plan.levels:
+        for lesson in lvl.lessons[: max(0, per_level)]:
+            req = LessonRequest(
+                language=plan.language,
+                level_hint=level_hint,
+                lesson_title=lesson.title,
+                grammar_topics=lesson.grammar_topics,
+                vocab_topics=lesson.vocab_topics,
+                interests=interests,
+            )
+            key = _lesson_cache_key(req)
+            if key not in seen:
+                seen.add(key)
+                reqs.append(req)
+    return reqs
+
+
+async def _pregen_one(job: Dict[str, Any], item: Dict[str, Any], req: LessonRequest) -> None:
+    key = item["cache_key"]
+    async with LLM_BACKGROUND_SEMAPHORE:
+        # урок мог уже появиться в кэше (другой план, тап ученика, пока ждали слот)
+        if await LESSON_CACHE.acontains(key):
+            item["status"] = "cached"
+            job["counts"]["cached"] += 1
+            return
+        item["status"] = "running"
+        try:
+            await _LESSON_SINGLE_FLIGHT.do(key, lambda: _generate_and_cache_lesson(key, req))
+            item["status"] = "done"
+            job["counts"]["done"] += 1
+        except Exception as e:
+            item["status"] = "failed"
+            item["error"] = str(e)
+            job["counts"]["failed"] += 1
+            logger.warning("[PREGEN] lesson %r failed: %s", req.lesson_title, e)
+
+
+async def _run_pregen_job(job: Dict[str, Any], reqs: List[LessonRequest]) -> None:
+    job["status"] = "running"
+    job["started_at"] = time.time()
+    try:
+        await asyncio.gather(
+            *(_pregen_one(job, item, req) for item, req in zip(job["lessons"], reqs))
         )
+        job["status"] = "done"
+    except asyncio.CancelledError:
+        job["status"] = "cancelled"
+        raise
+    finally:
+        job["finished_at"] = time.time()
+        _PREGEN_TASKS.pop(job["job_id"], None)
+        logger.info("[PREGEN] job %s %s: %s", job["job_id"], job["status"], job["counts"])
+
+
+def _start_pregen_job(
+    plan: CoursePlan,
+    per_level: int,
+    interests: Optional[List[str]] = None,
+    level_hint: Optional[str] = None,
+) -> Dict[str, Any]:
+    reqs = _pregen_lesson_requests(plan, per_level, interests, level_hint)
+    job_id = uuid.uuid4().hex
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "language": plan.language,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "total": len(reqs),
+        "counts": {"done": 0, "cached": 0, "failed": 0},
+        "lessons": [
+            {"lesson_title": r.lesson_title, "cache_key": _lesson_cache_key(r), "status": "pending"}
+            for r in reqs
+        ],
+    }
+    _PREGEN_JOBS[job_id] = job
+    while len(_PREGEN_JOBS) > PREGEN_JOBS_KEEP:
+        old_id, _ = _PREGEN_JOBS.popitem(last=False)
+        task = _PREGEN_TASKS.pop(old_id, None)
+        if task is not None:
+            task.cancel()
+    _PREGEN_TASKS[job_id] = asyncio.create_task(_run_pregen_job(job, reqs))
+    return job
+
+
+def _pregen_job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    view = {k: v for k, v in job.items() if k != "lessons"}
+    view["lessons"] = [{k: v for k, v in item.items() if k != "cache_key"} for item in job["lessons"]]
+    view["pending"] = job["total"] - sum(job["counts"].values())
+    return view
+
+
+@app.post("/pregenerate_lessons")
+async def pregenerate_lessons(req: PregenerateRequest):
+    """
+    Ставит в фон генерацию первых N уроков каждого уровня плана.
+    Готовые уроки попадают в кэш /generate_lesson.
+    """
+    if LLM_BACKGROUND_CONCURRENCY <= 0:
+        raise HTTPException(status_code=503, detail="Background generation is disabled (single LLM slot)")
+    per_level = req.lessons_per_level if req.lessons_per_level is not None else PREGEN_LESSONS_PER_LEVEL
+    level_hint = req.level_hint if req.level_hint is not None else (req.plan.overall_level or None)
+    job = _start_pregen_job(req.plan, per_level, req.interests, level_hint)
+    return _pregen_job_view(job)
+
+
+@app.get("/pregenerate_lessons/{job_id}")
+async def pregenerate_status(job_id: str):
+    job = _PREGEN_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return _pregen_job_view(job)
+
 
-    except Exception as e:
-        logger.exception("[LESSON] generation failed, returning fallback: %s", e)
-        return _fallback_lesson(req)
-    
 class CheckAnswerRequest(BaseModel):
     exercise_type: str
     question: str
     user_answer: str
     correct_answer: Optional[str] = None
+    accepted_answers: Optional[List[str]] = None   # допустимые альтернативы correct_answer
     sample_answer: Optional[str] = None
     evaluation_criteria: Optional[str] = None
     language: str
@@ -1900,39 +5446,256 @@ class CheckAnswerResponse(BaseModel):
     score: int  # 0–100
     feedback: str
 
-@app.post("/check_answer", response_model=CheckAnswerResponse)
-def check_answer(req: CheckAnswerRequest):
-    try:
-        user_payload = {
-            "exercise_type": req.exercise_type,
-            "question": req.question,
-            "user_answer": req.user_answer,
-            "correct_answer": req.correct_answer,
-            "sample_answer": req.sample_answer,
-            "evaluation_criteria": req.evaluation_criteria,
-            "language": req.language,
-        }
 
-        content = llm_chat_completion(
-            [
-                {"role": "system", "content": ANSWER_CHECK_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": json.dumps(user_payload, ensure_ascii=False),
-                },
-            ],
-            temperature=0.2,
-        )
+# ---------- Локальная проверка ответов (без LLM) ----------
+
+# Допустимая доля опечаток от длины ответа; для корейского слоги цельные — без допуска
+ANSWER_TYPO_RATIO: Dict[str, float] = {
+    "en": 0.12,
+    "es": 0.12,
+    "it": 0.12,
+    "fr": 0.1,
+    "de": 0.1,
+    "ko": 0.0,
+}
+ANSWER_TYPO_RATIO_DEFAULT = float(os.getenv("ANSWER_TYPO_RATIO", "0.1"))
+ANSWER_TYPO_MAX = int(os.getenv("ANSWER_TYPO_MAX", "3"))
+# Языки, где диакритика меняет слово/форму (Apfel/Äpfel) — её отличие считаем ошибкой
+ANSWER_STRICT_DIACRITICS_LANGS = {
+    l.strip() for l in os.getenv("ANSWER_STRICT_DIACRITICS_LANGS", "de").split(",") if l.strip()
+}
+
+# Типы с однозначным ответом: несовпадение = неверно, LLM не нужен
+_CLOSED_ANSWER_TYPES = {"multiple_choice", "choose_correct_form", "fill_in_blank", "reorder_words", "sentence_order"}
+# translate_sentence сверяем локально, но «не совпало» отдаём LLM — переводов бывает много
+_LOCAL_ANSWER_TYPES = _CLOSED_ANSWER_TYPES | {"translate_sentence"}
+
+_ANSWER_QUOTES = str.maketrans({"’": "'", "‘": "'", "`": "'", "´": "'", "ʼ": "'"})
+_ANSWER_INWORD_PUNCT_RE = re.compile(r"(?<=\w)-(?=\w)")   # e-mail
+# апостроф внутри слова — часть слова (it's ≠ its, we're ≠ were); снаружи — кавычка
+_ANSWER_PUNCT_RE = re.compile(r"[^\w\s']|(?<!\w)'|'(?!\w)")
+
+ANSWER_CHECK_STATS = {"local": 0, "llm": 0, "llm_errors": 0, "batch_calls": 0, "batch_items": 0}
+ANSWER_BATCH_MAX_ITEMS = int(os.getenv("ANSWER_BATCH_MAX_ITEMS", "12"))   # упражнений в одном промпте
+# Сколько упражнений максимум добиваем поштучно, если модель что-то пропустила в пачке
+ANSWER_SINGLE_FALLBACK_MAX = int(os.getenv("ANSWER_SINGLE_FALLBACK_MAX", "3"))
+
+
+def _normalize_answer(text: str) -> str:
+    """Регистр, вид апострофа, пунктуация и пробелы — без учёта; апостроф внутри слова сохраняется."""
+    text = unicodedata.normalize("NFKC", text or "").casefold().translate(_ANSWER_QUOTES)
+    text = _ANSWER_INWORD_PUNCT_RE.sub("", text)
+    return " ".join(_ANSWER_PUNCT_RE.sub(" ", text).replace("_", " ").split())
+
+
+def _strip_accents(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return unicodedata.normalize("NFC", "".join(c for c in decomposed if not unicodedata.combining(c)))
+
+
+def _bounded_levenshtein(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна; как только превысили limit — возвращаем limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            row_min = min(row_min, cur[j])
+        if row_min > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
 
-        data = _parse_json_content(content)
+def _is_form_change(a: str, b: str) -> bool:
+    """
+    Слова отличаются окончанием (walk/walks, der/den, gehe/gehst) — это другая
+    форма слова, а не опечатка. Короткие слова (артикли, местоимения) целиком
+    грамматические, любое отличие в них — тоже форма.
+    """
+    if min(len(a), len(b)) <= 3:
+        return True
+    common = len(os.path.commonprefix([a, b]))
+    return common >= min(len(a), len(b)) - 2
+
+
+def _differs_by_typos_only(user: str, target: str) -> bool:
+    """Те же слова в том же количестве; отличаются только опечатками внутри слов."""
+    user_words, target_words = user.split(), target.split()
+    if len(user_words) != len(target_words):
+        return False
+    return not any(
+        u != t and _is_form_change(u, t) for u, t in zip(user_words, target_words)
+    )
+
+
+def _answer_candidates(req: CheckAnswerRequest) -> List[str]:
+    answers = [req.correct_answer, *(req.accepted_answers or [])]
+    return [a for a in answers if isinstance(a, str) and a.strip()]
+
+
+def _grade_locally(req: CheckAnswerRequest) -> Optional[CheckAnswerResponse]:
+    """
+    Детерминированная проверка по correct_answer/accepted_answers.
+    Закрытые типы — только точное совпадение (после нормализации регистра и
+    пунктуации); допуск на диакритику и опечатки — лишь для свободного перевода.
+    None — случай неоднозначный (open_answer, перевод своими словами), нужен LLM.
+    """
+    ex_type = (req.exercise_type or "").strip().lower()
+    candidates = _answer_candidates(req)
+    if ex_type not in _LOCAL_ANSWER_TYPES or not candidates:
+        return None
+
+    user = _normalize_answer(req.user_answer)
+    if not user:
+        return CheckAnswerResponse(is_correct=False, score=0, feedback="Ответ пустой.")
+
+    normalized = [(cand, _normalize_answer(cand)) for cand in candidates]
+    for cand, norm in normalized:
+        if user == norm:
+            return CheckAnswerResponse(is_correct=True, score=100, feedback="Верно!")
 
+    if ex_type in _CLOSED_ANSWER_TYPES:
+        # выбор/порядок/пропуск проверяют как раз одну букву или форму —
+        # без допусков на диакритику и опечатки
         return CheckAnswerResponse(
-            is_correct=bool(data.get("is_correct")),
-            score=int(data.get("score", 0)),
-            feedback=data.get("feedback", "No feedback"),
+            is_correct=False,
+            score=0,
+            feedback=f"Неверно. Правильный ответ: {candidates[0]}",
         )
 
+    lang = normalize_lang_code(req.language)
+    strict_accents = lang in ANSWER_STRICT_DIACRITICS_LANGS
+    if not strict_accents:
+        user_plain = _strip_accents(user)
+        for cand, norm in normalized:
+            if user_plain == _strip_accents(norm):
+                return CheckAnswerResponse(
+                    is_correct=True,
+                    score=90,
+                    feedback=f"Верно, но обратите внимание на диакритику: {cand}",
+                )
+    else:
+        user_plain = user
+
+    ratio = ANSWER_TYPO_RATIO.get(lang, ANSWER_TYPO_RATIO_DEFAULT)
+    for cand, norm in normalized:
+        target = norm if strict_accents else _strip_accents(norm)
+        limit = min(ANSWER_TYPO_MAX, int(len(target) * ratio))
+        if limit <= 0:
+            continue
+        dist = _bounded_levenshtein(user_plain, target, limit)
+        if dist <= limit and _differs_by_typos_only(user_plain, target):
+            return CheckAnswerResponse(
+                is_correct=True,
+                score=max(70, 100 - 10 * dist),
+                feedback=f"Почти верно — небольшая опечатка. Правильно: {cand}",
+            )
+
+    # свободный перевод: не совпало — решает LLM
+    return None
+
+
+def _answer_key_text(text: str) -> str:
+    """
+    Нормализация для ключа кэша: только регистр и пробелы. Пунктуацию не трогаем —
+    it's/its, we're/were, can't/cant должны получать разные вердикты LLM.
+    """
+    return " ".join(unicodedata.normalize("NFC", text or "").casefold().split())
+
+
+def _answer_cache_key(req: CheckAnswerRequest) -> str:
+    """
+    (отпечаток упражнения, ответ, язык). Отпечаток — всё, что влияет на оценку:
+    тип, вопрос, эталоны и критерии; регистр и пробелы не важны.
+    """
+    fingerprint = {
+        "type": (req.exercise_type or "").strip().lower(),
+        "question": _answer_key_text(req.question),
+        "answers": sorted({_answer_key_text(a) for a in _answer_candidates(req)}),
+        "sample": _answer_key_text(req.sample_answer or ""),
+        "criteria": " ".join((req.evaluation_criteria or "").split()),
+    }
+    raw = json.dumps(
+        [fingerprint, _answer_key_text(req.user_answer), normalize_lang_code(req.language)],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+ANSWER_CACHE = SqliteResponseCache(
+    "answer_checks",
+    ttl_s=ANSWER_CACHE_TTL_S,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+)
+_ANSWER_SINGLE_FLIGHT = _AsyncSingleFlight()
+
+
+async def _grade_with_llm(req: CheckAnswerRequest) -> CheckAnswerResponse:
+    """Оценка через LLM; бросает исключение, если ответ модели не разобрать."""
+    user_payload = {
+        "exercise_type": req.exercise_type,
+        "question": req.question,
+        "user_answer": req.user_answer,
+        "correct_answer": req.correct_answer,
+        "accepted_answers": req.accepted_answers,
+        "sample_answer": req.sample_answer,
+        "evaluation_criteria": req.evaluation_criteria,
+        "language": req.language,
+    }
+
+    content = await llm_chat_completion(
+        [
+            {"role": "system", "content": ANSWER_CHECK_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": json.dumps(user_payload, ensure_ascii=False),
+            },
+        ],
+        temperature=0.2,
+        endpoint="check_answer",
+        raise_errors=True,
+    )
+
+    data = _parse_json_content(content)
+    if not isinstance(data, dict) or "is_correct" not in data:
+        raise ValueError("Invalid answer check JSON")
+
+    return CheckAnswerResponse(
+        is_correct=bool(data.get("is_correct")),
+        score=max(0, min(100, int(data.get("score", 0)))),
+        feedback=data.get("feedback", "No feedback"),
+    )
+
+
+async def _grade_and_cache(key: str, req: CheckAnswerRequest) -> CheckAnswerResponse:
+    ANSWER_CHECK_STATS["llm"] += 1
+    result = await _grade_with_llm(req)
+    await ANSWER_CACHE.aput(key, result.dict())
+    return result
+
+
+@app.post("/check_answer", response_model=CheckAnswerResponse)
+async def check_answer(req: CheckAnswerRequest):
+    local = _grade_locally(req)
+    if local is not None:
+        ANSWER_CHECK_STATS["local"] += 1
+        return local
+
+    # тот же неверный ответ на то же упражнение уже оценивали — отдаём сохранённый
+    key = _answer_cache_key(req)
+    cached = await ANSWER_CACHE.aget_or_miss(key)
+    if cached is not None:
+        return CheckAnswerResponse(**cached)
+
+    try:
+        return await _ANSWER_SINGLE_FLIGHT.do(key, lambda: _grade_and_cache(key, req))
     except Exception as e:
+        ANSWER_CHECK_STATS["llm_errors"] += 1
         logger.exception("[CHECK_ANSWER] failed: %s", e)
         return CheckAnswerResponse(
             is_correct=False,
@@ -1943,9 +5706,209 @@ def check_answer(req: CheckAnswerRequest):
 
 
 
+# ---------- Проверка целого урока одним запросом ----------
+
+
+class LessonAnswersRequest(BaseModel):
+    """
+    Ответы ученика на упражнения урока: exercise id -> ответ.
+    Для multiple_choice/choose_correct_form вместо текста можно прислать
+    номер варианта в answer_indices — строка из цифр в answers всегда текст
+    (варианты бывают числами). Если у отвеченных упражнений id повторяется,
+    ответ не сопоставить однозначно — 422.
+    """
+    language: str
+    lesson: LessonContent
+    answers: Dict[str, str] = {}
+    answer_indices: Dict[str, int] = {}
+
+
+class ExerciseCheckResult(CheckAnswerResponse):
+    exercise_id: str
+
+
+class LessonAnswersResponse(BaseModel):
+    results: List[ExerciseCheckResult]
+    correct_count: int
+    score: int  # средний балл по проверенным упражнениям, 0–100
+
+
+def _check_request_for_exercise(
+    ex: LessonExercise,
+    user_answer: str,
+    language: str,
+    answer_index: Optional[int] = None,
+) -> CheckAnswerRequest:
+    correct = ex.correct_answer
+    answer = user_answer or ""
+    if ex.type in ("multiple_choice", "choose_correct_form") and ex.options:
+        if ex.correct_index is not None and 0 <= ex.correct_index < len(ex.options):
+            correct = ex.options[ex.correct_index]
+        if answer_index is not None and 0 <= answer_index < len(ex.options):
+            answer = ex.options[answer_index]
+    elif ex.type in ("reorder_words", "sentence_order") and not correct and ex.reorder_correct:
+        correct = " ".join(ex.reorder_correct)
+
+    return CheckAnswerRequest(
+        exercise_type=ex.type,
+        question=ex.sentence_with_gap or ex.question,
+        user_answer=answer,
+        correct_answer=correct,
+        accepted_answers=ex.accepted_answers,
+        sample_answer=ex.sample_answer,
+        evaluation_criteria=ex.evaluation_criteria,
+        language=language,
+    )
+
+
+async def _grade_packed(items: List[tuple]) -> Dict[str, CheckAnswerResponse]:
+    """
+    Одна LLM-оценка на пачку упражнений. items: (exercise_id, cache_key, req).
+    Возвращает то, что модель оценила; недостающие id доделывает вызывающий.
+    """
+    payload = {
+        "language": items[0][2].language,
+        "items": [
+            {
+                "id": ex_id,
+                "exercise_type": req.exercise_type,
+                "question": req.question,
+                "user_answer": req.user_answer,
+                "correct_answer": req.correct_answer,
+                "accepted_answers": req.accepted_answers,
+                "sample_answer": req.sample_answer,
+                "evaluation_criteria": req.evaluation_criteria,
+            }
+            for ex_id, _, req in items
+        ],
+    }
+    ANSWER_CHECK_STATS["batch_calls"] += 1
+    ANSWER_CHECK_STATS["batch_items"] += len(items)
+    content = await llm_chat_completion(
+        [
+            {"role": "system", "content": ANSWER_CHECK_BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": json.dumps(payload, ensure_ascii=False)},
+        ],
+        temperature=0.2,
+        endpoint="check_answers_batch",
+        raise_errors=True,
+    )
+    data = _parse_json_content(content)
+    rows = data.get("results") if isinstance(data, dict) else None
+    if not isinstance(rows, list):
+        raise ValueError("Invalid batch answer check JSON")
+
+    keys = {ex_id: key for ex_id, key, _ in items}
+    graded: Dict[str, CheckAnswerResponse] = {}
+    for row in rows:
+        if not isinstance(row, dict) or "is_correct" not in row:
+            continue
+        ex_id = str(row.get("id"))
+        if ex_id not in keys or ex_id in graded:
+            continue
+        try:
+            result = CheckAnswerResponse(
+                is_correct=bool(row.get("is_correct")),
+                score=max(0, min(100, int(row.get("score", 0)))),
+                feedback=row.get("feedback", "No feedback"),
+            )
+        except (TypeError, ValueError):
+            continue
+        graded[ex_id] = result
+        await ANSWER_CACHE.aput(keys[ex_id], result.dict())
+    return graded
+
+
+def _ungraded_answer() -> CheckAnswerResponse:
+    ANSWER_CHECK_STATS["llm_errors"] += 1
+    return CheckAnswerResponse(
+        is_correct=False,
+        score=0,
+        feedback="Could not evaluate answer. Please try again.",
+    )
+
+
+async def _grade_one_safe(key: str, req: CheckAnswerRequest) -> CheckAnswerResponse:
+    try:
+        return await _ANSWER_SINGLE_FLIGHT.do(key, lambda: _grade_and_cache(key, req))
+    except Exception as e:
+        logger.warning("[CHECK_ANSWER] single fallback failed: %s", e)
+        return _ungraded_answer()
+
+
+@app.post("/check_answers", response_model=LessonAnswersResponse)
+async def check_answers(req: LessonAnswersRequest):
+    """
+    Проверка всех ответов урока за один вызов: детерминированные — локально,
+    повторы — из кэша, остальное — одним упакованным промптом к LLM
+    (если модель что-то пропустила — добиваем по одному, не больше
+    ANSWER_SINGLE_FALLBACK_MAX и не после сбоя LLM).
+    """
+    answered = [ex.id for ex in req.lesson.exercises if ex.id in req.answers or ex.id in req.answer_indices]
+    duplicates = sorted({ex_id for ex_id in answered if answered.count(ex_id) > 1})
+    if duplicates:
+        raise HTTPException(status_code=422, detail=f"Duplicate exercise ids: {', '.join(duplicates)}")
+
+    # результаты по позиции упражнения — её же отдаём модели как id в пачке
+    results: Dict[str, CheckAnswerResponse] = {}
+    pending: List[tuple] = []
+
+    for pos, ex in enumerate(req.lesson.exercises):
+        if ex.id not in req.answers and ex.id not in req.answer_indices:
+            continue
+        check_req = _check_request_for_exercise(
+            ex, req.answers.get(ex.id, ""), req.language, req.answer_indices.get(ex.id)
+        )
+        item_id = str(pos)
+        local = _grade_locally(check_req)
+        if local is not None:
+            ANSWER_CHECK_STATS["local"] += 1
+            results[item_id] = local
+            continue
+        key = _answer_cache_key(check_req)
+        cached = await ANSWER_CACHE.aget_or_miss(key)
+        if cached is not None:
+            results[item_id] = CheckAnswerResponse(**cached)
+            continue
+        pending.append((item_id, key, check_req))
+
+    llm_failed = False
+    if len(pending) > 1:
+        chunks = [pending[i : i + ANSWER_BATCH_MAX_ITEMS] for i in range(0, len(pending), ANSWER_BATCH_MAX_ITEMS)]
+        packed = await asyncio.gather(*(_grade_packed(chunk) for chunk in chunks), return_exceptions=True)
+        for outcome in packed:
+            if isinstance(outcome, Exception):
+                logger.warning("[CHECK_ANSWER] packed grading failed: %r", outcome)
+                # ValueError — модель ответила, но не тем; остальное — таймаут/недоступность
+                llm_failed = llm_failed or not isinstance(outcome, ValueError)
+                continue
+            results.update(outcome)
+
+    leftovers = [(ex_id, key, r) for ex_id, key, r in pending if ex_id not in results]
+    # LLM лежит или не успевает — поштучные вызовы только добавят ей нагрузки
+    singles = [] if llm_failed else leftovers[:ANSWER_SINGLE_FALLBACK_MAX]
+    if singles:
+        graded = await asyncio.gather(*(_grade_one_safe(key, r) for _, key, r in singles))
+        results.update({ex_id: res for (ex_id, _, _), res in zip(singles, graded)})
+    for ex_id, _, _ in leftovers:
+        if ex_id not in results:
+            results[ex_id] = _ungraded_answer()
+
+    ordered = [
+        ExerciseCheckResult(exercise_id=ex.id, **results[str(pos)].dict())
+        for pos, ex in enumerate(req.lesson.exercises)
+        if str(pos) in results
+    ]
+    return LessonAnswersResponse(
+        results=ordered,
+        correct_count=sum(1 for r in ordered if r.is_correct),
+        score=round(sum(r.score for r in ordered) / len(ordered)) if ordered else 0,
+    )
+
+
 # ---------- Локальный запуск ----------
 
 if __name__ == "__main__":
     import uvicorn
 
-uvicorn.run(app, host=BACKEND_HOST, port=BACKEND_PORT)
+    uvicorn.run(app, host=BACKEND_HOST, port=BACKEND_PORT)
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# кэши и аудио — во временный каталог, чтобы импорт бэкенда не трогал рабочие
+_TMP = tempfile.mkdtemp(prefix="ltb_tests_")
+os.environ.setdefault("AUDIO_CACHE_DIR", os.path.join(_TMP, "audio"))
+os.environ.setdefault("COURSES_V2_DIR", os.path.join(_TMP, "courses"))
+os.environ.setdefault("CACHE_DB_PATH", os.path.join(_TMP, "cache.sqlite3"))
+os.environ.setdefault("LLM_WARMUP", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
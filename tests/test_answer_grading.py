@@ -0,0 +1,46 @@
+import pytest
+
+import language_tutor_backend as ltb
+
+
+def _grade(exercise_type, user_answer, correct_answer, language="en"):
+    return ltb._grade_locally(
+        ltb.CheckAnswerRequest(
+            exercise_type=exercise_type,
+            question="q",
+            user_answer=user_answer,
+            correct_answer=correct_answer,
+            language=language,
+        )
+    )
+
+
+@pytest.mark.parametrize(
+    "user, correct",
+    [
+        ("its", "it's"),
+        ("were", "we're"),
+        ("cant", "can't"),
+        ("well", "we'll"),
+        ("hell", "he'll"),
+        ("shed", "she'd"),
+    ],
+)
+def test_apostrophe_changes_the_word(user, correct):
+    res = _grade("fill_in_blank", user, correct)
+    assert res is not None and not res.is_correct and res.score == 0
+
+
+def test_apostrophe_variants_are_equal():
+    res = _grade("fill_in_blank", "it’s", "it's")
+    assert res.is_correct and res.score == 100
+
+
+def test_quotes_around_answer_are_ignored():
+    res = _grade("fill_in_blank", "'it's'", "it's")
+    assert res.is_correct
+
+
+def test_translation_missing_apostrophe_is_not_accepted_locally():
+    res = _grade("translate_sentence", "Its raining", "It's raining.")
+    assert res is None or not res.is_correct
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+
+import language_tutor_backend as ltb
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _background_concurrency(**env):
+    out = subprocess.run(
+        [sys.executable, "-c", "import language_tutor_backend as m; print(m.LLM_BACKGROUND_CONCURRENCY)"],
+        cwd=ROOT,
+        env={**os.environ, **env},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return int(out.stdout.strip().splitlines()[-1])
+
+
+def test_single_llm_slot_leaves_no_background_budget():
+    assert _background_concurrency(LLM_MAX_CONCURRENCY="1") == 0
+    assert _background_concurrency(LLM_MAX_CONCURRENCY="1", LLM_BACKGROUND_CONCURRENCY="3") == 0
+
+
+def test_background_budget_keeps_one_slot_free():
+    assert _background_concurrency(LLM_MAX_CONCURRENCY="4", LLM_BACKGROUND_CONCURRENCY="4") == 3
+
+
+def test_no_background_work_without_budget(monkeypatch):
+    monkeypatch.setattr(ltb, "LLM_BACKGROUND_CONCURRENCY", 0)
+    calls = []
+
+    async def fake_generate(req):
+        calls.append(req)
+        return object()
+
+    monkeypatch.setattr(ltb, "call_generate_situation", fake_generate)
+
+    async def run():
+        pool = ltb.SituationPool(size=3, max_buckets=10)
+        req = ltb.GenerateSituationRequest(language="en", level="B1", character="barista")
+        for _ in range(3):
+            await pool.get(req)
+        await asyncio.sleep(0)
+        return pool.stats()
+
+    stats = asyncio.run(run())
+    assert len(calls) == 3
+    assert stats["generated"] == 0 and stats["filling"] == 0
+    assert not ltb._chat_summaries_enabled()
+
+
+def test_pregenerate_endpoint_refuses_without_budget(monkeypatch):
+    monkeypatch.setattr(ltb, "LLM_BACKGROUND_CONCURRENCY", 0)
+    plan = ltb.CoursePlan.construct(language="en", levels=[], overall_level="A1")
+    with pytest.raises(ltb.HTTPException) as exc:
+        asyncio.run(ltb.pregenerate_lessons(ltb.PregenerateRequest.construct(plan=plan)))
+    assert exc.value.status_code == 503